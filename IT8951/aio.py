@@ -0,0 +1,304 @@
+"""
+asyncio variants of the SPI transport, the EPD and the AutoEPDDisplay.
+
+The HRDY edge is handed to the event loop with loop.call_soon_threadsafe, so waiting
+for the controller suspends the calling task instead of blocking the loop, and refreshes
+are polled with asyncio.sleep. The controller is still initialized synchronously when
+the objects are created.
+
+    display = AsyncEPDDisplay(vcom=-2.06)
+    await display.clear()
+    ...
+    await display.draw_partial(DisplayModes.DU)
+"""
+
+import asyncio
+import logging
+
+from .constants import Commands, DisplayModes, PixelModes, Rotate
+from .display import AutoEPDDisplay
+from .interface import DEVICE_MEMORY, EPD
+from .spi import SPI, WORD
+
+import numpy as np
+
+
+async def run_ops_async(ops, target, suffix=''):
+    """
+    Like IT8951.interface.run_ops, but awaits the coroutine methods of target called name + suffix
+    and pauses with asyncio.sleep
+    """
+    value = None
+    while True:
+        try:
+            step = ops.send(value)
+        except StopIteration as stop:
+            return stop.value
+        name, args = step[0], step[1:]
+        if name == 'pause':
+            value = await asyncio.sleep(*args)
+        else:
+            value = await getattr(target, name + suffix)(*args)
+
+
+class AsyncSPI(SPI):
+    """
+    A SPI transport with coroutine variants of the methods waiting for HRDY. The
+    synchronous methods keep working, EPD uses them to initialize the controller.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # loop and future of the task waiting for the next HRDY edge
+        self._loop = None
+        self._waiter = None
+        SPI.__init__(self, *args, **kwargs)
+
+    def ready_pin(self, channel):
+        SPI.ready_pin(self, channel)
+        loop, waiter = self._loop, self._waiter
+        if loop is not None and waiter is not None:
+            # called from the GPIO thread, or synchronously by an emulated controller
+            loop.call_soon_threadsafe(self._wake, waiter)
+
+    @staticmethod
+    def _wake(waiter):
+        if not waiter.done():
+            waiter.set_result(True)
+
+    def prime_ready(self):
+        SPI.prime_ready(self)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        self._waiter = loop.create_future() if loop is not None else None
+        self._loop = loop
+
+    async def wait_ready_async(self, timeout=1.0):
+        """
+        Wait for the rising edge of HRDY without blocking the event loop.
+        :return: False if the controller did not get ready within timeout.
+        """
+        if timeout == 0.0 or self.ready.is_set():
+            return True
+        if self._waiter is None:
+            # primed outside of the event loop
+            return self.wait_ready(timeout)
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            if self.ready.is_set():
+                return True
+            logging.error('HRDY timeout after {:1.3f}'.format(timeout))
+            return False
+
+    async def write_ndata_async(self, data, timeout=1.0):
+        """
+        Write data words in chunks of at most MAX_BUFFER_SIZE words, handing the event
+        loop to other tasks while the controller takes each chunk. Batched transfers are
+        not used, they would block the loop for the whole batch.
+        """
+        words = self._as_words(data)
+        buf = self.pool.get('chunk', self.MAX_BUFFER_SIZE + 1, WORD)
+        buf[0] = 0x0000
+        for i in range(0, words.size, self.MAX_BUFFER_SIZE):
+            chunk = words[i:i + self.MAX_BUFFER_SIZE]
+            buf[1:chunk.size + 1] = chunk
+            self.prime_ready()
+            self._send(buf[:chunk.size + 1])
+            await self.wait_ready_async(timeout)
+
+    async def write_data_async(self, us_data, timeout=1.0):
+        self.prime_ready()
+        self._send_word(0x0000, us_data)
+        await self.wait_ready_async(timeout)
+
+    async def write_cmd_code_async(self, cmd_code, timeout=0.0):
+        self.prime_ready()
+        self._send_word(0x6000, cmd_code)
+        await self.wait_ready_async(timeout)
+
+    async def send_cmd_arg_async(self, cmd_code, args, timeout=1.0):
+        # EPD probes batched arguments while it is initialized, so this does not block
+        batched = len(args) > 1 and self.args_batched()
+        await self.write_cmd_code_async(cmd_code)
+        if batched:
+            self.prime_ready()
+            self.write(0x0000, args)
+            await self.wait_ready_async(timeout)
+            return
+        for arg in args:
+            await self.write_data_async(arg, timeout)
+
+    async def read_data_async(self, n):
+        send = self.pool.get('read', n + 2, WORD)
+        send[:] = 0
+        send[0] = 0x1000
+        self.prime_ready()
+        data = self.xfer3(send)
+        await self.wait_ready_async()
+        return data[2:].tolist()
+
+    async def read_int_async(self):
+        return (await self.read_data_async(1))[0]
+
+    async def read_ndata_async(self, n, timeout=1.0):
+        """
+        Read n data words like SPI.read_ndata, handing the event loop to other tasks
+        while the controller prepares each chunk
+        """
+        data = np.empty(n, dtype=np.uint16)
+        send = self.pool.get('read', self.MAX_BUFFER_SIZE + 2, WORD)
+        send[:] = 0
+        send[0] = 0x1000
+        for i in range(0, n, self.MAX_BUFFER_SIZE):
+            count = min(self.MAX_BUFFER_SIZE, n - i)
+            self.prime_ready()
+            data[i:i + count] = self.xfer3(send[:count + 2])[2:]
+            await self.wait_ready_async(timeout)
+        return data
+
+
+class AsyncEPD(EPD):
+    """
+    An EPD whose image transfers, refreshes and power state changes are coroutines.
+    It is initialized synchronously, like EPD.
+
+    Parameters
+    ----------
+
+    vcom : float
+         The VCOM voltage that produces optimal display.
+
+    spi : AsyncSPI, optional
+         The transport to talk to the controller, defaults to AsyncSPI().
+
+    cache : str, optional
+         Path of the device info cache, see EPD.
+
+    memory_size : int, optional
+         Bytes of device memory, see EPD.
+    """
+
+    def __init__(self, vcom=-1.5, spi=None, cache=None, memory_size=DEVICE_MEMORY):
+        if spi is None:
+            spi = AsyncSPI(reset=cache is None)
+        EPD.__init__(self, vcom, spi, cache, memory_size)
+
+    async def load_img_area(self, buf, rotate_mode=Rotate.NONE, xy=None, dims=None,
+                            pixel_format=PixelModes.M_4BPP, offset=0):
+        """
+        Coroutine of EPD.load_img_area, returns the pixel format that was used
+        """
+        return await self._run(self._load_img_area_ops(buf, rotate_mode, xy, dims, pixel_format, offset))
+
+    async def display_area(self, xy, dims, display_mode):
+        """
+        Coroutine of EPD.display_area
+        """
+        await self._run(self._display_area_ops(xy, dims, display_mode))
+
+    async def display_buf_area(self, xy, dims, display_mode, offset):
+        """
+        Coroutine of EPD.display_buf_area
+        """
+        await self._run(self._display_buf_area_ops(xy, dims, display_mode, offset))
+
+    async def display_ready(self):
+        """
+        Coroutine of EPD.display_ready
+        """
+        return await self._run(self._display_ready_ops())
+
+    async def wait_display_ready(self):
+        """
+        Return once the display engine has finished all refreshes, see EPD.wait_display_ready
+        """
+        await self._run(self._wait_display_ready_ops())
+
+    async def read_register_async(self, address):
+        return await self._run(self._read_register_ops(address))
+
+    async def write_register_async(self, address, val):
+        await self._run(self._write_register_ops(address, val))
+
+    def _run(self, ops):
+        # the coroutine variants of the SPI methods, which end in _async
+        return run_ops_async(ops, self.spi, '_async')
+
+    async def active(self):
+        await self.spi.write_cmd_code_async(Commands.SYS_RUN, 1.0)
+
+    async def sleep(self):
+        await self.spi.write_cmd_code_async(Commands.SLEEP, 1.0)
+
+
+class AsyncEPDDisplay(AutoEPDDisplay):
+    """
+    An AutoEPDDisplay whose draw_full, draw_partial, clear, store_slot, show_slot,
+    wait_display_ready, activate and sleep are coroutines. Calls from concurrent tasks
+    are serialized, each draw sends the frame as it was when the call got its turn.
+
+    Parameters
+    ----------
+
+    epd : AsyncEPD, optional
+        The device, defaults to AsyncEPD(vcom)
+
+    vcom : float
+        The VCOM voltage if epd is not given
+
+    cache : str, optional
+        The device info cache if epd is not given, see EPD
+
+    All other keyword arguments are passed to AutoDisplay.
+    """
+
+    def __init__(self, epd=None, vcom=-1.50, cache=None, **kwargs):
+        if epd is None:
+            epd = AsyncEPD(vcom=vcom, cache=cache)
+        AutoEPDDisplay.__init__(self, epd, vcom, **kwargs)
+        self._lock = asyncio.Lock()
+
+    async def draw_full(self, mode, pixel_format=None, dither=None):
+        async with self._lock:
+            for update in self._full_updates(mode, pixel_format, dither):
+                await self.update(*update)
+
+    async def draw_partial(self, mode, pixel_format=None, damage=None, dither=None):
+        async with self._lock:
+            for update in self._partial_updates(mode, pixel_format, damage, dither):
+                await self.update(*update)
+
+    async def clear(self):
+        self.frame_buf.paste(0xFF, box=(0, 0, self.width, self.height))
+        await self.draw_full(DisplayModes.INIT)
+
+    async def store_slot(self, name, image=None, pixel_format=None):
+        async with self._lock:
+            args = self._slot_store(name, image, pixel_format)
+            await run_ops_async(self._load_slot_ops(*args), self.epd)
+
+    async def show_slot(self, name, mode=DisplayModes.GC16):
+        async with self._lock:
+            offset, mode = self._slot_show(name, mode)
+            await run_ops_async(self._display_slot_ops(offset, mode), self.epd)
+
+    async def wait_display_ready(self):
+        """
+        Return once the panel has finished all refreshes
+        """
+        async with self._lock:
+            await run_ops_async(self._wait_display_ready_ops(), self.epd)
+
+    async def activate(self):
+        async with self._lock:
+            await self.epd.active()
+
+    async def sleep(self):
+        async with self._lock:
+            await self.epd.sleep()
+
+    async def update(self, data, xy, dims, mode, pixel_format=PixelModes.M_4BPP):
+        await run_ops_async(self._update_ops(data, xy, dims, mode, pixel_format), self.epd)
@@ -0,0 +1,272 @@
+"""
+Benchmark of the update pipeline, run against the emulator so it does not need a panel.
+
+Every stage of AutoEPDDisplay.draw_partial is timed on its own for a sweep of panel sizes,
+region sizes and dirty patterns. The results are written as JSON and can be compared to
+the results of an earlier run:
+
+    python -m IT8951.benchmark --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import ImageDraw
+
+from .constants import DisplayModes, PixelModes
+from .display import AutoEPDDisplay, Quantizer
+from .emulator import IT8951Emulator
+from .interface import PackCache
+from .spi import SPI
+
+PANELS = [(800, 600), (1024, 758), (1200, 825), (1448, 1072), (1872, 1404)]
+REGIONS = [(32, 32), (128, 64), (400, 300)]
+PATTERNS = ['block', 'scattered', 'full']
+
+
+def timed(func, repeat):
+    """
+    Call func repeat times and return the median and minimum duration in milliseconds
+    together with the result of the last call
+    """
+    times = []
+    rtn = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rtn = func()
+        times.append(1000 * (time.perf_counter() - start))
+    return {'median': statistics.median(times), 'min': min(times)}, rtn
+
+
+def dirty_boxes(pattern, panel, region):
+    """
+    Return the rectangles changed by a dirty pattern
+    """
+    width, height = panel
+    w, h = min(region[0], width), min(region[1], height)
+    if pattern == 'full':
+        return [(0, 0, width, height)]
+    if pattern == 'scattered':
+        w, h = max(w // 2, 1), max(h // 2, 1)
+        return [(0, 0, w, h), (width - w, 0, width, h),
+                (0, height - h, w, height), (width - w, height - h, width, height)]
+    x, y = (width - w) // 2, (height - h) // 2
+    return [(x, y, x + w, y + h)]
+
+
+def draw_pattern(frame_buf, boxes, color):
+    draw = ImageDraw.Draw(frame_buf)
+    for box in boxes:
+        draw.rectangle([box[0], box[1], box[2] - 1, box[3] - 1], fill=color)
+
+
+def bench_case(display, pattern, region, repeat):
+    """
+    Time each stage of a partial update for one dirty pattern and region size
+    """
+    epd = display.epd
+    panel = (display.width, display.height)
+    boxes = dirty_boxes(pattern, panel, region)
+    colors = [0x00, 0x80]
+
+    # start from a known state
+    display.frame_buf.paste(0xFF, box=(0, 0, display.width, display.height))
+    display.draw_full(DisplayModes.GC16)
+    prev = display.prev_frame.copy()
+    draw_pattern(display.frame_buf, boxes, colors[0])
+    frame = display._get_frame_buf()
+
+    stages = {}
+    stages['compute_diff_box'], box = timed(lambda: display._compute_diff_box(prev, frame, round_to=4), repeat)
+
+    def diff_boxes():
+        display.diff.reset(prev)
+        start = time.perf_counter()
+        display._compute_diff_boxes()
+        return 1000 * (time.perf_counter() - start)
+    diffs = [diff_boxes() for _ in range(repeat)]
+    stages['compute_diff_boxes'] = {'median': statistics.median(diffs), 'min': min(diffs)}
+    display.diff.reset(prev)
+
+    stages['crop_region'], data = timed(lambda: display._get_frame_region(box), repeat)
+    xy = (box[0], box[1])
+    dims = (box[2] - box[0], box[3] - box[1])
+    for name in ('M_1BPP', 'M_2BPP', 'M_3BPP', 'M_4BPP', 'M_8BPP'):
+        stages['pack_' + name], words = timed(
+            lambda: epd._pack_pixels(data, getattr(PixelModes, name), pool=epd.spi.pool), repeat)
+    key, pixels = PackCache.key(data, PixelModes.M_4BPP)
+    cache = PackCache()
+    cache.put(key, pixels, epd._pack_pixels(pixels, PixelModes.M_4BPP))
+    stages['pack_cache_hit'], _ = timed(
+        lambda: cache.get(*PackCache.key(data, PixelModes.M_4BPP, pool=epd.spi.pool)), repeat)
+    for method in Quantizer.METHODS:
+        quantizer = Quantizer(2, method)
+        stages['quantize_' + method], _ = timed(lambda: quantizer.quantize(data), repeat)
+    words = epd._pack_pixels(data, PixelModes.M_4BPP)
+    stages['encode_words'], _ = timed(lambda: SPI.unsignedshort2bytes(words), repeat)
+
+    def transfer():
+        epd._load_img_area_start(0, PixelModes.M_4BPP, 0, xy, dims)
+        epd.spi.write_ndata(words)
+        epd._load_img_end()
+    stages['spi_transfer'], _ = timed(transfer, repeat)
+
+    def refresh():
+        epd.display_area(xy, dims, DisplayModes.GC16)
+        start = time.perf_counter()
+        epd.wait_display_ready()
+        return 1000 * (time.perf_counter() - start)
+    waits = [refresh() for _ in range(repeat)]
+    stages['wait_display_ready'] = {'median': statistics.median(waits), 'min': min(waits)}
+
+    # the whole pipeline, toggling the pattern color so every call has the same changes
+    display.draw_partial(DisplayModes.GC16)
+    times = []
+    for i in range(repeat):
+        draw_pattern(display.frame_buf, boxes, colors[(i + 1) % 2])
+        start = time.perf_counter()
+        display.draw_partial(DisplayModes.GC16)
+        times.append(1000 * (time.perf_counter() - start))
+    stages['draw_partial'] = {'median': statistics.median(times), 'min': min(times)}
+
+    return {
+        'panel': list(panel),
+        'pattern': pattern,
+        'region': list(region),
+        'box': list(box),
+        'pixels': dims[0] * dims[1],
+        'words': int(np.size(words)),
+        'stages': stages,
+    }
+
+
+def bench_full(display, repeat):
+    """
+    Time AutoEPDDisplay.draw_full
+    """
+    stage, _ = timed(lambda: display.draw_full(DisplayModes.GC16), repeat)
+    return {
+        'panel': [display.width, display.height],
+        'pattern': 'draw_full',
+        'region': [display.width, display.height],
+        'pixels': display.width * display.height,
+        'stages': {'draw_full': stage},
+    }
+
+
+def bench_transfer(display, repeat):
+    """
+    Time sending a full frame with LD_IMG_AREA in 4bpp and 8bpp, and with burst writes
+    of the 8bpp pixels, and reading it back with burst reads
+    """
+    epd = display.epd
+    frame = display._get_frame_region((0, 0, display.width, display.height))
+    stages = {}
+    for name in ('M_4BPP', 'M_8BPP'):
+        stages['ld_img_area_' + name], _ = timed(
+            lambda: epd.load_img_area(frame, xy=(0, 0), dims=(epd.width, epd.height),
+                                      pixel_format=getattr(PixelModes, name)), repeat)
+    stages['mem_burst_write'], _ = timed(lambda: epd.write_image(frame), repeat)
+    stages['mem_burst_read'], _ = timed(lambda: epd.read_image(), repeat)
+    return {
+        'panel': [display.width, display.height],
+        'pattern': 'frame_transfer',
+        'region': [display.width, display.height],
+        'pixels': display.width * display.height,
+        'stages': stages,
+    }
+
+
+def run(panels=PANELS, regions=REGIONS, patterns=PATTERNS, repeat=5, time_scale=0.0):
+    """
+    Run the benchmark sweep and return the results as dict
+    """
+    results = []
+    for width, height in panels:
+        emulator = IT8951Emulator(width=width, height=height, time_scale=time_scale)
+        display = AutoEPDDisplay(epd=emulator.epd())
+        results.append(bench_full(display, repeat))
+        results.append(bench_transfer(display, repeat))
+        for pattern in patterns:
+            for region in (regions if pattern != 'full' else [(width, height)]):
+                logging.info('panel %dx%d, %s %dx%d', width, height, pattern, *region)
+                results.append(bench_case(display, pattern, region, repeat))
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'time_scale': time_scale,
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=1.2):
+    """
+    Return a list of (case, stage, old ms, new ms) for stages that got slower by more than threshold
+    """
+    def key(result):
+        return (tuple(result['panel']), result['pattern'], tuple(result['region']))
+
+    baseline = {key(result): result for result in old['results']}
+    regressions = []
+    for result in new['results']:
+        before = baseline.get(key(result))
+        if before is None:
+            continue
+        for stage, times in result['stages'].items():
+            if stage not in before['stages']:
+                continue
+            old_ms = before['stages'][stage]['median']
+            if old_ms > 0 and times['median'] / old_ms > threshold:
+                regressions.append((key(result), stage, old_ms, times['median']))
+    return regressions
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m IT8951.benchmark', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--panels', nargs='+', type=parse_size, default=PANELS, metavar='WxH')
+    parser.add_argument('--regions', nargs='+', type=parse_size, default=REGIONS, metavar='WxH')
+    parser.add_argument('--patterns', nargs='+', choices=PATTERNS, default=PATTERNS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--time-scale', type=float, default=0.0,
+                        help='scale of the emulated refresh durations, 0 skips waiting for the panel')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown factor reported as regression')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+    results = run(args.panels, args.regions, args.patterns, args.repeat, args.time_scale)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for case, stage, old_ms, new_ms in regressions:
+            logging.warning('%s %s: %.3f ms -> %.3f ms', case, stage, old_ms, new_ms)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -42,6 +42,12 @@ class PixelModes:
     M_4BPP = 2
     M_8BPP = 3
 
+    # not controller modes:
+    # one bit per pixel, transferred as 8bpp and shown through the BGVR color table
+    M_1BPP = -2
+    # use the smallest mode that keeps all gray levels of the image
+    AUTO = -1
+
 
 # these waveform modes are described here:
 # http://www.waveshare.net/w/upload/c/c4/E-paper-mode-declaration.pdf
@@ -55,6 +61,9 @@ class DisplayModes:
     A2 = 6
     DU4 = 7
 
+    # not a controller mode: AutoDisplay picks a mode per updated area
+    AUTO = -1
+
 
 class EndianTypes:
     LITTLE = 0
@@ -1,6 +1,225 @@
-from PIL import Image, ImageChops
-from .constants import DisplayModes
-from .interface import EPD
+import collections
+import logging
+import queue
+import time
+from concurrent.futures import Future
+from threading import Condition, Event, Lock, RLock, Thread
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from .constants import DisplayModes, PixelModes, Rotate
+from .interface import AUTO_PIXEL_FORMATS, EPD, PIXEL_ALIGNMENT, PIXEL_BITS, rotate_area, run_ops
+
+# display modes from fastest to cleanest, coalesced updates use the cleanest mode requested
+MODE_QUALITY = (DisplayModes.AUTO, DisplayModes.A2, DisplayModes.DU, DisplayModes.DU4, DisplayModes.GLD16,
+                DisplayModes.GLR16, DisplayModes.GL16, DisplayModes.GC16, DisplayModes.INIT)
+
+# ghosting an update in each mode leaves behind on the tiles it refreshes, GC16 and INIT
+# clean the tiles
+GHOSTING = {
+    DisplayModes.A2: 2,
+    DisplayModes.DU: 1,
+    DisplayModes.DU4: 1,
+    DisplayModes.GL16: 1,
+    DisplayModes.GLR16: 1,
+    DisplayModes.GLD16: 1,
+}
+
+
+class TileDiff:
+    """
+    Keeps a shadow copy of the frame on the device as NumPy array, and compares new
+    frames to it tile by tile. Only tiles that changed are written back to the shadow,
+    and the dirty attribute marks them in a (rows, columns) bitmap of tiles.
+    """
+
+    def __init__(self, width, height, tile_size=(32, 32)):
+        self.width = width
+        self.height = height
+        self.tile_width, self.tile_height = tile_size
+        self.shadow = None
+        self.dirty = np.zeros((-(-height // self.tile_height), -(-width // self.tile_width)), dtype=bool)
+
+    def reset(self, frame):
+        """
+        Set the shadow to a copy of frame, e.g. after a full update
+        """
+        self.shadow = np.array(frame, dtype=np.uint8)
+        self.dirty[:] = False
+
+    def compare(self, frame, box):
+        """
+        Compare frame, holding the pixels of box, to the shadow. Marks the tiles that
+        changed as dirty, copies them into the shadow, and returns the mask of changed
+        pixels relative to box.
+        """
+        minx, miny, maxx, maxy = box
+        self.dirty[:] = False
+        changed = frame != self.shadow[miny:maxy, minx:maxx]
+
+        # reduce the mask to the tiles box touches
+        tile_x0, tile_y0 = minx // self.tile_width, miny // self.tile_height
+        col_starts = np.arange(tile_x0 * self.tile_width, maxx, self.tile_width).clip(minx) - minx
+        row_starts = np.arange(tile_y0 * self.tile_height, maxy, self.tile_height).clip(miny) - miny
+        tiles = np.logical_or.reduceat(np.logical_or.reduceat(changed, row_starts, axis=0), col_starts, axis=1)
+        self.dirty[tile_y0:tile_y0 + tiles.shape[0], tile_x0:tile_x0 + tiles.shape[1]] = tiles
+
+        # write back runs of dirty tiles in every row of tiles
+        for row in np.flatnonzero(tiles.any(axis=1)):
+            y0 = row_starts[row]
+            y1 = row_starts[row + 1] if row + 1 < row_starts.size else maxy - miny
+            flags = np.concatenate(([False], tiles[row], [False]))
+            edges = np.flatnonzero(flags[1:] != flags[:-1])
+            for start, end in zip(edges[::2], edges[1::2]):
+                x0 = col_starts[start]
+                x1 = col_starts[end] if end < col_starts.size else maxx - minx
+                self.shadow[miny + y0:miny + y1, minx + x0:minx + x1] = frame[y0:y1, x0:x1]
+
+        return changed
+
+
+class Quantizer:
+    """
+    Reduces gray levels to 2, 4 or 16 evenly spaced levels, so images can be sent as
+    1bpp bitmaps or shown with DU4 instead of GC16. The levels are returned as 8 bit gray
+    values, e.g. 0x00, 0x55, 0xAA and 0xFF for 4 levels, which AutoDisplay picks the
+    smallest fitting pixel format and the fastest display mode for.
+
+    Methods are 'threshold' (nearest level), 'ordered' (8x8 Bayer matrix aligned to
+    the frame, so neighbouring areas join without seams) and 'diffusion'
+    (Floyd-Steinberg error diffusion).
+
+    When quantize() is given the frame size, results are cached in tiles of tile_size
+    pixels. Only tiles whose pixels changed since they were quantized are computed
+    again, so unchanged tiles keep their pattern. hits and misses count the tiles
+    taken from the cache and the ones that were computed.
+    """
+
+    METHODS = ('threshold', 'ordered', 'diffusion')
+
+    def __init__(self, levels=16, method='ordered', tile_size=(32, 32)):
+        if levels not in (2, 4, 16):
+            raise ValueError('levels has to be 2, 4 or 16')
+        if method not in self.METHODS:
+            raise ValueError('method has to be one of {}'.format(', '.join(self.METHODS)))
+        self.levels = levels
+        self.method = method
+        self.tile_size = tile_size
+
+        # 8 bit gray value of every level
+        self.grays = np.round(np.arange(levels) * (255 / (levels - 1))).astype(np.uint8)
+
+        # thresholds of ordered dithering between 0 and 1
+        bayer = np.zeros((1, 1))
+        while bayer.shape[0] < 8:
+            bayer = np.block([[4 * bayer, 4 * bayer + 2], [4 * bayer + 3, 4 * bayer + 1]])
+        self.bayer = ((bayer + 0.5) / bayer.size).astype(np.float32)
+
+        # source pixels, results and tiles holding valid results, allocated for the
+        # frame size on first use
+        self._source = None
+        self._result = None
+        self._valid = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, pixels, xy=(0, 0), size=None):
+        """
+        Return the quantized pixels (2D NumPy array of gray levels) of the area with its
+        top left corner at xy of the frame. Without size nothing is cached, otherwise
+        size is the (width, height) of the frame.
+        """
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        if size is None:
+            return self._quantize(pixels, xy)
+
+        x, y = xy
+        h, w = pixels.shape
+        if self._source is None or (self._source.width, self._source.height) != tuple(size):
+            self._source = TileDiff(size[0], size[1], self.tile_size)
+            self._source.reset(np.zeros((size[1], size[0]), dtype=np.uint8))
+            self._result = np.zeros_like(self._source.shadow)
+            self._valid = np.zeros_like(self._source.dirty)
+        source = self._source
+        tw, th = source.tile_width, source.tile_height
+
+        source.compare(pixels, (x, y, x + w, y + h))
+        tx0, ty0 = x // tw, y // th
+        tx1, ty1 = -(-(x + w) // tw), -(-(y + h) // th)
+        stale = source.dirty[ty0:ty1, tx0:tx1] | ~self._valid[ty0:ty1, tx0:tx1]
+        result = self._result[y:y + h, x:x + w]
+        misses = int(np.count_nonzero(stale))
+        self.hits += stale.size - misses
+        self.misses += misses
+        if not misses:
+            return result
+
+        # quantize the box around the stale tiles, and keep the cached tiles
+        mask = np.repeat(np.repeat(stale, th, axis=0), tw, axis=1)
+        mask = mask[y - ty0 * th:y - ty0 * th + h, x - tx0 * tw:x - tx0 * tw + w]
+        rows = np.flatnonzero(stale.any(axis=1))
+        cols = np.flatnonzero(stale.any(axis=0))
+        r0, r1 = max((ty0 + rows[0]) * th - y, 0), min((ty0 + rows[-1] + 1) * th - y, h)
+        c0, c1 = max((tx0 + cols[0]) * tw - x, 0), min((tx0 + cols[-1] + 1) * tw - x, w)
+        np.copyto(result[r0:r1, c0:c1], self._quantize(pixels[r0:r1, c0:c1], (x + c0, y + r0)),
+                  where=mask[r0:r1, c0:c1])
+
+        # only tiles inside the area were quantized completely
+        inside_x = (np.arange(tx0, tx1) * tw >= x) & (np.minimum(np.arange(tx0 + 1, tx1 + 1) * tw, size[0]) <= x + w)
+        inside_y = (np.arange(ty0, ty1) * th >= y) & (np.minimum(np.arange(ty0 + 1, ty1 + 1) * th, size[1]) <= y + h)
+        self._valid[ty0:ty1, tx0:tx1] = inside_y[:, None] & inside_x[None, :]
+        return result
+
+    def _quantize(self, pixels, xy):
+        """
+        Quantize pixels without cache
+        """
+        if self.method == 'diffusion':
+            return self._diffuse(pixels)
+
+        scaled = pixels * np.float32((self.levels - 1) / 255)
+        if self.method == 'ordered':
+            h, w = pixels.shape
+            rows = (np.arange(h) + xy[1]) % self.bayer.shape[0]
+            cols = (np.arange(w) + xy[0]) % self.bayer.shape[1]
+            scaled += self.bayer[rows[:, None], cols[None, :]]
+        else:
+            scaled += np.float32(0.5)
+        levels = scaled.astype(np.intp)
+        np.minimum(levels, self.levels - 1, out=levels)
+        return self.grays[levels]
+
+    def _diffuse(self, pixels):
+        """
+        Floyd-Steinberg error diffusion. A pixel only depends on the pixels left of it and
+        on the row above up to one pixel to the right, so all pixels on a line
+        x + 2 * y = t are independent and processed as one vector.
+        """
+        h, w = pixels.shape
+        step = 255 / (self.levels - 1)
+        # one column of padding on both sides and one row below take the error
+        # diffused out of the area
+        stride = w + 2
+        work = np.zeros((h + 1, stride), dtype=np.float32)
+        work[:h, 1:w + 1] = pixels
+        work = work.ravel()
+        levels = np.zeros(work.size, dtype=np.intp)
+        # index of the first pixel of every row in the flat arrays
+        starts = np.arange(h) * stride + 1
+        for t in range(w + 2 * (h - 1)):
+            y0, y1 = max(0, (t - w) // 2 + 1), min(h - 1, t // 2) + 1
+            i = starts[y0:y1] + (t - 2 * np.arange(y0, y1))
+            old = work[i]
+            level = np.rint(old / step)
+            np.clip(level, 0, self.levels - 1, out=level)
+            levels[i] = level
+            error = old - level * step
+            work[i + 1] += error * (7 / 16)
+            work[i + stride - 1] += error * (3 / 16)
+            work[i + stride] += error * (5 / 16)
+            work[i + stride + 1] += error * (1 / 16)
+        return self.grays[levels.reshape(h + 1, stride)[:h, 1:w + 1]]
 
 
 class AutoDisplay:
@@ -10,19 +229,72 @@ class AutoDisplay:
 
     Updates are done by calling the update() method, which derived classes should
     implement.
+
+    Changes are split into several regions if updating them separately is cheaper
+    than updating their bounding box. region_cost is the fixed cost of one more
+    region (the commands to load and display it) in transferred pixels, max_regions
+    limits the number of regions per update.
+
+    Changes are found by comparing frame_buf tile by tile (tile_size pixels) to a
+    shadow copy of what was sent to the device, see TileDiff.
+
+    rotate (constants.Rotate) is the orientation of frame_buf on the panel, flip=True
+    is the same as Rotate.FLIP. width and height are the size of the panel, with
+    Rotate.CW or Rotate.CCW frame_buf and the width and height attributes are portrait
+    sized instead. frame_buf is never rotated, changes are found in frame_buf
+    coordinates and the controller rotates the pixels while loading them, so update()
+    receives areas in frame_buf coordinates, see _device_area().
+
+    dither is a Quantizer applied to every update, it can be overridden per update
+    with the dither argument of draw_full and draw_partial. Areas that need another
+    quantization are added to dither_regions as (box, Quantizer) tuples, they take
+    precedence over the dither attribute but not over the dither argument.
+
+    With DisplayModes.AUTO every updated area is shown with the fastest mode that suits
+    its content: A2 for black and white on black and white, DU for other black and white
+    content, DU4 for four gray levels, GL16 or GLR16 for gray on white and GC16 for
+    everything else. Every tile counts the ghosting (see GHOSTING) of the updates since
+    it was last cleaned by GC16 or INIT. Once that reaches ghost_budget, the next update
+    with DisplayModes.AUTO cleans the tile with GC16, also when nothing changed, so it
+    can be called when idle. track_gray is not needed with DisplayModes.AUTO.
     """
 
-    def __init__(self, width, height, flip=False, track_gray=False):
+    def __init__(self, width, height, flip=False, track_gray=False, pixel_format=PixelModes.AUTO,
+                 region_cost=4096, max_regions=8, tile_size=(32, 32), rotate=None, dither=None,
+                 ghost_budget=8):
+        if rotate is None:
+            rotate = Rotate.FLIP if flip else Rotate.NONE
+        self.rotate = rotate
+        self.flip = rotate == Rotate.FLIP
+
+        self.device_width = width
+        self.device_height = height
+        if rotate in (Rotate.CW, Rotate.CCW):
+            width, height = height, width
         self.width = width
         self.height = height
-        self.flip = flip
+
+        # format the pixels are transferred in, PixelModes.AUTO picks one per update
+        self.pixel_format = pixel_format
+
+        self.region_cost = region_cost
+        self.max_regions = max_regions
+
+        self.dither = dither
+        self.dither_regions = []
 
         self.frame_buf = Image.new('L', (width, height), 0xFF)
 
         # keep track of what we have updated,
         # so that we can automatically do partial updates of only the
         # relevant portions of the display
-        self.prev_frame = None
+        self.diff = TileDiff(width, height, tile_size)
+
+        # ghosting of every tile since it was last cleaned, and the tiles showing only
+        # black and white
+        self.ghost_budget = ghost_budget
+        self.ghosting = np.zeros(self.diff.dirty.shape, dtype=np.int32)
+        self.binary_tiles = np.zeros(self.diff.dirty.shape, dtype=bool)
 
         self.track_gray = track_gray
         if track_gray:
@@ -33,65 +305,256 @@ class AutoDisplay:
 
     def _get_frame_buf(self):
         """
-        Return the frame buf, rotated according to flip
+        Return the frame buf
         """
-        if self.flip:
-            return self.frame_buf.rotate(180)
-        else:
-            return self.frame_buf
+        return self.frame_buf
 
-    def draw_full(self, mode):
+    def _get_frame_region(self, box):
         """
-        Write the full image to the device, and display it using mode
+        Return the pixels of box (in frame_buf coordinates) as NumPy array
         """
+        if box == (0, 0, self.width, self.height):
+            return np.asarray(self.frame_buf)
+        return np.asarray(self.frame_buf.crop(box))
 
-        self.update(self._get_frame_buf().getdata(), (0, 0), (self.width, self.height), mode)
+    def _device_area(self, xy, dims):
+        """
+        Return the top left corner and size on the panel of the area at xy with size dims
+        in frame_buf coordinates
+        """
+        xy, turns = rotate_area(self.rotate, xy, dims, self.device_width, self.device_height)
+        if turns % 2:
+            dims = (dims[1], dims[0])
+        return xy, dims
+
+    @property
+    def prev_frame(self):
+        """
+        The frame last sent to the device as NumPy array in frame_buf coordinates,
+        None before the first update
+        """
+        return self.diff.shadow
+
+    def draw_full(self, mode, pixel_format=None, dither=None):
+        """
+        Write the full image to the device, and display it using mode. pixel_format
+        overrides the pixel_format attribute for this update, dither (a Quantizer)
+        the dither attribute and dither_regions.
+        """
+
+        for update in self._full_updates(mode, pixel_format, dither):
+            self.update(*update)
+
+    def _full_updates(self, mode, pixel_format=None, dither=None):
+        """
+        Take the whole frame into the shadow frame and return the arguments of the
+        update call that sends it
+        """
+        if pixel_format is None:
+            pixel_format = self.pixel_format
+
+        box = (0, 0, self.width, self.height)
+        frame = self._get_frame_region(box)
 
         if self.track_gray:
-            if mode == DisplayModes.DU:
-                diff_box = self._compute_diff_box(self.prev_frame, self._get_frame_buf(), round_to=4)
+            if mode == DisplayModes.DU and self.diff.shadow is not None:
+                diff_box = self._compute_diff_box(self.diff.shadow, frame, round_to=4)
                 self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
             else:
                 self.gray_change_bbox = None
 
-        self.prev_frame = self._get_frame_buf().copy()
+        self.diff.reset(frame)
+        buf = self._quantize(self.diff.shadow, box, dither)
+        if mode == DisplayModes.AUTO:
+            mode = self._auto_mode(box, buf)
+        updates = [(buf, (0, 0), (self.width, self.height), mode, pixel_format)]
+        self._count_ghosting(updates)
+        return updates
+
+    def draw_partial(self, mode, pixel_format=None, damage=None, dither=None):
+        """
+        Write only the rectangles covering the pixels of the image that have changed
+        since the last call to draw_full or draw_partial. pixel_format overrides the
+        pixel_format attribute for this update, dither (a Quantizer) the dither
+        attribute and dither_regions.
+
+        damage is an optional list of boxes in frame_buf coordinates that contain all
+        changes. Only these are compared, so the update costs depend on their size
+        instead of the panel size.
+        """
+        for update in self._partial_updates(mode, pixel_format, damage, dither):
+            self.update(*update)
 
-    def draw_partial(self, mode):
+    def _partial_updates(self, mode, pixel_format=None, damage=None, dither=None):
         """
-        Write only the rectangle bounding the pixels of the image that have changed
-        since the last call to draw_full or draw_partial
+        Take the changes of the frame into the shadow frame and return the arguments
+        of the update calls that send them
         """
+        if pixel_format is None:
+            pixel_format = self.pixel_format
 
-        if self.prev_frame is None:  # first call since initialization
-            self.draw_full(mode)
+        if self.diff.shadow is None:  # first call since initialization
+            return self._full_updates(mode, pixel_format, dither)
 
-        # compute diff for this frame
-        # TODO: should not have round_to in this class
-        diff_box = self._compute_diff_box(self.prev_frame, self._get_frame_buf(), round_to=4)
+        # compute diff for this frame, the boxes are aligned once the pixel format is known
+        diff_boxes = self._compute_diff_boxes(damage)
+
+        if mode == DisplayModes.AUTO:
+            return self._auto_updates(diff_boxes, pixel_format, dither)
 
         if self.track_gray:
-            self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
+            for diff_box in diff_boxes:
+                self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
             # reset grayscale changes to zero
             if mode != DisplayModes.DU:
-                diff_box = self._round_bbox(self.gray_change_bbox, round_to=4)
+                diff_boxes = [self.gray_change_bbox] if self.gray_change_bbox is not None else []
                 self.gray_change_bbox = None
 
-        self.prev_frame = self._get_frame_buf().copy()
+        # nothing to do if diff_boxes is empty
+        updates = [self._box_update(diff_box, mode, pixel_format, dither) for diff_box in diff_boxes]
+        self._count_ghosting(updates)
+        return updates
+
+    def _auto_updates(self, diff_boxes, pixel_format, dither):
+        """
+        Return the updates of diff_boxes in the modes picked by _auto_mode, followed by
+        GC16 updates cleaning the tiles that used up their ghosting budget before
+        """
+        due = self.ghosting >= self.ghost_budget
+        updates = []
+        for diff_box in diff_boxes:
+            update = self._box_update(diff_box, DisplayModes.AUTO, pixel_format, dither)
+            self._count_ghosting([update])
+            updates.append(update)
+
+        # tiles still due after the updates
+        due &= self.ghosting >= self.ghost_budget
+        if due.any():
+            tw, th = self.diff.tile_width, self.diff.tile_height
+            boxes = []
+            for minx, miny, maxx, maxy in self._split_box(due, self.region_cost // (tw * th)):
+                boxes.append((minx * tw, miny * th, min(maxx * tw, self.width), min(maxy * th, self.height)))
+            cleanups = [self._box_update(box, DisplayModes.GC16, pixel_format, dither)
+                        for box in self._merge_boxes(boxes, self.max_regions)]
+            self._count_ghosting(cleanups)
+            updates += cleanups
+        return updates
 
-        # nothing to do
-        if diff_box is None:
-            return
+    def _auto_mode(self, box, buf):
+        """
+        Return the fastest display mode that shows buf, the pixels sent for box after
+        quantizing, well, or GC16 if a tile of box used up its ghosting budget
+        """
+        tiles = self._tiles(box)
+        if self.ghosting[tiles].max() >= self.ghost_budget:
+            return DisplayModes.GC16
 
-        buf = self._get_frame_buf().crop(diff_box)
+        nibbles = buf >> 4
+        if not np.any((nibbles != 0x0) & (nibbles != 0xF)):
+            return DisplayModes.A2 if self.binary_tiles[tiles].all() else DisplayModes.DU
+        if not np.any(nibbles % 5):
+            return DisplayModes.DU4
 
-        # flatten to black or white
-        if mode == DisplayModes.DU:
-            buf = buf.point(lambda x: 0x00 if x < 0xB0 else 0xFF)
+        # gray on a mostly white background
+        tw, th = self.diff.tile_width, self.diff.tile_height
+        rows, cols = tiles
+        background = self.diff.shadow[rows.start * th:rows.stop * th, cols.start * tw:cols.stop * tw]
+        if 2 * np.count_nonzero(background >= 0xF0) >= background.size:
+            return DisplayModes.GLR16 if self.ghosting[tiles].any() else DisplayModes.GL16
+        return DisplayModes.GC16
 
-        xy = (diff_box[0], diff_box[1])
-        dims = (diff_box[2]-diff_box[0], diff_box[3]-diff_box[1])
+    def _count_ghosting(self, updates):
+        """
+        Add the ghosting of updates to the tiles they refresh, and record which of
+        these tiles show only black and white afterwards
+        """
+        tw, th = self.diff.tile_width, self.diff.tile_height
+        for _, xy, dims, mode, _ in updates:
+            tiles = self._tiles((xy[0], xy[1], xy[0] + dims[0], xy[1] + dims[1]))
+            if mode in GHOSTING:
+                self.ghosting[tiles] += GHOSTING[mode]
+            else:
+                self.ghosting[tiles] = 0
 
-        self.update(buf.getdata(), xy, dims, mode)
+            rows, cols = tiles
+            nibbles = self.diff.shadow[rows.start * th:rows.stop * th, cols.start * tw:cols.stop * tw] >> 4
+            gray = (nibbles != 0x0) & (nibbles != 0xF)
+            gray = np.logical_or.reduceat(gray, np.arange(0, gray.shape[0], th), axis=0)
+            gray = np.logical_or.reduceat(gray, np.arange(0, gray.shape[1], tw), axis=1)
+            self.binary_tiles[tiles] = ~gray
+
+    def _tiles(self, box):
+        """
+        Return the slices of the tiles box touches
+        """
+        tw, th = self.diff.tile_width, self.diff.tile_height
+        return slice(box[1] // th, -(-box[3] // th)), slice(box[0] // tw, -(-box[2] // tw))
+
+    def _box_update(self, box, mode, pixel_format, dither=None):
+        """
+        Align box to the pixel format and return the update arguments for the pixels inside. With
+        PixelModes.AUTO the pixel format is used that transfers the fewest bytes and
+        can represent the pixels. DisplayModes.AUTO picks the mode for the quantized pixels.
+        """
+        if pixel_format == PixelModes.AUTO:
+            candidates = list(AUTO_PIXEL_FORMATS)
+            if self.rotate != Rotate.NONE:
+                # bitmaps cannot be rotated by the controller
+                candidates.remove(PixelModes.M_1BPP)
+        else:
+            candidates = [pixel_format]
+
+        best = None
+        for candidate in candidates:
+            aligned = self._round_bbox(box, round_to=PIXEL_ALIGNMENT[candidate], round_y_to=4)
+            aligned = (aligned[0], aligned[1], min(aligned[2], self.width), min(aligned[3], self.height))
+            if (aligned[2]-aligned[0]) % PIXEL_ALIGNMENT[candidate] and candidate != candidates[-1]:
+                # clipped at the right edge of the panel
+                continue
+            size = (aligned[2]-aligned[0]) * (aligned[3]-aligned[1]) * PIXEL_BITS[candidate]
+            if best is not None and size >= best[0]:
+                continue
+
+            # the shadow holds the current frame everywhere changes were found
+            buf = self._quantize(self.diff.shadow[aligned[1]:aligned[3], aligned[0]:aligned[2]], aligned, dither)
+            aligned_mode = self._auto_mode(aligned, buf) if mode == DisplayModes.AUTO else mode
+
+            # flatten to black or white
+            if aligned_mode == DisplayModes.DU:
+                buf = np.where(buf < 0xB0, 0x00, 0xFF).astype(np.uint8)
+
+            if candidate == candidates[-1] or EPD.fits_pixel_format(buf, candidate):
+                best = (size, candidate, aligned, buf, aligned_mode)
+
+        _, pixel_format, aligned, buf, mode = best
+        xy = (aligned[0], aligned[1])
+        dims = (aligned[2]-aligned[0], aligned[3]-aligned[1])
+
+        return buf, xy, dims, mode, pixel_format
+
+    def _quantize(self, buf, box, dither=None):
+        """
+        Return buf, the pixels of box in the shadow frame, quantized by dither or else by
+        the dither attribute and the dither_regions box overlaps
+        """
+        size = (self.width, self.height)
+        if dither is not None:
+            return dither.quantize(buf, box[:2], size)
+        if self.dither is not None:
+            buf = self.dither.quantize(buf, box[:2], size)
+        copied = False
+        for region, quantizer in self.dither_regions:
+            minx, miny = max(box[0], region[0]), max(box[1], region[1])
+            maxx, maxy = min(box[2], region[2], self.width), min(box[3], region[3], self.height)
+            if minx >= maxx or miny >= maxy:
+                continue
+            if not copied:
+                # buf is a view of the shadow or of a quantizer cache
+                buf = np.array(buf)
+                copied = True
+            buf[miny - box[1]:maxy - box[1], minx - box[0]:maxx - box[0]] = quantizer.quantize(
+                self.diff.shadow[miny:maxy, minx:maxx], (minx, miny), size)
+        return buf
 
     def clear(self):
         """
@@ -122,30 +585,152 @@ class AutoDisplay:
         Parameters
         ----------
 
-        a : PIL.Image
+        a : PIL.Image or numpy.ndarray
             The first image
 
-        b : PIL.Image
+        b : PIL.Image or numpy.ndarray
             The second image
 
         round_to : int
             The multiple to align the bbox to
         """
-        box = ImageChops.difference(a, b).getbbox()
-        if box is None:
+        changed = np.asarray(a) != np.asarray(b)
+        rows = np.flatnonzero(changed.any(axis=1))
+        if rows.size == 0:
             return None
+        cols = np.flatnonzero(changed.any(axis=0))
+        box = (int(cols[0]), int(rows[0]), int(cols[-1])+1, int(rows[-1])+1)
         return cls._round_bbox(box, round_to)
 
+    def _compute_diff_boxes(self, damage=None):
+        """
+        Find boxes covering the differences between frame_buf and the shadow frame,
+        and copy the changed tiles into the shadow. The bounding box of the differences
+        in every damaged area is split while the cost model says that is cheaper.
+
+        Parameters
+        ----------
+
+        damage : list of boxes, optional
+            Boxes in frame_buf coordinates containing all changes, defaults to the whole frame
+        """
+        if damage is None:
+            regions = [(0, 0, self.width, self.height)]
+        else:
+            regions = []
+            for minx, miny, maxx, maxy in damage:
+                minx, miny = max(minx, 0), max(miny, 0)
+                maxx, maxy = min(maxx, self.width), min(maxy, self.height)
+                if minx < maxx and miny < maxy:
+                    regions.append((minx, miny, maxx, maxy))
+
+        boxes = []
+        for region in regions:
+            changed = self.diff.compare(self._get_frame_region(region), region)
+            for minx, miny, maxx, maxy in self._split_box(changed, self.region_cost):
+                boxes.append((minx+region[0], miny+region[1], maxx+region[0], maxy+region[1]))
+        return self._merge_boxes(boxes, self.max_regions)
+
+    @classmethod
+    def _split_box(cls, mask, region_cost):
+        """
+        Return boxes (relative to mask) covering the True pixels of mask. The box around
+        them is cut along the widest gap of unchanged rows or columns as long as the
+        pixels of the parts plus region_cost per part are less than the pixels of the box.
+        """
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            return []
+        minx, miny, maxx, maxy = cols[0], rows[0], cols[-1]+1, rows[-1]+1
+        mask = mask[miny:maxy, minx:maxx]
+        cost = mask.size + region_cost
+
+        best = None
+        for axis, used in ((0, rows - miny), (1, cols - minx)):
+            gaps = np.diff(used)
+            if gaps.size == 0:
+                continue
+            i = np.argmax(gaps)
+            if gaps[i] <= 1:
+                continue
+            if axis == 0:
+                parts = [mask[:used[i]+1], mask[used[i+1]:]]
+            else:
+                parts = [mask[:, :used[i]+1], mask[:, used[i+1]:]]
+            # the parts get at least trimmed to their bounding boxes
+            split_cost = sum(cls._bbox_size(part) + region_cost for part in parts)
+            if split_cost < cost and (best is None or split_cost < best[0]):
+                offsets = [(0, 0), (0, used[i+1]) if axis == 0 else (used[i+1], 0)]
+                best = (split_cost, parts, offsets)
+
+        if best is None:
+            return [(minx, miny, maxx, maxy)]
+
+        boxes = []
+        for part, (dx, dy) in zip(best[1], best[2]):
+            for box in cls._split_box(part, region_cost):
+                boxes.append((box[0]+minx+dx, box[1]+miny+dy, box[2]+minx+dx, box[3]+miny+dy))
+        return boxes
+
+    @staticmethod
+    def _bbox_size(mask):
+        """
+        Return the number of pixels in the bounding box of the True pixels of mask
+        """
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            return 0
+        return (rows[-1]+1 - rows[0]) * (cols[-1]+1 - cols[0])
+
+    @classmethod
+    def _merge_boxes(cls, boxes, max_boxes):
+        """
+        Merge boxes that overlap once aligned, and then the pairs growing least
+        by merging until there are at most max_boxes left
+        """
+        boxes = list(boxes)
+        while len(boxes) > 1:
+            best = None
+            for i in range(len(boxes)):
+                for j in range(i+1, len(boxes)):
+                    merged = cls._merge_bbox(boxes[i], boxes[j])
+                    growth = cls._box_size(merged) - cls._box_size(boxes[i]) - cls._box_size(boxes[j])
+                    overlap = cls._intersect(cls._round_bbox(boxes[i]), cls._round_bbox(boxes[j]))
+                    if overlap or len(boxes) > max_boxes:
+                        if best is None or (overlap, -growth) > (best[0], -best[1]):
+                            best = (overlap, growth, i, j, merged)
+            if best is None:
+                break
+            _, _, i, j, merged = best
+            boxes = [box for k, box in enumerate(boxes) if k not in (i, j)] + [merged]
+        return boxes
+
     @staticmethod
-    def _round_bbox(box, round_to=4):
+    def _box_size(box):
+        return (box[2]-box[0]) * (box[3]-box[1])
+
+    @staticmethod
+    def _intersect(a, b):
         """
-        Round a bounding box so the edges are divisible by round_to
+        Check whether bounding boxes a and b overlap
         """
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    @staticmethod
+    def _round_bbox(box, round_to=4, round_y_to=None):
+        """
+        Round a bounding box so the edges are divisible by round_to, or the
+        top and bottom edges by round_y_to if it is given
+        """
+        if round_y_to is None:
+            round_y_to = round_to
         minx, miny, maxx, maxy = box
         minx -= minx%round_to
         maxx += round_to-1 - (maxx-1)%round_to
-        miny -= miny%round_to
-        maxy += round_to-1 - (maxy-1)%round_to
+        miny -= miny%round_y_to
+        maxy += round_y_to-1 - (maxy-1)%round_y_to
         return (minx, miny, maxx, maxy)
 
     @staticmethod
@@ -165,36 +750,596 @@ class AutoDisplay:
         maxy = max(a[3], b[3])
         return minx, miny, maxx, maxy
 
-    def update(self, data, xy, dims, mode):
+    def update(self, data, xy, dims, mode, pixel_format=PixelModes.M_4BPP):
         raise NotImplementedError
 
 
 class AutoEPDDisplay(AutoDisplay):
     """
-    This class initializes the EPD, and uses it to display the updates
+    This class initializes the EPD, and uses it to display the updates. cache is passed
+    to EPD if no epd is given.
+
+    Screens that are shown again and again can be stored in named slots, frames in
+    device memory next to the image buffer, with store_slot(). show_slot() then shows
+    a slot without transferring pixels. frame_buf and the shadow frame are set to the
+    slot, so later partial updates only send what differs from it.
     """
 
-    def __init__(self, epd=None, vcom=-1.50, **kwargs):
+    def __init__(self, epd=None, vcom=-1.50, cache=None, **kwargs):
 
         if epd is None:
-            epd = EPD(vcom=vcom)
+            epd = EPD(vcom=vcom, cache=cache)
         self.epd = epd
         AutoDisplay.__init__(self, self.epd.width, self.epd.height, **kwargs)
 
-    def update(self, data, xy, dims, mode):
-        # send image to controller
-        self.epd.wait_display_ready()
+        # areas displayed since the display was last known to be ready
+        self.refreshing = []
+        self.refreshing_bitmap = False
+
+        # name: (offset in device memory, pixels) of the stored slots, and the name of
+        # the slot the panel shows unchanged
+        self.slots = {}
+        self.current_slot = None
+
+    def update(self, data, xy, dims, mode, pixel_format=PixelModes.M_4BPP):
+        run_ops(self._update_ops(data, xy, dims, mode, pixel_format), self.epd)
+
+    def _update_ops(self, data, xy, dims, mode, pixel_format):
+        """
+        The steps of update, see IT8951.interface.run_ops
+        """
+        if pixel_format == PixelModes.M_1BPP and not (yield from self._bitmap_allowed_ops()):
+            # a bitmap would wait for the running refreshes, 4bpp is loaded while they run
+            pixel_format = PixelModes.M_4BPP
+
+        # the area on the panel, the controller rotates the pixels while loading them
+        device_xy, device_dims = self._device_area(xy, dims)
+
+        # send image to controller, waiting for refreshes that are still running only if
+        # they could be disturbed
+        footprint = self._footprint(device_xy, device_dims, pixel_format)
+        if self._must_wait(footprint, pixel_format):
+            yield from self._wait_display_ready_ops()
+
         # highly depends on the amount of data to be transfered. about 3ns per byte
-        self.epd.load_img_area(
-            data,
-            xy=xy,
-            dims=dims
-        )
+        pixel_format = yield 'load_img_area', data, self.rotate, xy, dims, pixel_format
 
         # display sent image
         # takes 480-482ms (very constant for GC16)
-        self.epd.display_area(
-            xy,
-            dims,
-            mode
-        )
+        yield 'display_area', device_xy, device_dims, mode
+        self._refresh_started(footprint, pixel_format)
+
+    def store_slot(self, name, image=None, pixel_format=None):
+        """
+        Load image (PIL image or NumPy array of the size of frame_buf, defaults to
+        frame_buf) into the slot called name. A new name takes the next free frame in
+        device memory, an existing one is overwritten, and ValueError is raised if no frame
+        is left. pixel_format defaults to the pixel_format attribute, slots are never loaded
+        as 1bpp bitmap.
+        """
+        pixels, offset, pixel_format = self._slot_store(name, image, pixel_format)
+        self._load_slot(pixels, offset, pixel_format)
+
+    def show_slot(self, name, mode=DisplayModes.GC16):
+        """
+        Display the slot called name on the whole panel using mode, and take its pixels
+        into frame_buf
+        """
+        offset, mode = self._slot_show(name, mode)
+        self._display_slot(offset, mode)
+
+    def wait_display_ready(self):
+        """
+        Block until the panel has finished all refreshes
+        """
+        run_ops(self._wait_display_ready_ops(), self.epd)
+
+    def _wait_display_ready_ops(self):
+        yield 'wait_display_ready',
+        self._refreshes_done()
+
+    def _slot_store(self, name, image, pixel_format):
+        """
+        Record the pixels of a slot, and return them with the offset and pixel format to load them with
+        """
+        if image is None:
+            image = self.frame_buf
+        pixels = np.array(image, dtype=np.uint8)
+        if pixels.shape != (self.height, self.width):
+            raise ValueError('slot images have to be the size of frame_buf')
+        if name in self.slots:
+            offset = self.slots[name][0]
+        elif len(self.slots) + 1 < self.epd.frame_count:
+            offset = self.epd.frame_offset(len(self.slots) + 1)
+        else:
+            raise ValueError('device memory holds {:d} slots, none is left for {!r}'.format(
+                self.epd.frame_count - 1, name))
+        self.slots[name] = (offset, pixels)
+        if self.current_slot == name:
+            self.current_slot = None
+        return pixels, offset, pixel_format if pixel_format is not None else self.pixel_format
+
+    def _load_slot(self, pixels, offset, pixel_format):
+        run_ops(self._load_slot_ops(pixels, offset, pixel_format), self.epd)
+
+    def _load_slot_ops(self, pixels, offset, pixel_format):
+        # the slot could be on the panel right now
+        if self.refreshing:
+            yield from self._wait_display_ready_ops()
+        yield 'load_img_area', pixels, self.rotate, (0, 0), (self.width, self.height), pixel_format, offset
+
+    def _slot_show(self, name, mode):
+        """
+        Take the pixels of a slot into frame_buf and the shadow frame, and return its offset
+        and the display mode to show it with
+        """
+        offset, pixels = self.slots[name]
+        box = (0, 0, self.width, self.height)
+        self.frame_buf.paste(Image.fromarray(pixels))
+        if self.track_gray:
+            self.gray_change_bbox = box if mode == DisplayModes.DU else None
+        self.diff.reset(pixels)
+        if mode == DisplayModes.AUTO:
+            mode = self._auto_mode(box, pixels)
+        self._count_ghosting([(None, (0, 0), (self.width, self.height), mode, None)])
+        self.current_slot = name
+        return offset, mode
+
+    def _display_slot(self, offset, mode):
+        run_ops(self._display_slot_ops(offset, mode), self.epd)
+
+    def _display_slot_ops(self, offset, mode):
+        footprint = [(0, 0, self.device_width, self.device_height)]
+        if self.refreshing:
+            yield from self._wait_display_ready_ops()
+        yield 'display_buf_area', (0, 0), (self.device_width, self.device_height), mode, offset
+        self._refresh_started(footprint, PixelModes.M_4BPP)
+
+    def _partial_updates(self, mode, pixel_format=None, damage=None, dither=None):
+        updates = AutoDisplay._partial_updates(self, mode, pixel_format, damage, dither)
+        if updates:
+            self.current_slot = None
+        if len(updates) > 1:
+            # a bitmap switches the whole display engine to 1bpp, so the areas after it would
+            # wait for its refresh, while 4bpp areas are loaded during the refreshes before them
+            updates = [(data, xy, dims, mode, PixelModes.M_4BPP if fmt == PixelModes.M_1BPP else fmt)
+                       for data, xy, dims, mode, fmt in updates]
+        return updates
+
+    def _full_updates(self, mode, pixel_format=None, dither=None):
+        self.current_slot = None
+        return AutoDisplay._full_updates(self, mode, pixel_format, dither)
+
+    @staticmethod
+    def _footprint(xy, dims, pixel_format):
+        """
+        Return the boxes of device memory an update of the area at xy with size dims writes to
+        """
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+        footprint = [box]
+        if pixel_format in (PixelModes.M_1BPP, PixelModes.AUTO):
+            # the bitmap bytes are stored at columns x / 8 to (x + width) / 8 of the same rows,
+            # which need not lie inside the area
+            footprint.append((box[0]//8, box[1], box[2]//8, box[3]))
+        return footprint
+
+    def _bitmap_allowed_ops(self):
+        """
+        Check whether an update can be sent as bitmap, which is only the case while no
+        refresh is running. The controller is polled once the running refreshes are
+        predicted to be done.
+        """
+        if not self.refreshing:
+            return True
+        if not (yield 'display_ready',):
+            return False
+        self._refreshes_done()
+        return True
+
+    def _must_wait(self, footprint, pixel_format):
+        """
+        Check whether an update has to wait for the running refreshes. Bitmaps change
+        global display settings, so they are never loaded while a refresh is running.
+        """
+        bitmap = pixel_format in (PixelModes.M_1BPP, PixelModes.AUTO)
+        return bool(self.refreshing) and (bitmap or self.refreshing_bitmap or any(
+            self._intersect(a, b) for a in footprint for b in self.refreshing))
+
+    def _refreshes_done(self):
+        self.refreshing = []
+        self.refreshing_bitmap = False
+
+    def _refresh_started(self, footprint, pixel_format):
+        self.refreshing += footprint
+        self.refreshing_bitmap |= pixel_format == PixelModes.M_1BPP
+
+
+class PipelinedEPDDisplay(AutoEPDDisplay):
+    """
+    An AutoEPDDisplay that hands its updates to a worker thread, so callers never wait
+    for the panel. The worker uploads the next region into controller memory while the
+    panel still refreshes the previous one, unless the regions overlap, and keeps the
+    order of all updates.
+
+    draw_full, draw_partial, clear, store_slot, show_slot, wait_display_ready, activate
+    and sleep return a concurrent.futures.Future that completes once everything they
+    submitted has been sent to the device. The worker owns the EPD, use submit() to run
+    other EPD calls in order with the updates.
+    """
+
+    def __init__(self, epd=None, vcom=-1.50, **kwargs):
+        AutoEPDDisplay.__init__(self, epd, vcom, **kwargs)
+
+        # serializes producers, which share the shadow frame
+        self._lock = RLock()
+        # futures of the updates submitted by the current draw call
+        self._pending = None
+
+        self._queue = queue.Queue()
+        self._worker = Thread(target=self._run, name='IT8951 update worker', daemon=True)
+        self._worker.start()
+
+    def update(self, data, xy, dims, mode, pixel_format=PixelModes.M_4BPP):
+        # copy the pixels, the shadow frame keeps changing while the update waits
+        future = self.submit(AutoEPDDisplay.update, self, np.array(data, dtype=np.uint8),
+                             xy, dims, mode, pixel_format)
+        if self._pending is not None:
+            self._pending.append(future)
+        return future
+
+    def draw_full(self, mode, pixel_format=None, dither=None):
+        return self._collect(AutoEPDDisplay.draw_full, mode, pixel_format, dither)
+
+    def draw_partial(self, mode, pixel_format=None, damage=None, dither=None):
+        return self._collect(AutoEPDDisplay.draw_partial, mode, pixel_format, damage, dither)
+
+    def clear(self):
+        return self._collect(AutoEPDDisplay.clear)
+
+    def store_slot(self, name, image=None, pixel_format=None):
+        with self._lock:
+            args = self._slot_store(name, image, pixel_format)
+        return self.submit(self._load_slot, *args)
+
+    def show_slot(self, name, mode=DisplayModes.GC16):
+        with self._lock:
+            offset, mode = self._slot_show(name, mode)
+        return self.submit(self._display_slot, offset, mode)
+
+    def activate(self):
+        return self.submit(self.epd.active)
+
+    def wait_display_ready(self):
+        return self.submit(AutoEPDDisplay.wait_display_ready, self)
+
+    def _bitmap_allowed_ops(self):
+        # a bitmap would also hold up the updates queued behind it
+        if not self._queue.empty():
+            return False
+        return (yield from AutoEPDDisplay._bitmap_allowed_ops(self))
+
+    def sleep(self):
+        return self.submit(self.epd.sleep)
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) on the worker thread after all updates submitted before,
+        and return a future for its result
+        """
+        future = Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def flush(self):
+        """
+        Block until the worker has sent all submitted updates to the device
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Send the remaining updates and stop the worker thread
+        """
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, func, *args):
+        """
+        Call func and return a future for all updates it submits
+        """
+        with self._lock:
+            outer = self._pending is None
+            if outer:
+                self._pending = []
+            try:
+                func(self, *args)
+            finally:
+                futures = self._pending
+                if outer:
+                    self._pending = None
+        if not outer:
+            return None
+        return self._combine(futures)
+
+    @staticmethod
+    def _combine(futures):
+        """
+        Return a future that completes when all futures have completed, failing
+        with the first exception if any of them failed
+        """
+        combined = Future()
+        if not futures:
+            combined.set_result(None)
+            return combined
+
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                combined.set_exception(errors[0])
+            else:
+                combined.set_result(None)
+
+        for future in futures:
+            future.add_done_callback(done)
+        return combined
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                future, func, args = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    logging.exception('display update failed')
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+
+class UpdateScheduler:
+    """
+    Draws frames submitted by any number of producer threads on an AutoDisplay from a
+    thread of its own, so producers never wait for the device.
+
+    Producers hand over snapshots of the whole frame or of a region with submit(). They
+    are queued without waiting for the worker, and the worker pastes them into the frame_buf of the
+    display, which only the worker touches from then on, before drawing. Everything
+    submitted while the worker is busy, or within 1/max_rate seconds of the previous
+    refresh, is coalesced into one draw_partial showing the latest state. Superseded
+    intermediate states are never drawn.
+
+    Parameters
+    ----------
+
+    display : AutoDisplay
+        The display to draw on
+
+    mode : constants.DisplayModes, optional
+        Display mode of submissions that do not give one
+
+    max_rate : float, optional
+        Maximum number of refreshes per second, None for no limit
+
+    pixel_format : constants.PixelModes, optional
+        Passed to draw_partial, defaults to the pixel format of the display
+    """
+
+    def __init__(self, display, mode=DisplayModes.GC16, max_rate=None, pixel_format=None):
+        self.display = display
+        self.mode = mode
+        self.max_rate = max_rate
+        self.pixel_format = pixel_format
+
+        # statistics
+        self.submitted = 0
+        self.refreshes = 0
+        self.coalesced = 0
+
+        self._pending = collections.deque()
+        self._count_lock = Lock()
+        self._wakeup = Event()
+        self._drawn = Condition()
+        self._done = 0
+        self._closed = False
+        self._last_refresh = None
+
+        self._worker = Thread(target=self._run, name='IT8951 update scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, image, xy=(0, 0), mode=None):
+        """
+        Show image (PIL image or 2D NumPy array of gray levels) with its top left corner
+        at xy of the frame. A copy is queued, so the caller can keep drawing into image.
+        Returns immediately.
+        """
+        if isinstance(image, Image.Image):
+            image = image.copy()
+        else:
+            image = Image.fromarray(np.array(image, dtype=np.uint8))
+        with self._count_lock:
+            self.submitted += 1
+        self._pending.append((image, (int(xy[0]), int(xy[1])), mode if mode is not None else self.mode))
+        self._wakeup.set()
+
+    def flush(self, timeout=None):
+        """
+        Block until everything submitted so far has been drawn. Returns False on timeout.
+        """
+        target = self.submitted
+        with self._drawn:
+            return self._drawn.wait_for(lambda: self._done >= target, timeout)
+
+    def close(self):
+        """
+        Draw what is still pending and stop the worker thread
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # clear before taking the submissions, so no wakeup gets lost
+            self._wakeup.clear()
+            if self.max_rate and self._last_refresh is not None and self._pending:
+                delay = self._last_refresh + 1.0 / self.max_rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            batch = []
+            while self._pending:
+                batch.append(self._pending.popleft())
+            if batch:
+                self._last_refresh = time.monotonic()
+                try:
+                    self._draw(batch)
+                except Exception:
+                    logging.exception('scheduled display update failed')
+                with self._drawn:
+                    self._done += len(batch)
+                    self._drawn.notify_all()
+            # close sets the flag before waking the worker, so it is seen here even if its
+            # wakeup was cleared above
+            if self._closed and not self._pending:
+                return
+
+    def _draw(self, batch):
+        """
+        Paste the latest state of the batch into the frame buffer and draw it
+        """
+        display = self.display
+        full = (display.width, display.height)
+
+        # a snapshot of the whole frame supersedes everything before it
+        start = 0
+        for i, (image, xy, _) in enumerate(batch):
+            if xy == (0, 0) and image.size == full:
+                start = i
+        # and so does a later region at the same place
+        latest = {}
+        for i in range(start, len(batch)):
+            image, xy, _ = batch[i]
+            latest[(xy, image.size)] = i
+
+        damage = []
+        for i in sorted(latest.values()):
+            image, xy, _ = batch[i]
+            display.frame_buf.paste(image, xy)
+            damage.append((xy[0], xy[1], xy[0] + image.size[0], xy[1] + image.size[1]))
+        if any(box == (0, 0) + full for box in damage):
+            damage = None
+
+        mode = max((m for _, _, m in batch), key=MODE_QUALITY.index)
+        self.coalesced += len(batch) - 1
+        self.refreshes += 1
+        display.draw_partial(mode, self.pixel_format, damage)
+
+
+class TextRenderer:
+    """
+    Draws text into the frame_buf of an AutoDisplay from caches, for readouts that change
+    many times per second. Fonts are loaded once per file and size, and every string is
+    rasterized once per font, size, colors and alignment into a strip that is already
+    quantized (by quantizer, default 16 gray levels) and padded with the background to
+    a multiple of 32 pixels wide and 4 pixels high. The max_strips strips used last are
+    kept, hits and misses count the strips taken from the cache and the ones rendered.
+
+    draw() blits a strip and returns the box it changed, which can be passed as damage
+    to draw_partial, so an update needs neither font rendering nor a full frame diff:
+
+        text = TextRenderer(display)
+        box = text.draw((256, 120), '28°', 'fonts/Arial_Black.ttf', 32, align='right')
+        display.draw_partial(DisplayModes.DU, damage=[box])
+
+    Readouts placed at x coordinates that are multiples of 32 are updated without
+    pixels around them.
+    """
+
+    ALIGN = ('left', 'center', 'right')
+
+    def __init__(self, display, quantizer=None, max_strips=256):
+        self.display = display
+        self.quantizer = quantizer if quantizer is not None else Quantizer(16, 'threshold')
+        self.max_strips = max_strips
+
+        self._fonts = {}
+        self._strips = collections.OrderedDict()
+        # box of the last strip drawn at every position, cleared when drawing there again
+        self._placed = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, path, size):
+        """
+        Return the TrueType font at path in size, loading it on first use
+        """
+        key = (path, size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = self._fonts[key] = ImageFont.truetype(path, size)
+        return font
+
+    def render(self, text, font, size, fill=0x00, background=0xFF, align='left'):
+        """
+        Return the strip showing text as PIL image, and the x coordinate in the strip of
+        the point the text is aligned to. font is the path of a TrueType font.
+        """
+        if align not in self.ALIGN:
+            raise ValueError('align has to be one of {}'.format(', '.join(self.ALIGN)))
+        key = (text, font, size, fill, background, align)
+        strip = self._strips.get(key)
+        if strip is not None:
+            self._strips.move_to_end(key)
+            self.hits += 1
+            return strip
+        self.misses += 1
+
+        loaded = self.font(font, size)
+        left, _, right, _ = loaded.getbbox(text)
+        ascent, descent = loaded.getmetrics()
+        width = right - left
+        padded_width = max(-(-width // 32) * 32, 32)
+        padded_height = -(-(ascent + descent) // 4) * 4
+        pad = {'left': 0, 'center': (padded_width - width) // 2, 'right': padded_width - width}[align]
+
+        image = Image.new('L', (padded_width, padded_height), background)
+        ImageDraw.Draw(image).text((pad - left, 0), text, font=loaded, fill=fill)
+        image = Image.fromarray(self.quantizer.quantize(np.asarray(image)))
+        anchor = {'left': pad, 'center': pad + width // 2, 'right': pad + width}[align]
+
+        strip = self._strips[key] = (image, anchor)
+        while len(self._strips) > self.max_strips:
+            self._strips.popitem(last=False)
+        return strip
+
+    def draw(self, xy, text, font, size, fill=0x00, background=0xFF, align='left'):
+        """
+        Draw text into frame_buf, aligned to xy by the top of the line and align. The
+        strip drawn at xy before is cleared with the background. Returns the box of
+        frame_buf that changed.
+        """
+        image, anchor = self.render(text, font, size, fill, background, align)
+        x, y = int(xy[0]) - anchor, int(xy[1])
+        box = (x, y, x + image.size[0], y + image.size[1])
+
+        frame_buf = self.display.frame_buf
+        previous = self._placed.get((xy, align))
+        if previous is not None and previous != box:
+            frame_buf.paste(background, previous)
+            box = AutoDisplay._merge_bbox(previous, box)
+        frame_buf.paste(image, (x, y))
+        self._placed[(xy, align)] = (x, y, x + image.size[0], y + image.size[1])
+        return box
@@ -0,0 +1,553 @@
+"""
+A software model of the IT8951 controller that can replace the SPI bus and the GPIO pins
+of a Raspberry Pi. It allows running the driver without a panel, e.g. for benchmarks or to
+check that the controller memory holds exactly the pixels that were uploaded.
+
+Example
+-------
+
+    emulator = IT8951Emulator(width=800, height=600, time_scale=0.0)
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    assert (emulator.panel == 0xFF).all()
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+import numpy as np
+
+from .constants import Commands, DisplayModes, EndianTypes, Pins, PixelModes, Registers, Rotate
+from .interface import EPD
+from .spi import SPI, SpiIocTransfer, WORD
+
+# number of argument words of each command
+COMMAND_ARGS = {
+    Commands.SYS_RUN: 0,
+    Commands.STANDBY: 0,
+    Commands.SLEEP: 0,
+    Commands.REG_RD: 1,
+    Commands.REG_WR: 2,
+    Commands.MEM_BST_RD_T: 4,
+    Commands.MEM_BST_RD_S: 0,
+    Commands.MEM_BST_WR: 4,
+    Commands.MEM_BST_END: 0,
+    Commands.LD_IMG: 1,
+    Commands.LD_IMG_AREA: 5,
+    Commands.LD_IMG_END: 0,
+    Commands.DPY_AREA: 5,
+    Commands.GET_DEV_INFO: 0,
+    Commands.DPY_BUF_AREA: 7,
+    Commands.VCOM: 1,
+}
+
+# The controller is modelled from the datasheet, independently of the tables and helpers of
+# IT8951.interface, so the tests check the driver against it rather than against itself.
+
+# bits a pixel takes in the packed pixel data of each pixel format of LD_IMG
+PIXEL_FIELD_BITS = {
+    PixelModes.M_2BPP: 2,
+    PixelModes.M_3BPP: 4,
+    PixelModes.M_4BPP: 4,
+    PixelModes.M_8BPP: 8,
+}
+
+# significant bits of a pixel in the packed pixel data, they are stored as the most
+# significant bits of a byte and the lower bits are zero
+PIXEL_MASKS = {
+    PixelModes.M_2BPP: 0x3,
+    PixelModes.M_3BPP: 0xE,
+    PixelModes.M_4BPP: 0xF,
+    PixelModes.M_8BPP: 0xFF,
+}
+
+# UP1SR+2 bit that makes the display engine read image memory as 1bpp bitmap
+UP1SR_BITMAP = 1 << 2
+
+# approximate duration of a display update in seconds
+DISPLAY_TIMES = {
+    DisplayModes.INIT: 2.0,
+    DisplayModes.DU: 0.26,
+    DisplayModes.GC16: 0.48,
+    DisplayModes.GL16: 0.48,
+    DisplayModes.GLR16: 0.48,
+    DisplayModes.GLD16: 0.48,
+    DisplayModes.A2: 0.12,
+    DisplayModes.DU4: 0.29,
+}
+
+
+def encode_string(text):
+    """
+    Encode text as 8 words of two characters each, as returned by GET_DEV_INFO
+    """
+    raw = text.encode('latin-1')[:16].ljust(16, b'\0')
+    return np.frombuffer(raw, dtype=WORD).tolist()
+
+
+class IT8951Emulator:
+    """
+    An in-process emulation of the IT8951 controller, its image memory and the panel.
+
+    Parameters
+    ----------
+
+    width, height : int
+        The panel size
+
+    img_buf_address : int
+        The address of the image buffer reported by GET_DEV_INFO
+
+    memory_frames : int
+        The number of full frames the memory holds beyond img_buf_address
+
+    vcom : float
+        The VCOM voltage the controller starts with
+
+    time_scale : float
+        Factor applied to the durations of display updates. 0.0 makes updates finish immediately.
+
+    hrdy_delay : float
+        Time in seconds the controller keeps HRDY low after each transfer. With 0.0 HRDY
+        rises before the transfer returns.
+
+    batch_args : bool
+        False emulates firmware that takes one argument per transfer for commands other
+        than REG_WR. It drops the command and keeps HRDY low if a transfer holds more.
+
+    bufsiz : int
+        The spidev.bufsiz kernel parameter, the most bytes one SPI_IOC_MESSAGE ioctl takes.
+        Larger messages fail with EMSGSIZE, like they do with spidev.
+    """
+
+    def __init__(self, width=800, height=600, img_buf_address=0x118D30, memory_frames=4,
+                 firmware_version='SWv_0.1.WS_v.0.1', lut_version='M641', vcom=-1.5,
+                 time_scale=1.0, hrdy_delay=0.0, batch_args=True, bufsiz=4096):
+        self.width = width
+        self.height = height
+        self.img_buf_address = img_buf_address
+        self.firmware_version = firmware_version
+        self.lut_version = lut_version
+        self.time_scale = time_scale
+        self.hrdy_delay = hrdy_delay
+        self.batch_args = batch_args
+        self.bufsiz = bufsiz
+
+        self.memory = np.zeros(img_buf_address + memory_frames * width * height, dtype=np.uint8)
+        # what the panel currently shows
+        self.panel = np.full((height, width), 0xFF, dtype=np.uint8)
+        self.vcom = int(round(-1000 * vcom))
+
+        self.spidev = EmulatedSpiDev(self)
+        self.gpio = EmulatedGPIO(self)
+
+        self.lock = threading.RLock()
+        self.hrdy = True
+        self._hrdy_timer = None
+
+        # statistics
+        self.commands = Counter()
+        self.transfers = 0
+        self.bytes_written = 0
+        self.ioctls = 0
+        self.hrdy_violations = 0
+        self.updates = []
+        self.errors = []
+
+        self.power_on()
+
+    def power_on(self):
+        """
+        Bring the controller into the state after reset
+        """
+        self.registers = defaultdict(int)
+        self.registers[Registers.LISAR] = self.img_buf_address & 0xFFFF
+        self.registers[Registers.LISAR + 2] = self.img_buf_address >> 16
+        self.state = 'run'
+        self.busy_until = 0.0
+        self._command = None
+        self._args = []
+        self._nargs = 0
+        self._load = None
+        self._burst = None
+        self._out = deque()
+
+    def epd(self, vcom=-1.5, cache=None, **kwargs):
+        """
+        Return an EPD talking to this emulator, with its memory size. kwargs are passed to
+        SPI, which does not reset the controller if cache is given, like the default SPI of EPD.
+        """
+        kwargs.setdefault('reset', cache is None)
+        return EPD(vcom=vcom, spi=self.spi(**kwargs), cache=cache, memory_size=self.memory.size)
+
+    def spi(self, **kwargs):
+        """
+        Return a SPI transport talking to this emulator. kwargs are passed to SPI, the
+        message size defaults to bufsiz, as read from sysfs on a Raspberry Pi.
+        """
+        kwargs.setdefault('message_size', self.bufsiz)
+        return SPI(device=self.spidev, gpio=self.gpio, **kwargs)
+
+    def frame(self, address=None):
+        """
+        Return a writable view of the image memory at address (default img_buf_address)
+        as (height, width) array, one byte per pixel.
+        """
+        if address is None:
+            address = self.img_buf_address
+        return self.memory[address:address + self.width * self.height].reshape(self.height, self.width)
+
+    def busy(self):
+        """
+        True while a display update is running
+        """
+        return time.monotonic() < self.busy_until
+
+    def reset_stats(self):
+        self.commands.clear()
+        self.transfers = 0
+        self.bytes_written = 0
+        self.ioctls = 0
+        self.hrdy_violations = 0
+        self.updates = []
+        self.errors = []
+
+    def transfer(self, data):
+        """
+        Handle one SPI transfer (one chip select cycle) and return the received bytes
+        """
+        with self.lock:
+            if not self.hrdy:
+                self.hrdy_violations += 1
+            self.transfers += 1
+            self.bytes_written += len(data)
+            words = np.frombuffer(bytes(data), dtype=WORD)
+            rtn = np.zeros(words.size, dtype=WORD)
+            if words.size:
+                preamble = int(words[0])
+                if preamble == 0x6000:
+                    for code in words[1:]:
+                        self._start_command(int(code))
+                elif preamble == 0x0000:
+                    if (not self.batch_args and words.size > 2 and len(self._args) < self._nargs
+                            and self._command != Commands.REG_WR):
+                        self._command = None
+                        self._nargs = 0
+                        return rtn.tobytes()
+                    self._write_data(words[1:].astype(np.uint16))
+                elif preamble == 0x1000:
+                    # first word is a dummy
+                    for i in range(2, words.size):
+                        rtn[i] = self._out.popleft() if self._out else 0
+                else:
+                    self._error('unknown preamble 0x{:04X}'.format(preamble))
+            self._lower_hrdy()
+        return rtn.tobytes()
+
+    def _lower_hrdy(self):
+        if self.hrdy_delay <= 0.0:
+            self.gpio.edge(Pins.HRDY)
+            return
+        self.hrdy = False
+        if self._hrdy_timer is not None:
+            self._hrdy_timer.cancel()
+        self._hrdy_timer = threading.Timer(self.hrdy_delay, self._raise_hrdy)
+        self._hrdy_timer.daemon = True
+        self._hrdy_timer.start()
+
+    def _raise_hrdy(self):
+        self.hrdy = True
+        self.gpio.edge(Pins.HRDY)
+
+    def _error(self, msg):
+        logging.warning('IT8951 emulator: %s', msg)
+        self.errors.append(msg)
+
+    def _start_command(self, code):
+        if self._load is not None and code != Commands.LD_IMG_END:
+            self._error('command 0x{:04X} while loading image'.format(code))
+        if code not in COMMAND_ARGS:
+            self._error('unknown command 0x{:04X}'.format(code))
+            self._command = None
+            return
+        self.commands[code] += 1
+        self._command = code
+        self._args = []
+        self._nargs = COMMAND_ARGS[code]
+        if self._nargs == 0:
+            self._execute()
+
+    def _write_data(self, words):
+        i = 0
+        while i < words.size and len(self._args) < self._nargs:
+            self._args.append(int(words[i]))
+            i += 1
+            if len(self._args) == self._nargs:
+                self._execute()
+        if i < words.size:
+            if self._load is not None:
+                self._load['data'].append(words[i:])
+            elif self._burst is not None and self._burst['write']:
+                self._burst_write(words[i:])
+            else:
+                self._error('unexpected data for command {}'.format(self._command))
+
+    def _execute(self):
+        code = self._command
+        args = self._args
+        if code == Commands.SYS_RUN:
+            self.state = 'run'
+        elif code == Commands.STANDBY:
+            self.state = 'standby'
+        elif code == Commands.SLEEP:
+            self.state = 'sleep'
+        elif code == Commands.REG_RD:
+            self._out.append(self.read_register(args[0]))
+        elif code == Commands.REG_WR:
+            self.registers[args[0]] = args[1]
+        elif code in (Commands.MEM_BST_RD_T, Commands.MEM_BST_WR):
+            self._burst = {
+                'address': args[0] | (args[1] << 16),
+                'count': args[2] | (args[3] << 16),
+                'write': code == Commands.MEM_BST_WR,
+            }
+        elif code == Commands.MEM_BST_RD_S:
+            self._burst_read()
+        elif code == Commands.MEM_BST_END:
+            self._burst = None
+        elif code == Commands.LD_IMG:
+            # the whole frame, turned a quarter by Rotate.CW and Rotate.CCW
+            dims = (self.height, self.width) if args[0] & 0x1 else (self.width, self.height)
+            self._start_load(args[0], (0, 0), dims)
+        elif code == Commands.LD_IMG_AREA:
+            self._start_load(args[0], (args[1], args[2]), (args[3], args[4]))
+        elif code == Commands.LD_IMG_END:
+            self._end_load()
+        elif code == Commands.DPY_AREA:
+            self._display(args[:4], args[4], self.img_buf_address)
+        elif code == Commands.DPY_BUF_AREA:
+            self._display(args[:4], args[4], args[5] | (args[6] << 16))
+        elif code == Commands.GET_DEV_INFO:
+            self._out.extend([self.width, self.height,
+                              self.img_buf_address & 0xFFFF, self.img_buf_address >> 16])
+            self._out.extend(encode_string(self.firmware_version))
+            self._out.extend(encode_string(self.lut_version))
+        elif code == Commands.VCOM:
+            if args[0] == 0:
+                self._out.append(self.vcom)
+            elif len(args) == 1:
+                # the value to set follows as second argument
+                self._nargs = 2
+                return
+            else:
+                self.vcom = args[1]
+
+    def read_register(self, address):
+        """
+        Return the value the controller reports for a register
+        """
+        if address == Registers.LUTAFSR:
+            return 0xFFFF if self.busy() else 0
+        return self.registers[address]
+
+    def _load_address(self):
+        return self.registers[Registers.LISAR] | (self.registers[Registers.LISAR + 2] << 16)
+
+    def _start_load(self, arg, xy, dims):
+        self._load = {
+            'endian': (arg >> 8) & 0x1,
+            'pixel_format': (arg >> 4) & 0x3,
+            'rotate': arg & 0x3,
+            'xy': xy,
+            'dims': dims,
+            'address': self._load_address(),
+            'data': [],
+        }
+
+    def _end_load(self):
+        load = self._load
+        self._load = None
+        if load is None:
+            self._error('LD_IMG_END without LD_IMG')
+            return
+        words = np.concatenate(load['data']) if load['data'] else np.zeros(0, dtype=np.uint16)
+        pixels = self.unpack(words, load['dims'], load['pixel_format'], load['endian'])
+        if pixels is None:
+            return
+        # the frame position of every loaded pixel, the controller turns the image clockwise
+        # with Rotate.CW, counter clockwise with Rotate.CCW and by half a turn with Rotate.FLIP
+        y, x = np.indices(pixels.shape)
+        x += load['xy'][0]
+        y += load['xy'][1]
+        rotate = load['rotate']
+        if rotate == Rotate.CW:
+            x, y = self.width - 1 - y, x
+        elif rotate == Rotate.CCW:
+            x, y = y, self.height - 1 - x
+        elif rotate == Rotate.FLIP:
+            x, y = self.width - 1 - x, self.height - 1 - y
+        if x.min() < 0 or y.min() < 0 or x.max() >= self.width or y.max() >= self.height:
+            self._error('image area {} {} outside of the frame'.format(load['xy'], load['dims']))
+            return
+        self.frame(load['address'])[y, x] = pixels
+
+    def unpack(self, words, dims, pixel_format, endian=EndianTypes.LITTLE):
+        """
+        Unpack pixel words of an area of size dims into a (height, width) array holding the
+        bytes the controller stores in its image memory. Every row starts with a new word.
+        """
+        bits = PIXEL_FIELD_BITS[pixel_format]
+        per_word = 16 // bits
+        w, h = dims
+        row_words = -(-w // per_word)
+        if words.size != row_words * h:
+            self._error('expected {:d} pixel words for area {}, got {:d}'.format(row_words * h, dims, words.size))
+            return None
+        words = words.reshape(h, row_words)
+        pixels = np.empty((h, row_words * per_word), dtype=np.uint8)
+        for i in range(per_word):
+            shift = bits * (i if endian == EndianTypes.LITTLE else per_word - 1 - i)
+            pixels[:, i::per_word] = ((words >> shift) & PIXEL_MASKS[pixel_format]) << (8 - bits)
+        return pixels[:, :w]
+
+    def _display(self, area, mode, address):
+        x, y, w, h = area
+        if x + w > self.width or y + h > self.height:
+            self._error('display area {} outside of the panel'.format(area))
+            return
+        if mode not in DISPLAY_TIMES:
+            self._error('unknown display mode {:d}'.format(mode))
+            return
+        frame = self.frame(address)
+        if self.registers[Registers.UP1SR + 2] & UP1SR_BITMAP:
+            # every byte holds 8 pixels, shown with the gray levels of the color table
+            if x % 8 or w % 8:
+                self._error('bitmap display area {} not aligned to bytes'.format(area))
+                return
+            bits = np.unpackbits(frame[y:y + h, x // 8:(x + w) // 8], axis=1, bitorder='little')
+            colors = self.registers[Registers.BGVR]
+            self.panel[y:y + h, x:x + w] = np.where(bits, colors >> 8, colors & 0xFF)
+        else:
+            self.panel[y:y + h, x:x + w] = frame[y:y + h, x:x + w]
+        now = time.monotonic()
+        self.busy_until = max(self.busy_until, now + DISPLAY_TIMES[mode] * self.time_scale)
+        self.updates.append((x, y, w, h, mode))
+
+    def _burst_write(self, words):
+        burst = self._burst
+        words = words[:burst['count']]
+        data = words.astype('<u2').view(np.uint8)
+        start = burst['address']
+        self.memory[start:start + data.size] = data
+        burst['address'] += data.size
+        burst['count'] -= words.size
+
+    def _burst_read(self):
+        burst = self._burst
+        if burst is None or burst['write']:
+            self._error('MEM_BST_RD_S without MEM_BST_RD_T')
+            return
+        start = burst['address']
+        data = self.memory[start:start + 2 * burst['count']]
+        self._out.extend(data.view('<u2').tolist())
+
+    def reset(self, level):
+        """
+        Called when the RESET pin changes
+        """
+        if level:
+            with self.lock:
+                self.power_on()
+                self.hrdy = True
+            self.gpio.edge(Pins.HRDY)
+        else:
+            self.hrdy = False
+
+
+class EmulatedSpiDev:
+    """
+    Stands in for spidev.SpiDev, sending every transfer to the emulator
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.max_speed_hz = 0
+        self.mode = 0
+
+    def xfer3(self, data):
+        return list(self.emulator.transfer(data))
+
+    def writebytes2(self, data):
+        self.emulator.transfer(data)
+
+    def ioctl(self, request, transfers):
+        """
+        Handle SPI_IOC_MESSAGE, every segment is a separate chip select cycle
+        """
+        count = ((request >> 16) & 0x3FFF) // ctypes.sizeof(SpiIocTransfer)
+        if sum(transfer.len for transfer in transfers[:count]) > self.emulator.bufsiz:
+            raise OSError(errno.EMSGSIZE, os.strerror(errno.EMSGSIZE))
+        self.emulator.ioctls += 1
+        for transfer in transfers[:count]:
+            self.emulator.transfer(ctypes.string_at(transfer.tx_buf, transfer.len))
+
+    def close(self):
+        pass
+
+
+class EmulatedGPIO:
+    """
+    Stands in for the RPi.GPIO module, connecting the HRDY and RESET pins to the emulator
+    """
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    PUD_DOWN = 21
+    RISING = 31
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        pass
+
+    def add_event_detect(self, channel, edge, callback=None):
+        self.callbacks[channel] = callback
+
+    def remove_event_detect(self, channel):
+        self.callbacks.pop(channel, None)
+
+    def input(self, channel):
+        if channel == Pins.HRDY:
+            return self.HIGH if self.emulator.hrdy else self.LOW
+        return self.LOW
+
+    def output(self, channel, value):
+        if channel == Pins.RESET:
+            self.emulator.reset(value)
+
+    def edge(self, channel):
+        """
+        Deliver a rising edge on channel to the registered callback
+        """
+        callback = self.callbacks.get(channel)
+        if callback is not None:
+            callback(channel)
+
+    def cleanup(self):
+        self.callbacks.clear()
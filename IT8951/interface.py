@@ -1,13 +1,261 @@
+import collections
+import json
 import logging
+import os
+import zlib
 
 from . import constants
 from .constants import Commands, Registers, PixelModes
-from .spi import SPI
+from .spi import SPI, WORD, BufferPool
 
-from time import sleep
+from time import monotonic, sleep
 
 import numpy as np
 
+# bits per pixel in the transferred data
+PIXEL_BITS = {
+    PixelModes.M_1BPP: 1,
+    PixelModes.M_2BPP: 2,
+    PixelModes.M_3BPP: 4,
+    PixelModes.M_4BPP: 4,
+    PixelModes.M_8BPP: 8,
+}
+
+# areas have to be aligned to this many pixels in x direction, so rows start with a new
+# word. Bitmaps are loaded with x and width divided by 8, which have to stay 32-bit aligned.
+PIXEL_ALIGNMENT = {
+    PixelModes.M_1BPP: 32,
+    PixelModes.M_2BPP: 8,
+    PixelModes.M_3BPP: 4,
+    PixelModes.M_4BPP: 4,
+    PixelModes.M_8BPP: 2,
+}
+
+# formats PixelModes.AUTO picks from, smallest first, before falling back to 8bpp. 2bpp is
+# only sent when asked for: the controller is modelled to store a 2bpp level in the upper
+# two bits of a byte, so 0b11 becomes 0xC0 and white would show as gray.
+AUTO_PIXEL_FORMATS = (PixelModes.M_1BPP, PixelModes.M_4BPP)
+
+# UP1SR+2 bit that makes the display engine read image memory as 1bpp bitmap
+BITMAP_MODE = 1 << 2
+
+# bytes of SDRAM of the IT8951, the default memory_size of EPD
+DEVICE_MEMORY = 64 << 20 >> 3
+
+# device info stored by EPD in its cache file
+CACHE_KEYS = ('width', 'height', 'img_buf_address', 'firmware_version', 'lut_version', 'vcom')
+
+# registers the controller changes by itself, EPD always reads them from the device
+VOLATILE_REGISTERS = frozenset([
+    Registers.LUT0EWHR, Registers.LUT0XYR, Registers.LUT0BADDR, Registers.LUT0MFN,
+    Registers.LUT01AF, Registers.UP0SR, Registers.UP0SR + 2, Registers.UP1SR, Registers.UP1SR + 2,
+    Registers.LUT0ABFRV, Registers.UPBBADDR, Registers.LUT0IMXY, Registers.LUTAFSR,
+    Registers.MCSR,
+])
+
+# typical duration of a refresh in seconds, the starting point of RefreshModel
+REFRESH_TIMES = {
+    constants.DisplayModes.INIT: 2.0,
+    constants.DisplayModes.DU: 0.26,
+    constants.DisplayModes.GC16: 0.48,
+    constants.DisplayModes.GL16: 0.48,
+    constants.DisplayModes.GLR16: 0.48,
+    constants.DisplayModes.GLD16: 0.48,
+    constants.DisplayModes.A2: 0.12,
+    constants.DisplayModes.DU4: 0.29,
+}
+
+# if the display is busy, EPD.wait_display_ready polls again at this fraction of the predicted
+# refresh time, at the predicted end, and then at intervals doubling from POLL_INTERVAL up to
+# POLL_INTERVAL_MAX
+READY_EARLY = 0.8
+POLL_INTERVAL = 0.001
+POLL_INTERVAL_MAX = 0.01
+
+
+def run_ops(ops, target):
+    """
+    Run the generator ops, which yields (name, *args) for every I/O step it takes, by calling
+    the method of target called name with args and sending back the result. ('pause', seconds)
+    sleeps. Returns the value ops returns.
+
+    The steps of EPD and AutoEPDDisplay are written this way once, and run by IT8951.aio as well.
+    """
+    value = None
+    while True:
+        try:
+            step = ops.send(value)
+        except StopIteration as stop:
+            return stop.value
+        name, args = step[0], step[1:]
+        value = sleep(*args) if name == 'pause' else getattr(target, name)(*args)
+
+
+def rotate_area(rotate_mode, xy, dims, width, height):
+    """
+    Map an area given in the coordinates of an image loaded with rotate_mode to the
+    device frame of size (width, height). Returns the top left corner in the device frame
+    and the number of quarter turns counter clockwise (as used by numpy.rot90) that turn
+    the loaded pixels into device orientation.
+    """
+    x, y = xy
+    w, h = dims
+    if rotate_mode == constants.Rotate.FLIP:
+        return (width - x - w, height - y - h), 2
+    if rotate_mode == constants.Rotate.CW:
+        return (width - y - h, x), -1
+    if rotate_mode == constants.Rotate.CCW:
+        return (y, height - x - w), 1
+    return (x, y), 0
+
+
+class PackCache:
+    """
+    A LRU cache of packed pixel words, so areas that are loaded again with the same
+    content, e.g. icons toggled back and forth, are not packed again. Entries are found
+    by the CRC-32 of the pixels together with their shape, the pixel format and the
+    bitmap foreground, and keep a copy of the pixels to rule out collisions. At most
+    max_bytes of pixels and words are kept, larger areas are packed every time.
+
+    hits and misses count the lookups, entries and bytes describe the cache contents.
+    """
+
+    # 8bpp is not cached, packing it is a plain copy
+    FORMATS = (PixelModes.M_1BPP, PixelModes.M_2BPP, PixelModes.M_3BPP, PixelModes.M_4BPP)
+
+    def __init__(self, max_bytes=4 << 20):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def entries(self):
+        return len(self._entries)
+
+    def fits(self, buf):
+        """
+        Return True if the pixels of buf and their words fit into the cache
+        """
+        # the words of 4bpp take half the size of the pixels, all other formats less
+        return buf.size * 3 // 2 <= self.max_bytes
+
+    @staticmethod
+    def key(buf, pixel_format, foreground=None, pool=None):
+        """
+        Return the cache key of the pixels in buf and the pixels as contiguous array.
+        Views that are not contiguous are copied into the 'hash' buffer of pool first.
+        """
+        if not buf.flags.c_contiguous:
+            flat = pool.get('hash', buf.size) if pool is not None else np.empty(buf.size, dtype=np.ubyte)
+            flat = flat.reshape(buf.shape)
+            np.copyto(flat, buf)
+            buf = flat
+        return (zlib.crc32(buf), buf.shape, pixel_format, foreground), buf
+
+    def get(self, key, pixels):
+        """
+        Return the words cached for key if they were packed from pixels, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None or not self._equal(entry[0], pixels):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    @staticmethod
+    def _equal(cached, pixels):
+        # compare 8 pixels at once, this keeps the temporary array of the comparison small
+        if pixels.size % 8 == 0:
+            return np.array_equal(cached.reshape(-1).view(np.uint64), pixels.reshape(-1).view(np.uint64))
+        return np.array_equal(cached, pixels)
+
+    def put(self, key, pixels, words):
+        """
+        Cache copies of pixels and their words for key, evicting the entries used least
+        recently, and return the words
+        """
+        size = pixels.nbytes + words.nbytes
+        if size > self.max_bytes:
+            return words
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[0].nbytes + previous[1].nbytes
+        words = np.array(words)
+        self._entries[key] = (np.array(pixels), words)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (old_pixels, old_words) = self._entries.popitem(last=False)
+            self.bytes -= old_pixels.nbytes + old_words.nbytes
+        return words
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+
+class RefreshModel:
+    """
+    Learns how long refreshes take, per display mode as linear function of the refreshed
+    area. Recent measurements weigh more, every new one scales the weight of the earlier
+    ones by 1 - rate. The typical durations in REFRESH_TIMES count as one measurement
+    of the whole panel before anything has been measured.
+
+    Parameters
+    ----------
+
+    pixels : int
+        The area of the panel, used for the initial measurements
+
+    rate : float, optional
+        The weight of a new measurement
+    """
+
+    def __init__(self, pixels, rate=0.25):
+        self.pixels = pixels
+        self.rate = rate
+        # per mode weighted sums of 1, x, y, x*x and x*y with x the area and y the duration
+        self.sums = {}
+        # number of measurements per mode
+        self.samples = {}
+
+    def predict(self, mode, pixels):
+        """
+        Return the expected duration in seconds of a refresh of pixels using mode
+        """
+        n, sx, sy, sxx, sxy = self._sums(mode)
+        var = n * sxx - sx * sx
+        if var <= 1e-6 * n * sxx:
+            # all measurements of (nearly) the same area
+            return sy / n
+        slope = (n * sxy - sx * sy) / var
+        return max(0.0, (sy - slope * sx) / n + slope * pixels)
+
+    def learn(self, mode, pixels, seconds):
+        """
+        Add the measured duration of a refresh of pixels using mode
+        """
+        keep = 1.0 - self.rate
+        n, sx, sy, sxx, sxy = self._sums(mode)
+        self.sums[mode] = (keep * n + 1, keep * sx + pixels, keep * sy + seconds,
+                           keep * sxx + pixels * pixels, keep * sxy + pixels * seconds)
+        self.samples[mode] = self.samples.get(mode, 0) + 1
+
+    def durations(self):
+        """
+        Return the predicted duration of a full panel refresh for every mode
+        """
+        return {mode: self.predict(mode, self.pixels) for mode in REFRESH_TIMES}
+
+    def _sums(self, mode):
+        if mode not in self.sums:
+            seconds = REFRESH_TIMES.get(mode, max(REFRESH_TIMES.values()))
+            self.sums[mode] = (1.0, self.pixels, seconds, self.pixels * self.pixels, self.pixels * seconds)
+        return self.sums[mode]
+
 
 class EPD:
     """
@@ -19,11 +267,29 @@ class EPD:
     vcom : float
          The VCOM voltage that produces optimal display. Varies from
          device to device.
+
+    spi : SPI, optional
+         The transport to talk to the controller. Defaults to the SPI bus and
+         GPIO pins of a Raspberry Pi, see IT8951.emulator for a software controller.
+
+    cache : str, optional
+         Path of a JSON file keeping the device info between runs. If it exists, and a
+         probe of a few registers shows that the controller is still running as set up
+         by an earlier EPD, the reset and setup are skipped. Otherwise the controller
+         is reset and set up as usual, and the file is written. The default SPI does not
+         reset the controller if cache is given, an SPI passed in should be created with
+         reset=False to allow this.
+
+    memory_size : int, optional
+         Bytes of device memory, which bound the frames of EPD.frame_offset. Defaults to
+         DEVICE_MEMORY.
     """
 
-    def __init__(self, vcom=-1.5):
+    def __init__(self, vcom=-1.5, spi=None, cache=None, memory_size=DEVICE_MEMORY):
 
-        self.spi = SPI()
+        if spi is None:
+            spi = SPI(reset=cache is None)
+        self.spi = spi
 
         self.width = None
         self.height = None
@@ -31,6 +297,65 @@ class EPD:
         self.img_buf_address = None
         self.firmware_version = None
         self.lut_version = None
+        self.memory_size = memory_size
+
+        # shadow of the registers last read or written, and of VCOM in mV
+        self.registers = {}
+        self.vcom_shadow = None
+        # register accesses answered from the shadow and those that needed the device
+        self.register_hits = 0
+        self.register_misses = 0
+
+        info = self._read_cache(cache) if cache is not None else None
+        if info is not None and self.spi.resets == 0 and self._attach(info):
+            logging.debug('attached to running controller')
+        else:
+            self.invalidate_registers()
+            if self.spi.resets == 0:
+                self.spi.reset()
+            self._setup()
+        # check before any real command whether the controller takes batched arguments
+        self.spi.args_batched()
+
+        # BGVR colors while the display engine is in 1bpp mode, None otherwise
+        self.bitmap_colors = None
+        # (xy, pixels) of the image buffer columns the last bitmap was loaded into, written
+        # back once the display engine leaves 1bpp mode
+        self.bitmap_strip = None
+
+        # the largest update is a full frame with 8 bits per pixel
+        pixels = self.width * self.height
+        # rows padded to whole words take up to one more byte each
+        self.spi.pool.reserve('pack', pixels + max(self.width, self.height))
+        self.spi.pool.reserve('pack_scratch', pixels)
+        if self.spi.batch_transfers:
+            chunks = -(-pixels // (2 * self.spi.batch_chunk))
+            self.spi.pool.reserve('batch', chunks * (self.spi.batch_chunk + 1), WORD)
+
+        # packed words of recently loaded areas, see PackCache. Off by default, hashing
+        # and storing the words of changing areas costs more than packing them.
+        self.pack_cache = None
+
+        # refreshes started since the display was last found ready, as (mode, pixels, start)
+        self.refreshes = []
+        self.refresh_model = RefreshModel(self.width * self.height)
+        # statistics of wait_display_ready
+        self.ready_waits = 0
+        self.ready_polls = 0
+
+        # logging.debug('Vcom = {:1.2f}'.format(vcom))
+        if vcom != self.get_vcom():
+            self.set_vcom(vcom)
+        # sleep(0.01)
+        # logging.debug('Vcom = {:1.2f}'.format(self.get_vcom()))
+
+        if cache is not None:
+            self._write_cache(cache, info)
+
+    def _setup(self):
+        """
+        Read the device info and set up the controller after a reset
+        """
         [self.width, self.height, self.img_buf_address, self.firmware_version, self.lut_version] =\
             self.update_system_info()
 
@@ -40,17 +365,69 @@ class EPD:
         self.write_register(Registers.I80CPCR, 0x1)
         # logging.debug(self.read_register(Registers.I80CPCR))
 
-        # logging.debug('Vcom = {:1.2f}'.format(vcom))
-        if vcom != self.get_vcom():
-            self.set_vcom(vcom)
-        # sleep(0.01)
-        # logging.debug('Vcom = {:1.2f}'.format(self.get_vcom()))
+    def _attach(self, info):
+        """
+        Take the device info from info if the controller is still set up as _setup leaves it
+        """
+        # not self.active(), which subclasses like AsyncEPD turn into a coroutine
+        self.spi.write_cmd_code(Commands.SYS_RUN, 1.0)
+        address = self.read_register(Registers.LISAR) | (self.read_register(Registers.LISAR+2) << 16)
+        if self.read_register(Registers.I80CPCR) != 0x1 or address != info['img_buf_address']:
+            logging.info('controller is not set up as cached, resetting it')
+            return False
+
+        self.width, self.height = info['width'], info['height']
+        self.img_buf_address = info['img_buf_address']
+        self.firmware_version, self.lut_version = info['firmware_version'], info['lut_version']
+        self.vcom_shadow = info['vcom']
+
+        # an earlier process could have left the display engine in 1bpp mode
+        value = self.read_register(Registers.UP1SR + 2)
+        if value & BITMAP_MODE:
+            self.write_register(Registers.UP1SR + 2, value & ~BITMAP_MODE)
+        return True
+
+    @staticmethod
+    def _read_cache(path):
+        """
+        Return the device info stored in the cache file at path, or None
+        """
+        try:
+            with open(path) as f:
+                info = json.load(f)
+            return {key: info[key] for key in CACHE_KEYS}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug('no device info in {}: {}'.format(path, e))
+            return None
+
+    def _write_cache(self, path, info):
+        """
+        Store the device info in the cache file at path, unless it already holds info
+        """
+        current = {
+            'width': self.width,
+            'height': self.height,
+            'img_buf_address': self.img_buf_address,
+            'firmware_version': self.firmware_version,
+            'lut_version': self.lut_version,
+            'vcom': self.vcom_shadow,
+        }
+        if current == info:
+            return
+        try:
+            tmp = '{}.tmp'.format(path)
+            with open(tmp, 'w') as f:
+                json.dump(current, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning('cannot write device info to {}: {}'.format(path, e))
 
     def __del__(self):
         # logging.debug('Ende EPD')
         self.spi.__del__()
 
-    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None):
+    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None,
+                      pixel_format=PixelModes.M_4BPP, offset=0):
         """
         Write the pixel data in buf (an array of bytes, 1 per pixel) to device memory.
         This function does not actually display the image (see EPD.display_area).
@@ -71,30 +448,386 @@ class EPD:
         dims : (int, int), optional
             The dimensions of the area being pasted. If xy is omitted (or set to None), the
             dimensions are assumed to be the dimensions of the display area.
+
+        pixel_format : constants.PixelModes, optional
+            The format the pixels are packed in for the transfer. With PixelModes.AUTO the
+            smallest format of AUTO_PIXEL_FORMATS is used that keeps all gray levels and fits
+            the alignment of the area, or else 8bpp.
+
+            PixelModes.M_1BPP sends images with at most two gray levels as bitmap and programs
+            BGVR with these levels. The bitmap is loaded as 8bpp image into columns x / 8 to
+            (x + width) / 8 of the rows of the area, 8 pixels per byte. These columns are
+            usually outside the area, so their 8bpp pixels are read before and written back
+            when the display engine leaves 1bpp mode, which it does once an image is loaded
+            with another format. The x coordinate and width have to be multiples of 32.
+
+        offset : int, optional
+            Byte offset of the frame to load into from img_buf_address, e.g. EPD.frame_offset(1)
+            for a frame shown with EPD.display_buf_area. Only the image buffer takes 1bpp images.
+
+        Returns
+        -------
+
+        The pixel format that was used
         """
 
+        return run_ops(self._load_img_area_ops(buf, rotate_mode, xy, dims, pixel_format, offset), self.spi)
+
+    def _load_img_area_ops(self, buf, rotate_mode, xy, dims, pixel_format, offset):
+        pixel_format, colors, command, args, words = self._prepare_load(buf, rotate_mode, xy, dims, pixel_format,
+                                                                        offset)
+
+        if pixel_format == PixelModes.M_1BPP:
+            yield from self._save_bitmap_strip_ops(xy, dims)
+        yield from self._bitmap_mode_ops(colors)
+        if offset:
+            yield from self._img_buf_base_addr_ops(self.img_buf_address + offset)
+        yield 'send_cmd_arg', command, args
+        # logging.debug('pixels {:d}'.format(len(words)))
+        self.spi.count = 0
+        yield 'write_ndata', words
+        # logging.debug('pixels done {:d}'.format(self.spi.count))
+
+        yield 'write_cmd_code', Commands.LD_IMG_END
+        if offset:
+            # a restarted process finds the image buffer address where it expects it
+            yield from self._img_buf_base_addr_ops(self.img_buf_address)
+        return pixel_format
+
+    def _prepare_load(self, buf, rotate_mode, xy, dims, pixel_format, offset=0):
+        """
+        Everything load_img_area does without talking to the device. Returns the pixel
+        format, the colors for EPD._set_bitmap_mode, the load command with its arguments
+        and the packed pixel words.
+        """
         endian_type = constants.EndianTypes.LITTLE
-        pixel_format = constants.PixelModes.M_4BPP
 
+        buf = self._as_pixels(buf)
+        if buf.ndim != 2:
+            # rows are packed separately, so flat buffers take the shape of the area
+            if xy is not None:
+                buf = buf.reshape(dims[1], dims[0])
+            elif rotate_mode in (constants.Rotate.CW, constants.Rotate.CCW):
+                buf = buf.reshape(self.width, self.height)
+            else:
+                buf = buf.reshape(self.height, self.width)
+        if pixel_format == PixelModes.AUTO:
+            pixel_format = self.select_pixel_format(buf, xy, dims, rotate_mode, bitmap=not offset)
+
+        colors = None
+        foreground = None
+        if pixel_format == PixelModes.M_1BPP:
+            if rotate_mode != constants.Rotate.NONE:
+                raise ValueError('1bpp images cannot be rotated')
+            if offset:
+                raise ValueError('1bpp images can only be loaded into the image buffer')
+            if xy is None:
+                xy = (0, 0)
+                dims = (self.width, self.height)
+            if xy[0] % PIXEL_ALIGNMENT[pixel_format] or dims[0] % PIXEL_ALIGNMENT[pixel_format]:
+                raise ValueError('x and width of 1bpp images have to be multiples of 32')
+            colors = self._bitmap_levels(buf)
+            foreground = colors[0]
+            command = Commands.LD_IMG_AREA
+            args = self._load_img_args(endian_type, PixelModes.M_8BPP, rotate_mode,
+                                       (xy[0] // 8, xy[1]), (dims[0] // 8, dims[1]))
+        elif xy is None:
+            command = Commands.LD_IMG
+            args = self._load_img_args(endian_type, pixel_format, rotate_mode)
+        else:
+            command = Commands.LD_IMG_AREA
+            args = self._load_img_args(endian_type, pixel_format, rotate_mode, xy, dims)
+
+        words = self._packed(buf, pixel_format, foreground)
+        return pixel_format, colors, command, args, words
+
+    def _packed(self, buf, pixel_format, foreground=None):
+        """
+        Return the words of buf packed in pixel_format, from pack_cache if possible
+        """
+        cache = self.pack_cache
+        if cache is None or pixel_format not in cache.FORMATS or not cache.fits(buf):
+            # the packed pixels are sent before the next load, so their buffers can be reused
+            return self._pack_pixels(buf, pixel_format, foreground, self.spi.pool)
+        key, pixels = cache.key(buf, pixel_format, foreground, self.spi.pool)
+        words = cache.get(key, pixels)
+        if words is None:
+            words = cache.put(key, pixels, self._pack_pixels(pixels, pixel_format, foreground, self.spi.pool))
+        return words
+
+    def select_pixel_format(self, buf, xy=None, dims=None, rotate_mode=constants.Rotate.NONE, bitmap=True):
+        """
+        Return the smallest pixel format of AUTO_PIXEL_FORMATS that represents every gray
+        level of buf the panel can show, and fits the alignment of the area given by xy and
+        dims, or else PixelModes.M_8BPP.
+        PixelModes.M_1BPP is only picked if bitmap is True.
+        """
         if xy is None:
-            self._load_img_start(endian_type, pixel_format, rotate_mode)
+            xy = (0, 0)
+            dims = (self.width, self.height)
+        candidates = list(AUTO_PIXEL_FORMATS)
+        if rotate_mode != constants.Rotate.NONE or not bitmap:
+            candidates.remove(PixelModes.M_1BPP)
+        for pixel_format in candidates:
+            alignment = PIXEL_ALIGNMENT[pixel_format]
+            if xy[0] % alignment or dims[0] % alignment:
+                continue
+            if self.fits_pixel_format(buf, pixel_format):
+                return pixel_format
+        return PixelModes.M_8BPP
+
+    @staticmethod
+    def fits_pixel_format(buf, pixel_format):
+        """
+        Check whether packing buf with pixel_format keeps the 16 gray levels the panel shows
+        """
+        nibbles = np.asarray(buf) >> 4
+        if pixel_format == PixelModes.M_1BPP:
+            # any two levels, the color table maps them
+            return not np.any((nibbles != nibbles.min()) & (nibbles != nibbles.max()))
+        if pixel_format == PixelModes.M_2BPP:
+            # the upper two bits of the nibble, the lower two are stored as zeros
+            return not np.any(nibbles & 0x3)
+        return True
+
+    @staticmethod
+    def _bitmap_levels(buf):
+        """
+        Return the foreground (darker) and background gray level of a two level image
+        """
+        foreground = (int(buf.min()) >> 4) * 0x11
+        background = (int(buf.max()) >> 4) * 0x11
+        return foreground, background
+
+    def _set_bitmap_mode(self, colors):
+        """
+        Switch the display engine to 1bpp mode showing bits as the (foreground, background)
+        gray levels in colors, or back to normal mode if colors is None.
+        """
+        run_ops(self._bitmap_mode_ops(colors), self.spi)
+
+    def _bitmap_mode_ops(self, colors):
+        if colors == self.bitmap_colors:
+            return
+        if (colors is None) != (self.bitmap_colors is None):
+            value = yield from self._read_register_ops(Registers.UP1SR + 2)
+            if colors is None:
+                value &= ~BITMAP_MODE
+            else:
+                value |= BITMAP_MODE
+            yield from self._write_register_ops(Registers.UP1SR + 2, value)
+        if colors is not None:
+            yield from self._write_register_ops(Registers.BGVR, (colors[0] << 8) | colors[1])
         else:
-            self._load_img_area_start(endian_type, pixel_format, rotate_mode, xy, dims)
+            yield from self._restore_bitmap_strip_ops()
+        self.bitmap_colors = colors
 
-        buf = self._pack_pixels(buf, pixel_format)
-        # logging.debug('pixels {:d}'.format(len(buf)))
-        self.spi.count = 0
-        self.spi.write_ndata(buf)
-        # logging.debug('pixels done {:d}'.format(self.spi.count))
+    def _save_bitmap_strip_ops(self, xy, dims):
+        """
+        Write back the columns the last bitmap replaced, and read the 8bpp pixels of the
+        columns the bitmap of the area at xy with size dims is loaded into
+        """
+        yield from self._restore_bitmap_strip_ops()
+        (x, y), (w, h) = self._frame_area(xy, dims)
+        if x == 0:
+            # the columns lie inside the area, which no longer holds 8bpp pixels either
+            return
+        pixels = yield from self._read_image_ops((x // 8, y), (w // 8, h), 0)
+        self.bitmap_strip = ((x // 8, y), pixels)
 
-        self._load_img_end()
+    def _restore_bitmap_strip_ops(self):
+        if self.bitmap_strip is None:
+            return
+        xy, pixels = self.bitmap_strip
+        self.bitmap_strip = None
+        args = self._load_img_args(constants.EndianTypes.LITTLE, PixelModes.M_8BPP, constants.Rotate.NONE,
+                                   xy, (pixels.shape[1], pixels.shape[0]))
+        yield 'send_cmd_arg', Commands.LD_IMG_AREA, args
+        # not packed into the pool, a bitmap waiting to be sent may be there
+        yield 'write_ndata', self._pack_pixels(pixels, PixelModes.M_8BPP)
+        yield 'write_cmd_code', Commands.LD_IMG_END
 
     def display_area(self, xy, dims, display_mode):
         """
         Update a portion of the display to whatever is currently stored in device memory
         for that region. Updated data can be written to device memory using EPD.write_img_area
         """
-        self.spi.send_cmd_arg(Commands.DPY_AREA, [xy[0], xy[1], dims[0], dims[1], display_mode], 2.0)
+        run_ops(self._display_area_ops(xy, dims, display_mode), self.spi)
+
+    def _display_area_ops(self, xy, dims, display_mode):
+        yield 'send_cmd_arg', Commands.DPY_AREA, [xy[0], xy[1], dims[0], dims[1], display_mode], 2.0
+        self.refreshes.append((display_mode, int(dims[0]) * int(dims[1]), monotonic()))
+
+    def display_buf_area(self, xy, dims, display_mode, offset):
+        """
+        Like EPD.display_area, but shows the frame at offset, e.g. one loaded with
+        EPD.load_img_area(..., offset=EPD.frame_offset(1)), without transferring pixels.
+        Switches the display engine out of 1bpp mode, frames are always shown as 8bpp.
+        """
+        run_ops(self._display_buf_area_ops(xy, dims, display_mode, offset), self.spi)
+
+    def _display_buf_area_ops(self, xy, dims, display_mode, offset):
+        yield from self._bitmap_mode_ops(None)
+        address = self.img_buf_address + offset
+        yield 'send_cmd_arg', Commands.DPY_BUF_AREA, [xy[0], xy[1], dims[0], dims[1], display_mode,
+                                                      address & 0xFFFF, address >> 16], 2.0
+        self.refreshes.append((display_mode, int(dims[0]) * int(dims[1]), monotonic()))
+
+    @property
+    def frame_count(self):
+        """
+        The number of 8bpp frames from img_buf_address on that fit into device memory,
+        including the image buffer
+        """
+        return (self.memory_size - self.img_buf_address) // (self.width * self.height)
+
+    def frame_offset(self, index):
+        """
+        Return the byte offset from img_buf_address of the index-th frame in device memory,
+        frame 0 is the image buffer. Raises ValueError if the frame does not fit into
+        memory_size.
+        """
+        if not 0 <= index < self.frame_count:
+            raise ValueError('frame {:d} does not fit into {:d} bytes of device memory, which hold {:d} frames'
+                             .format(index, self.memory_size, self.frame_count))
+        return index * self.width * self.height
+
+    def write_memory(self, offset, data):
+        """
+        Write 16-bit words to device memory with one burst write. Every word holds two
+        bytes, the lower byte is stored at the lower address.
+
+        Parameters
+        ----------
+
+        offset : int
+            Even byte offset of the first word from img_buf_address
+
+        data : NumPy array, sequence or bytes-like
+            The words to write, see SPI.xfer3 for the accepted types
+        """
+        words = self.spi._as_words(data)
+        self.spi.send_cmd_arg(Commands.MEM_BST_WR, self._burst_args(offset, words.size))
+        self.spi.write_ndata(words)
+        self.spi.write_cmd_code(Commands.MEM_BST_END)
+
+    def read_memory(self, offset, count):
+        """
+        Read count 16-bit words from device memory with one burst read
+
+        Parameters
+        ----------
+
+        offset : int
+            Even byte offset of the first word from img_buf_address
+
+        count : int
+            The number of words to read
+
+        Returns
+        -------
+
+        The words as NumPy array
+        """
+        return run_ops(self._read_memory_ops(offset, count), self.spi)
+
+    def _read_memory_ops(self, offset, count):
+        yield 'send_cmd_arg', Commands.MEM_BST_RD_T, self._burst_args(offset, count)
+        yield 'write_cmd_code', Commands.MEM_BST_RD_S
+        words = yield 'read_ndata', count
+        yield 'write_cmd_code', Commands.MEM_BST_END
+        return words
+
+    def write_image(self, buf, xy=None, dims=None, offset=0):
+        """
+        Write 8bpp pixels straight into a frame in device memory, without the conversion
+        of LD_IMG. Areas as wide as the panel take one burst write, other areas one per row.
+        Switches the display engine out of 1bpp mode, so the frame can be displayed with
+        EPD.display_area.
+
+        Parameters
+        ----------
+
+        buf : bytes
+            An array of bytes containing the pixel data
+
+        xy : (int, int), optional
+            The top-left corner of the area, defaults to the whole frame. x has to be even.
+
+        dims : (int, int), optional
+            The dimensions of the area. The width has to be even.
+
+        offset : int, optional
+            Byte offset of the frame from img_buf_address, frames are width * height bytes
+        """
+        xy, dims = self._frame_area(xy, dims)
+        if xy[0] % 2 or dims[0] % 2:
+            raise ValueError('x and width of burst written areas have to be even')
+        pixels = self._as_pixels(buf).reshape(dims[1], dims[0])
+
+        self._set_bitmap_mode(None)
+        start = offset + xy[1] * self.width + xy[0]
+        if dims[0] == self.width:
+            self.write_memory(start, np.ascontiguousarray(pixels).view('<u2'))
+            return
+        for row in range(dims[1]):
+            self.write_memory(start + row * self.width, np.ascontiguousarray(pixels[row]).view('<u2'))
+
+    def read_image(self, xy=None, dims=None, offset=0):
+        """
+        Read the 8bpp pixels of an area of a frame in device memory. Areas as wide as the
+        panel take one burst read, other areas one per row.
+
+        Parameters
+        ----------
+
+        xy : (int, int), optional
+            The top-left corner of the area, defaults to the whole frame
+
+        dims : (int, int), optional
+            The dimensions of the area
+
+        offset : int, optional
+            Byte offset of the frame from img_buf_address, frames are width * height bytes
+
+        Returns
+        -------
+
+        The pixels as (height, width) NumPy array
+        """
+        return run_ops(self._read_image_ops(xy, dims, offset), self.spi)
+
+    def _read_image_ops(self, xy, dims, offset):
+        (x, y), (w, h) = self._frame_area(xy, dims)
+        # whole words
+        x0, x1 = x - x % 2, x + w + (x + w) % 2
+        start = offset + y * self.width + x0
+        if x1 - x0 == self.width:
+            words = yield from self._read_memory_ops(start, self.width * h // 2)
+        else:
+            rows = []
+            for row in range(h):
+                rows.append((yield from self._read_memory_ops(start + row * self.width, (x1 - x0) // 2)))
+            words = np.concatenate(rows)
+        pixels = words.astype('<u2').view(np.ubyte).reshape(h, x1 - x0)
+        return pixels[:, x - x0:x - x0 + w]
+
+    def _frame_area(self, xy, dims):
+        """
+        Return xy and dims, defaulting to the whole frame
+        """
+        if xy is None:
+            return (0, 0), (self.width, self.height)
+        return (int(xy[0]), int(xy[1])), (int(dims[0]), int(dims[1]))
+
+    def _burst_args(self, offset, count):
+        """
+        Return the arguments of MEM_BST_WR and MEM_BST_RD_T for count words at offset
+        """
+        if offset % 2:
+            raise ValueError('burst offsets have to be even')
+        address = self.img_buf_address + offset
+        return [address & 0xFFFF, address >> 16, count & 0xFFFF, count >> 16]
 
     def update_system_info(self):
         """
@@ -109,12 +842,18 @@ class EPD:
 
     def get_vcom(self):
         """
-        Get the device's current value for VCOM voltage
+        Get the device's current value for VCOM voltage. Only the first call reads it
+        from the device.
         """
+        if self.vcom_shadow is not None:
+            self.register_hits += 1
+            return -self.vcom_shadow/1000
+        self.register_misses += 1
         self.spi.count = 0
         self.spi.write_cmd_code(Commands.VCOM, 1.0)
         self.spi.write_data(0)
         vcom_int = self.spi.read_int()
+        self.vcom_shadow = vcom_int
         return -vcom_int/1000
 
     def set_vcom(self, vcom):
@@ -122,9 +861,15 @@ class EPD:
         Set the device's VCOM voltage
         """
         self._validate_vcom(vcom)
+        vcom_int = int(-1000*vcom)
+        if vcom_int == self.vcom_shadow:
+            self.register_hits += 1
+            return
+        self.register_misses += 1
         self.spi.write_cmd_code(Commands.VCOM, 1.0)
         self.spi.write_data(1)
-        self.spi.write_data(int(-1000*vcom))
+        self.spi.write_data(vcom_int)
+        self.vcom_shadow = vcom_int
 
     @staticmethod
     def _validate_vcom(vcom):
@@ -133,79 +878,238 @@ class EPD:
             raise ValueError("vcom must be between -5 and 0")
 
     @staticmethod
-    def _pack_pixels(buf, pixel_format):
+    def _as_pixels(buf):
+        """
+        Return buf (bytes-like, sequence or array, 1 byte per pixel) as NumPy array, without
+        copying bytes-like objects and arrays of bytes
+        """
+        if isinstance(buf, (bytes, bytearray, memoryview)):
+            return np.frombuffer(buf, dtype=np.ubyte)
+        return np.asarray(buf, dtype=np.ubyte)
+
+    @staticmethod
+    def _pack_pixels(buf, pixel_format, foreground=0x00, pool=None):
         """
         Take a buffer where each byte represents a pixel, and pack it
-        into 16-bit words according to pixel_format.
+        into 16-bit words according to pixel_format. The words are returned
+        as NumPy array and can be passed to SPI.write_ndata as is.
+
+        2D arrays, like a region sliced out of a frame, are packed row by row without
+        copying them first, and every row starts with a new word, as the controller expects.
+        Rows that do not fill whole words are padded with white pixels, which takes a copy.
+        The words and intermediate results are stored in the arrays 'pack', 'pack_pad' and
+        'pack_scratch' of the BufferPool pool if it is given.
+
+        For PixelModes.M_1BPP a bit is set for pixels with the gray level of foreground.
         """
-        buf = np.array(buf, dtype=np.ubyte)
+        if pixel_format not in PIXEL_BITS or pixel_format == PixelModes.AUTO:
+            return None
+        buf = EPD._as_pixels(buf)
+        # pixels per byte and per word
+        per_byte = 8 // PIXEL_BITS[pixel_format]
+        if buf.ndim != 2:
+            buf = buf.reshape(1, -1)
+        if pool is None:
+            pool = BufferPool()
+        height, width = buf.shape
+        if width % (2 * per_byte):
+            padded = pool.get('pack_pad', height * (width + 2 * per_byte - width % (2 * per_byte)))
+            padded = padded.reshape(height, -1)
+            padded[:, :width] = buf
+            padded[:, width:] = 0xFF
+            buf = padded
+            height, width = buf.shape
+        size = height * width // per_byte
+        out = pool.get('pack', size)
+        packed = out.reshape(height, width // per_byte)
+        groups = buf.reshape(height, width // per_byte, per_byte)
+        scratch = pool.get('pack_scratch', buf.size)
+
+        # the first pixel goes into the least significant bits of the first byte,
+        # and the words are little endian
+        if pixel_format == PixelModes.M_1BPP:
+            nibbles = np.right_shift(buf, 4, out=scratch.reshape(buf.shape))
+            bits = np.equal(nibbles, foreground >> 4, out=scratch.view(np.bool_).reshape(buf.shape))
+            packed[:] = np.packbits(bits, axis=-1, bitorder='little')
 
-        if pixel_format == PixelModes.M_8BPP:
-            rtn = np.zeros((buf.size//2,), dtype=np.uint16)
-            rtn |= buf[1::2]
-            rtn <<= 8
-            rtn |= buf[::2]
+        elif pixel_format == PixelModes.M_8BPP:
+            packed[:] = buf
 
         elif pixel_format == PixelModes.M_2BPP:
-            rtn = np.zeros((buf.size//8,), dtype=np.uint16)
-            for i in range(7, -1, -1):
-                rtn <<= 2
-                rtn |= buf[i::8] >> 6
-
-        elif pixel_format == PixelModes.M_3BPP:
-            rtn = np.zeros((buf.size//4,), dtype=np.uint16)
-            for i in range(3, -1, -1):
-                rtn <<= 4
-                rtn |= (buf[i::4] & 0xFE) >> 4
-
-        elif pixel_format == PixelModes.M_4BPP:
-            rtn = np.zeros((buf.size//4,), dtype=np.uint16)
-            for i in range(3, -1, -1):
-                rtn <<= 4
-                rtn |= buf[i::4] >> 4
+            tmp = scratch[:size].reshape(packed.shape)
+            np.right_shift(groups[..., 0], 6, out=packed)
+            for i in range(1, 4):
+                np.bitwise_and(groups[..., i], 0xC0, out=tmp)
+                tmp >>= 6 - 2 * i
+                packed |= tmp
 
         else:
-            rtn = None
+            # M_4BPP, and M_3BPP which drops the lowest bit of the nibble the controller ignores
+            tmp = scratch[:size].reshape(packed.shape)
+            np.right_shift(groups[..., 0], 4, out=packed)
+            np.bitwise_and(groups[..., 1], 0xF0, out=tmp)
+            packed |= tmp
 
-        return rtn.tolist()
+        return out.view('<u2')
 
     def wait_display_ready(self):
-        while self.read_register(Registers.LUTAFSR):
-            logging.debug('LUTAFSR register says display is not ready')
-            sleep(0.01)
+        """
+        Return once the display engine has finished all refreshes. If LUTAFSR says it is busy,
+        sleeps until the refreshes started by display_area are nearly done according to
+        refresh_model, and polls again then, at the predicted end, and after that at growing
+        intervals.
+        """
+        run_ops(self._wait_display_ready_ops(), self.spi)
+
+    def _wait_display_ready_ops(self):
+        interval = 0.0
+        fraction = READY_EARLY
+        polls = 1
+        busy = None
+        while (yield from self._read_register_ops(Registers.LUTAFSR)):
+            busy = monotonic()
+            yield 'pause', max(interval, self._ready_delay(fraction))
+            fraction = 1.0
+            interval = min(2 * interval, POLL_INTERVAL_MAX) if interval else POLL_INTERVAL
+            polls += 1
+        self._refreshes_done(polls, busy)
+
+    def display_ready(self):
+        """
+        Return whether the display engine has finished all refreshes, without waiting.
+        LUTAFSR is only read once the refreshes started by display_area are predicted to be done.
+        """
+        return run_ops(self._display_ready_ops(), self.spi)
+
+    def _display_ready_ops(self):
+        if self._ready_delay() > 0 or (yield from self._read_register_ops(Registers.LUTAFSR)):
+            return False
+        self._refreshes_done(1, None)
+        return True
+
+    def _ready_delay(self, fraction=1.0):
+        """
+        Return the seconds until fraction of the predicted duration of every running refresh has passed
+        """
+        if not self.refreshes:
+            return 0.0
+        end = max(start + fraction * self.refresh_model.predict(mode, pixels)
+                  for mode, pixels, start in self.refreshes)
+        return end - monotonic()
+
+    def _refreshes_done(self, polls, busy):
+        """
+        Update the statistics and learn the refresh time after waiting for the display.
+        busy is the time of the last poll finding the display busy, or None.
+        """
+        now = monotonic()
+        self.ready_waits += 1
+        self.ready_polls += polls
+        if self.refreshes:
+            # the refreshes ended between the last two polls, the last of them is most likely
+            # the one predicted to end last
+            mode, pixels, start = max(self.refreshes, key=lambda r: r[2] + self.refresh_model.predict(r[0], r[1]))
+            if busy is not None:
+                self.refresh_model.learn(mode, pixels, (busy + now) / 2 - start)
+            elif now - start < self.refresh_model.predict(mode, pixels):
+                # the first poll found them done, they could have ended long before, so the
+                # time since the start only bounds the duration from above
+                self.refresh_model.learn(mode, pixels, now - start)
+        logging.debug('display ready after {:d} polls'.format(polls))
+        self.refreshes = []
+
+    @staticmethod
+    def _load_img_args(endian_type, pixel_format, rotate_mode, xy=None, dims=None):
+        """
+        Return the arguments of LD_IMG, or of LD_IMG_AREA if xy and dims are given
+        """
+        arg0 = (endian_type << 8) | (pixel_format << 4) | rotate_mode
+        if xy is None:
+            return [arg0]
+        return [arg0, xy[0], xy[1], dims[0], dims[1]]
 
     def _load_img_start(self, endian_type, pixel_format, rotate_mode):
         logging.debug('load_img_start')
-        arg = (endian_type << 8) | (pixel_format << 4) | rotate_mode
-        self.spi.write_cmd(Commands.LD_IMG, True, arg)
+        self.spi.send_cmd_arg(Commands.LD_IMG, self._load_img_args(endian_type, pixel_format, rotate_mode))
 
     def _load_img_area_start(self, endian_type, pixel_format, rotate_mode, xy, dims):
-        arg0 = (endian_type << 8) | (pixel_format << 4) | rotate_mode
-        self.spi.send_cmd_arg(Commands.LD_IMG_AREA, [arg0, xy[0], xy[1], dims[0], dims[1]])
+        self.spi.send_cmd_arg(Commands.LD_IMG_AREA,
+                              self._load_img_args(endian_type, pixel_format, rotate_mode, xy, dims))
 
     def _load_img_end(self):
         self.spi.write_cmd_code(Commands.LD_IMG_END)
 
     def read_register(self, address):
         """
-        Read a device register
+        Read a device register. Registers that are not in VOLATILE_REGISTERS are only read
+        from the device if their value is not known yet.
         """
-        self.spi.write_cmd_code(Commands.REG_RD)
-        self.spi.write_data(address, 0.0)
-        return self.spi.read_int()
+        return run_ops(self._read_register_ops(address), self.spi)
+
+    def _read_register_ops(self, address):
+        value = self._shadow_read(address)
+        if value is None:
+            yield 'write_cmd_code', Commands.REG_RD
+            yield 'write_data', address, 0.0
+            value = yield 'read_int',
+            if address not in VOLATILE_REGISTERS:
+                self.registers[address] = value
+        return value
 
     def write_register(self, address, val):
         """
-        Write to a device register
+        Write to a device register. Writes that would not change a register that is not in
+        VOLATILE_REGISTERS are skipped.
+        """
+        run_ops(self._write_register_ops(address, val), self.spi)
+
+    def _write_register_ops(self, address, val):
+        if self._shadow_write(address, val):
+            yield 'write_cmd_code', Commands.REG_WR
+            yield 'write_ndata', [address, val]
+
+    def _shadow_read(self, address):
         """
-        self.spi.write_cmd_code(Commands.REG_WR)
-        self.spi.write_ndata([address, val])
+        Return the shadow value of a register, or None if it has to be read from the device
+        """
+        if address in VOLATILE_REGISTERS:
+            return None
+        value = self.registers.get(address)
+        if value is None:
+            self.register_misses += 1
+        else:
+            self.register_hits += 1
+        return value
+
+    def _shadow_write(self, address, val):
+        """
+        Store val in the shadow of a register, and return whether it has to be written to the device
+        """
+        if address in VOLATILE_REGISTERS:
+            return True
+        val = int(val) & 0xFFFF
+        if self.registers.get(address) == val:
+            self.register_hits += 1
+            return False
+        self.register_misses += 1
+        self.registers[address] = val
+        return True
+
+    def invalidate_registers(self):
+        """
+        Forget the shadow registers, e.g. after the controller was reset by other means
+        """
+        self.registers = {}
+        self.vcom_shadow = None
 
     def _set_img_buf_base_addr(self, address):
+        run_ops(self._img_buf_base_addr_ops(address), self.spi)
+
+    def _img_buf_base_addr_ops(self, address):
         word_h = (address >> 16) & 0x0000FFFF
         word_l = address & 0x0000FFFF
-        self.write_register(Registers.LISAR+2, word_h)
-        self.write_register(Registers.LISAR, word_l)
+        yield from self._write_register_ops(Registers.LISAR+2, word_h)
+        yield from self._write_register_ops(Registers.LISAR, word_l)
 
     def active(self):
         self.spi.write_cmd_code(Commands.SYS_RUN, 1.0)
@@ -1,45 +1,168 @@
+import ctypes
+import fcntl
 import logging
 import time
 from threading import Event
 
-from .constants import Pins
+from .constants import Commands, Pins
 
-import RPi.GPIO as GPIO
+import numpy as np
+
+# the IT8951 expects every 16-bit word most significant byte first
+WORD = np.dtype('>u2')
+
+# spidev parameters, see linux/spi/spidev.h
+SPI_IOC_MAGIC = ord('k')
+SPIDEV_BUFSIZ = '/sys/module/spidev/parameters/bufsiz'
+
+
+class SpiIocTransfer(ctypes.Structure):
+    """
+    One segment of a SPI_IOC_MESSAGE ioctl (struct spi_ioc_transfer)
+    """
+    _fields_ = [
+        ('tx_buf', ctypes.c_uint64),
+        ('rx_buf', ctypes.c_uint64),
+        ('len', ctypes.c_uint32),
+        ('speed_hz', ctypes.c_uint32),
+        ('delay_usecs', ctypes.c_uint16),
+        ('bits_per_word', ctypes.c_uint8),
+        ('cs_change', ctypes.c_uint8),
+        ('tx_nbits', ctypes.c_uint8),
+        ('rx_nbits', ctypes.c_uint8),
+        ('word_delay_usecs', ctypes.c_uint8),
+        ('pad', ctypes.c_uint8),
+    ]
+
+
+def spi_ioc_message(n):
+    """
+    Return the request code of SPI_IOC_MESSAGE(n), an ioctl transferring n segments
+    """
+    size = n * ctypes.sizeof(SpiIocTransfer)
+    if size >= 1 << 14:
+        size = 0
+    # _IOW(SPI_IOC_MAGIC, 0, char[size])
+    return (1 << 30) | (size << 16) | (SPI_IOC_MAGIC << 8)
+
+
+class BufferPool:
+    """
+    Named arrays that are reused for every transfer instead of being allocated each time.
+    Reserve them up front, e.g. for the largest update of a panel, so that updates do not
+    allocate at all.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+        # number of arrays allocated, to check that updates stay within the reserved sizes
+        self.allocations = 0
+
+    def reserve(self, name, size, dtype=np.ubyte):
+        """
+        Make sure the array name holds at least size elements of dtype
+        """
+        self.get(name, size, dtype)
+
+    def get(self, name, size, dtype=np.ubyte):
+        """
+        Return a flat array of size elements of dtype, the start of the array name. Its
+        contents are undefined, and it is overwritten by the next get of name.
+        """
+        dtype = np.dtype(dtype)
+        array = self.arrays.get(name)
+        if array is None or array.dtype != dtype or array.size < size:
+            array = np.empty(size, dtype=dtype)
+            self.arrays[name] = array
+            self.allocations += 1
+        return array[:size]
 
 
 class SPI:
 
     MAX_BUFFER_SIZE = 1024
 
-    def __init__(self):
-        import spidev
+    # the size of SPI_IOC_MESSAGE is limited to 14 bits
+    MAX_SEGMENTS = ((1 << 14) - 1) // ctypes.sizeof(SpiIocTransfer)
+
+    def __init__(self, batch_transfers=False, device=None, gpio=None, batch_args=False, reset=True,
+                 message_size=None):
+        """
+        :param batch_transfers: send the chunks of SPI.write_ndata as segments of one
+            SPI_IOC_MESSAGE ioctl instead of one transfer and HRDY handshake per chunk.
+            Chunks are made small enough that at least two fit into message_size.
+        :param device: object with the interface of spidev.SpiDev to transfer data with.
+            Defaults to spidev.SpiDev(0, 1).
+        :param gpio: module or object with the interface of RPi.GPIO used for the HRDY
+            and RESET pins. Defaults to RPi.GPIO.
+        :param batch_args: send the arguments of SPI.send_cmd_arg in one transfer instead
+            of one transfer and HRDY handshake per argument, if SPI.args_batched finds that
+            the controller takes them. Opt-in, it has only been checked against the emulator.
+        :param reset: reset the controller. False leaves a running controller alone, see
+            SPI.reset and the cache parameter of EPD.
+        :param message_size: the most bytes spidev takes in one SPI_IOC_MESSAGE, defaults to
+            SPI.max_message_size(). With the default spidev.bufsiz of 4096 bytes an ioctl
+            carries two chunks, raise it to batch more.
+        """
+        if device is None:
+            import spidev
+            device = spidev.SpiDev(0, 1)
+        if gpio is None:
+            import RPi.GPIO as gpio
 
         self.ready = Event()
         self.debug = False
         self.count = 0
+        self.batch_transfers = batch_transfers
+        self.batch_args = batch_args
+        self.batch_args_probed = False
+        self.ioctl_count = 0
+        self.resets = 0
+
+        # words per chunk and chunks per ioctl of batched transfers
+        if message_size is None:
+            message_size = self.max_message_size()
+        self.message_size = message_size
+        self.batch_chunk = min(self.MAX_BUFFER_SIZE, message_size // 4 - 1)
+        self.batch_segments = min(self.MAX_SEGMENTS, message_size // (2 * (self.batch_chunk + 1)))
+        if batch_transfers and self.batch_chunk < 1:
+            logging.warning('SPI messages of {:d} bytes are too small for batched transfers'.format(message_size))
+            self.batch_transfers = False
 
-        self.spi = spidev.SpiDev(0, 1)
+        # buffers of the pack, encode and chunk stages, reused across updates
+        self.pool = BufferPool()
+        self.pool.reserve('chunk', self.MAX_BUFFER_SIZE + 1, WORD)
+
+        self.spi = device
         # raising the frequency does not make data transfer faster
         self.spi.max_speed_hz = 4000000  # maximum 12MHz
         self.spi.mode = 0b00
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(True)
-        GPIO.setup(Pins.HRDY, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(Pins.RESET, GPIO.OUT, initial=GPIO.HIGH)
+        self.gpio = gpio
+        self.gpio.setmode(gpio.BCM)
+        self.gpio.setwarnings(True)
+        self.gpio.setup(Pins.HRDY, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+        self.gpio.setup(Pins.RESET, gpio.OUT, initial=gpio.HIGH)
+
+        self.gpio.add_event_detect(Pins.HRDY, gpio.RISING, self.ready_pin)
 
-        GPIO.add_event_detect(Pins.HRDY, GPIO.RISING, self.ready_pin)
+        if reset:
+            self.reset()
 
-        # reset
+    def reset(self):
+        """
+        Pulse the RESET pin and wait for the controller to get ready
+        """
         # logging.debug('Reset')
-        GPIO.output(Pins.RESET, GPIO.LOW)
+        self.gpio.output(Pins.RESET, self.gpio.LOW)
         time.sleep(0.1)
         self.prime_ready()
-        GPIO.output(Pins.RESET, GPIO.HIGH)
+        self.gpio.output(Pins.RESET, self.gpio.HIGH)
         self.wait_ready(2.0)
+        self.resets += 1
 
     def __del__(self):
-        GPIO.cleanup()
+        self.gpio.cleanup()
         self.spi.close()
 
     def ready_pin(self, channel):
@@ -52,38 +175,142 @@ class SPI:
         self.ready.clear()
 
     def wait_ready(self, timeout=1.0):
+        """
+        Wait for the rising edge of HRDY.
+        :return: False if the controller did not get ready within timeout.
+        """
         if timeout == 0.0:
-            return
+            return True
         start = time.time()
         if self.ready.wait(timeout):
-            return
+            return True
         logging.error('{:1.3f}'.format(time.time() - start))
+        return False
 
     def write(self, preamble, ary):
         """
         Send preamble, and then write the data in ary (16-bit unsigned ints) over SPI
         """
-        buf = [preamble]
-        if ary:
-            buf = buf + ary
-        self.xfer3(buf)
+        if ary is None:
+            ary = ()
+        words = self._as_words(ary)
+        buf = self.pool.get('write', words.size + 1, WORD)
+        buf[0] = preamble
+        buf[1:] = words
+        self._send(buf)
+
+    def _send(self, buf):
+        """
+        Send the WORD array buf in one transfer, ignoring the data received. Devices with
+        writebytes2 take the array as it is, without encoding it into a new buffer.
+        """
+        writebytes2 = getattr(self.spi, 'writebytes2', None)
+        if writebytes2 is not None:
+            writebytes2(buf.view(np.ubyte))
+        else:
+            self.spi.xfer3(buf.tobytes())
 
     def write_pixels(self, pixbuf):
         """
         Write the pixels in pixbuf to the device. Pixbuf should be an array of
-        16-bit ints, containing packed pixel information.
+        16-bit ints, containing packed pixel information. Any input accepted by
+        SPI.xfer3 can be used.
         """
         self.write(0x0000, pixbuf)
 
     def write_ndata(self, data, timeout=1.0):
-        for i in range(0, len(data), self.MAX_BUFFER_SIZE):
-            end = i + self.MAX_BUFFER_SIZE
-            if end > len(data):
-                end = len(data)
+        """
+        Write data words to the controller in chunks of at most MAX_BUFFER_SIZE words.
+        :param data: 16-bit words, see SPI.xfer3 for the accepted types.
+        :param timeout: default 1.0 seconds
+        """
+        words = self._as_words(data)
+        if self.batch_transfers and words.size > self.batch_chunk:
+            self._write_ndata_batched(words, timeout)
+            return
+        buf = self.pool.get('chunk', self.MAX_BUFFER_SIZE + 1, WORD)
+        buf[0] = 0x0000
+        for i in range(0, words.size, self.MAX_BUFFER_SIZE):
+            chunk = words[i:i + self.MAX_BUFFER_SIZE]
+            buf[1:chunk.size + 1] = chunk
             self.prime_ready()
-            self.xfer3([0x0000] + data[i:end])
+            self._send(buf[:chunk.size + 1])
             self.wait_ready(timeout)
 
+    def _write_ndata_batched(self, words, timeout):
+        """
+        Write words in chunks of batch_chunk words, each with its own preamble and chip
+        select cycle. Up to batch_segments chunks are sent with a single ioctl, followed
+        by one HRDY handshake. If the controller does not get ready after a batch it
+        needs a handshake per chunk, and if spidev rejects the ioctl the message is too
+        large, so in both cases batching is switched off for later writes.
+        """
+        size = self.batch_chunk
+        segments = self.batch_segments
+        chunks = -(-words.size // size)
+        full = (chunks - 1) * size
+        buf = self.pool.get('batch', chunks * (size + 1), WORD)
+        buf = buf.reshape(chunks, size + 1)
+        buf[:, 0] = 0x0000
+        buf[:-1, 1:] = words[:full].reshape(chunks - 1, size)
+        buf[-1, 1:words.size - full + 1] = words[full:]
+        lengths = np.full(chunks, 2 * (size + 1))
+        lengths[-1] = 2 * (words.size - full + 1)
+
+        first = 0
+        while first < chunks:
+            if not self.batch_transfers:
+                for i in range(first, chunks):
+                    self.prime_ready()
+                    self._send(buf[i, :lengths[i] // 2])
+                    self.wait_ready(timeout)
+                return
+            last = min(first + segments, chunks)
+            transfers = (SpiIocTransfer * (last - first))()
+            for i, transfer in enumerate(transfers):
+                transfer.tx_buf = buf.ctypes.data + (first + i) * buf.strides[0]
+                transfer.len = int(lengths[first + i])
+                transfer.speed_hz = self.spi.max_speed_hz
+                transfer.bits_per_word = 8
+                # release chip select between segments, but not after the last one
+                transfer.cs_change = 1 if i < len(transfers) - 1 else 0
+            self.prime_ready()
+            try:
+                self._ioctl(spi_ioc_message(len(transfers)), transfers)
+            except OSError as e:
+                # nothing was sent, the batch goes out chunk by chunk
+                logging.warning('batched transfer of {:d} bytes failed: {}. Raise spidev.bufsiz or pass a smaller '
+                                'message_size'.format(int(lengths[first:last].sum()), e))
+                self.batch_transfers = False
+                continue
+            if not self.wait_ready(timeout):
+                logging.warning('controller not ready after batched transfer, using HRDY handshake per chunk')
+                self.batch_transfers = False
+            first = last
+
+    def _ioctl(self, request, arg):
+        """
+        Issue an ioctl on the spidev device. Backends that are not backed by a device
+        file can handle the request themselves by providing an ioctl(request, arg) method.
+        """
+        self.ioctl_count += 1
+        ioctl = getattr(self.spi, 'ioctl', None)
+        if ioctl is not None:
+            return ioctl(request, arg)
+        return fcntl.ioctl(self.spi.fileno(), request, arg)
+
+    @staticmethod
+    def max_message_size():
+        """
+        Return the maximum number of bytes spidev accepts in one SPI_IOC_MESSAGE.
+        It can be raised with the spidev.bufsiz kernel parameter.
+        """
+        try:
+            with open(SPIDEV_BUFSIZ) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 4096
+
     def write_data(self, us_data, timeout=1.0):
         """
         Write a single data value to the controller.
@@ -91,7 +318,7 @@ class SPI:
         :param timeout: default 1.0 seconds
         """
         self.prime_ready()
-        self.xfer3([0x0000, us_data])
+        self._send_word(0x0000, us_data)
         self.wait_ready(timeout)
 
     def write_cmd_code(self, cmd_code, timeout=0.0):
@@ -101,9 +328,15 @@ class SPI:
         :param timeout: set value to non-zero to enable checking the interrupt line after sending the command code.
         """
         self.prime_ready()
-        self.xfer3([0x6000, cmd_code])
+        self._send_word(0x6000, cmd_code)
         self.wait_ready(timeout)
 
+    def _send_word(self, preamble, word):
+        buf = self.pool.get('word', 2, WORD)
+        buf[0] = preamble
+        buf[1] = word
+        self._send(buf)
+
     def send_cmd_arg(self, cmd_code, args, timeout=1.0):
         """
         Write a command code with arguments to the controller.
@@ -111,23 +344,48 @@ class SPI:
         :param args: arguments to sent.
         :param timeout: default 1.0 seconds
         """
+        batched = len(args) > 1 and self.args_batched()
         self.write_cmd_code(cmd_code)
+        if batched:
+            self.prime_ready()
+            self.write(0x0000, args)
+            self.wait_ready(timeout)
+            return
         for arg in args:
             self.write_data(arg, timeout)
 
+    def args_batched(self):
+        """
+        Return whether the arguments of a command are sent in one transfer. If batch_args is
+        set, the first call checks that the controller takes them with MEM_BST_RD_T of an empty
+        burst, which reads nothing, and switches batch_args off if it does not get ready. Real
+        commands are never sent twice.
+        """
+        if self.batch_args and not self.batch_args_probed:
+            self.batch_args_probed = True
+            self.write_cmd_code(Commands.MEM_BST_RD_T)
+            self.prime_ready()
+            self.write(0x0000, [0, 0, 0, 0])
+            if not self.wait_ready():
+                logging.warning('controller not ready after the arguments of a command in one transfer, '
+                                'sending arguments one by one')
+                self.batch_args = False
+            self.write_cmd_code(Commands.MEM_BST_END)
+        return self.batch_args
+
     def read(self, preamble, count, debug=False):
         """
         Send preamble, and return a buffer of 16-bit unsigned ints of length count
         containing the data received
         """
-        send = [preamble]
         # spec says to read two dummy bytes, therefore count + 1
-        for i in range(count + 1):
-            send.append(0)
+        send = self.pool.get('read', count + 2, WORD)
+        send[:] = 0
+        send[0] = preamble
         self.prime_ready()
         data = self.xfer3(send, debug)
         self.wait_ready()
-        return data[2:]
+        return data[2:].tolist()
 
     def read_data(self, n, debug=False):
         """
@@ -149,18 +407,34 @@ class SPI:
         """
         return self.read_data(1)[0]
 
+    def read_ndata(self, n, timeout=1.0):
+        """
+        Read n data words from the device in chunks of at most MAX_BUFFER_SIZE words, each
+        with its own preamble and dummy word.
+        :return: NumPy array of the words
+        """
+        data = np.empty(n, dtype=np.uint16)
+        send = self.pool.get('read', self.MAX_BUFFER_SIZE + 2, WORD)
+        send[:] = 0
+        send[0] = 0x1000
+        for i in range(0, n, self.MAX_BUFFER_SIZE):
+            count = min(self.MAX_BUFFER_SIZE, n - i)
+            self.prime_ready()
+            data[i:i + count] = self.xfer3(send[:count + 2])[2:]
+            self.wait_ready(timeout)
+        return data
+
     def xfer3(self, data, debug=False):
         """
         Transfer 16-bit words of data to and from the device
-        :param data: data to transfer to the device
+        :param data: data to transfer to the device. Either a sequence of ints, a NumPy
+            array of words or a bytes-like object (bytes, bytearray, memoryview) holding
+            16-bit words in host byte order.
         :param debug: True for debugging received data
-        :return: data received from the device
+        :return: data received from the device as NumPy array of 16-bit words
         """
         # logging.debug('transfer start')
         tosend = self.unsignedshort2bytes(data)
-        # for x in tosend:
-        #     logging.debug(type(x))
-        #     logging.debug(x)
         received = self.spi.xfer3(tosend)
         if debug:
             logging.debug(received)
@@ -168,17 +442,29 @@ class SPI:
         # logging.debug('transfer end')
         return rtn
 
+    @staticmethod
+    def _as_words(data):
+        """
+        Return data as a flat NumPy array of 16-bit words without copying where possible.
+        Bytes-like objects are interpreted as words in host byte order.
+        """
+        if isinstance(data, np.ndarray):
+            return data.reshape(-1)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return np.frombuffer(data, dtype=np.uint16)
+        return np.asarray(data, dtype=np.uint16)
+
     @staticmethod
     def unsignedshort2bytes(data):
-        retval = [None] * (len(data) * 2)
-        for i in range(0, len(data)):
-            retval[i * 2] = data[i] >> 8
-            retval[i * 2 + 1] = data[i] & 0xFF
-        return retval
+        """
+        Encode 16-bit words as big-endian bytes. The byte swap is done in one
+        vectorized step, words already stored big-endian are not copied before encoding.
+        """
+        return np.asarray(SPI._as_words(data), dtype=WORD).tobytes()
 
     @staticmethod
     def bytes2unsignedshort(data):
-        retval = [None] * (len(data) // 2)
-        for i in range(0, len(data) // 2):
-            retval[i] = (data[i * 2] << 8) + data[i * 2 + 1]
-        return retval
+        """
+        Decode big-endian bytes into a NumPy array of 16-bit words
+        """
+        return np.frombuffer(bytes(data), dtype=WORD).astype(np.uint16)
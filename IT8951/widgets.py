@@ -0,0 +1,217 @@
+"""
+Retained mode widgets for an AutoDisplay.
+
+Every widget owns a box of frame_buf and keeps the value it shows. Setting a value only
+marks the widget as changed, WidgetLayer.update() then lets the changed widgets draw
+themselves and hands their damage boxes to draw_partial, so only these boxes are
+compared and uploaded instead of diffing the whole frame.
+
+    layer = WidgetLayer(display)
+    speed = layer.add(Label((282, 165, 522, 205), 'fonts/Arial_Black.ttf', 32))
+    torque = layer.add(BarGauge((19, 429, 745, 506), maximum=130, fill=0x70))
+    layer.update(DisplayModes.GC16)
+    ...
+    speed.set('38 km/h')
+    torque.set(70)
+    layer.update(DisplayModes.DU)
+"""
+
+from PIL import ImageDraw
+
+from .constants import DisplayModes
+from .display import TextRenderer
+
+
+class Widget:
+    """
+    Base class of the widgets. Derived classes implement draw(), which draws the widget
+    into frame_buf and returns the boxes it changed.
+
+    Parameters
+    ----------
+
+    box : (int, int, int, int)
+        The box of frame_buf the widget owns, as (minx, miny, maxx, maxy)
+
+    value : optional
+        The initial value
+    """
+
+    def __init__(self, box, value=None):
+        self.box = tuple(int(v) for v in box)
+        self.value = value
+        # the value that is in frame_buf, None until the widget was drawn
+        self.drawn = None
+        self.changed = True
+        self.layer = None
+
+    def set(self, value):
+        """
+        Show value from the next update on, nothing is drawn if it did not change
+        """
+        if value != self.value:
+            self.value = value
+            self.changed = True
+
+    def invalidate(self):
+        """
+        Draw the whole widget on the next update, e.g. after frame_buf was overwritten
+        """
+        self.drawn = None
+        self.changed = True
+
+    def render(self, frame_buf):
+        """
+        Draw the widget into frame_buf if it changed, and return the damaged boxes
+        """
+        if not self.changed:
+            return []
+        damage = self.draw(frame_buf)
+        self.drawn = self.value
+        self.changed = False
+        return damage
+
+    def draw(self, frame_buf):
+        raise NotImplementedError
+
+
+class Rectangle(Widget):
+    """
+    A filled rectangle with an optional outline, e.g. the frame of a group of widgets.
+    The value is not used.
+    """
+
+    def __init__(self, box, fill=0xFF, outline=None, width=1):
+        Widget.__init__(self, box)
+        self.fill = fill
+        self.outline = outline
+        self.width = width
+
+    def draw(self, frame_buf):
+        minx, miny, maxx, maxy = self.box
+        ImageDraw.Draw(frame_buf).rectangle([minx, miny, maxx - 1, maxy - 1], self.fill, self.outline, self.width)
+        return [self.box]
+
+
+class Label(Widget):
+    """
+    A line of text (the value), drawn with the TextRenderer of its layer and cut to the box.
+    align places the text at the left or right edge or in the center of the box.
+    """
+
+    def __init__(self, box, font, size, value='', fill=0x00, background=0xFF, align='left'):
+        Widget.__init__(self, box, value)
+        self.font = font
+        self.size = size
+        self.fill = fill
+        self.background = background
+        self.align = align
+
+    def draw(self, frame_buf):
+        minx, miny, maxx, maxy = self.box
+        frame_buf.paste(self.background, self.box)
+        image, anchor = self.layer.text.render(str(self.value), self.font, self.size, self.fill,
+                                               self.background, self.align)
+        x = {'left': minx, 'center': (minx + maxx) // 2, 'right': maxx}[self.align] - anchor
+
+        # the part of the strip inside the box
+        left, right = max(minx - x, 0), min(maxx - x, image.size[0])
+        bottom = min(maxy - miny, image.size[1])
+        if left < right and bottom > 0:
+            frame_buf.paste(image.crop((left, 0, right, bottom)), (x + left, miny))
+        return [self.box]
+
+
+class BarGauge(Widget):
+    """
+    A horizontal bar growing from the left edge of the box with the value between minimum
+    and maximum. Changes of the value only draw and report the strip between the old and
+    the new end of the bar.
+    """
+
+    def __init__(self, box, minimum=0.0, maximum=100.0, value=None, fill=0x00, background=0xFF):
+        Widget.__init__(self, box, minimum if value is None else value)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fill = fill
+        self.background = background
+
+    def length(self, value):
+        """
+        Return the length of the bar in pixels for value
+        """
+        width = self.box[2] - self.box[0]
+        fraction = (value - self.minimum) / (self.maximum - self.minimum)
+        return int(round(min(max(fraction, 0.0), 1.0) * width))
+
+    def draw(self, frame_buf):
+        minx, miny, maxx, maxy = self.box
+        end = minx + self.length(self.value)
+        if self.drawn is None:
+            frame_buf.paste(self.background, self.box)
+            if end > minx:
+                frame_buf.paste(self.fill, (minx, miny, end, maxy))
+            return [self.box]
+
+        previous = minx + self.length(self.drawn)
+        if end == previous:
+            return []
+        if end > previous:
+            strip = (previous, miny, end, maxy)
+            frame_buf.paste(self.fill, strip)
+        else:
+            strip = (end, miny, previous, maxy)
+            frame_buf.paste(self.background, strip)
+        return [strip]
+
+
+class WidgetLayer:
+    """
+    The widgets on an AutoDisplay. Widgets should not overlap, each one draws its box
+    without looking at the others.
+
+    Parameters
+    ----------
+
+    display : AutoDisplay
+        The display whose frame_buf the widgets draw into
+
+    text : TextRenderer, optional
+        The renderer of the labels, defaults to a new one
+    """
+
+    def __init__(self, display, text=None):
+        self.display = display
+        self.text = text if text is not None else TextRenderer(display)
+        self.widgets = []
+
+    def add(self, widget):
+        """
+        Add widget to the layer and return it
+        """
+        widget.layer = self
+        self.widgets.append(widget)
+        return widget
+
+    def invalidate(self):
+        """
+        Draw all widgets on the next update
+        """
+        for widget in self.widgets:
+            widget.invalidate()
+
+    def render(self):
+        """
+        Draw the changed widgets into frame_buf and return the damaged boxes
+        """
+        damage = []
+        for widget in self.widgets:
+            damage += widget.render(self.display.frame_buf)
+        return damage
+
+    def update(self, mode=DisplayModes.AUTO, pixel_format=None):
+        """
+        Draw the changed widgets and send only their damaged boxes with draw_partial.
+        Returns what draw_partial returns, e.g. a coroutine for AsyncEPDDisplay.
+        """
+        return self.display.draw_partial(mode, pixel_format, self.render())
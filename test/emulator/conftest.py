@@ -0,0 +1,36 @@
+"""
+Tests of the driver against the software controller in IT8951.emulator, they need
+neither a Raspberry Pi nor a panel:
+
+    python -m pytest test/emulator
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from IT8951.emulator import IT8951Emulator  # noqa: E402
+
+
+@pytest.fixture
+def emulator():
+    return IT8951Emulator(width=800, height=600, time_scale=0.0)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(8951)
+
+
+@pytest.fixture
+def font():
+    # a TrueType font of the integration tests, which git lfs checks out
+    path = os.path.join(os.path.dirname(__file__), '..', 'integration', 'fonts', 'FreeSans.ttf')
+    with open(path, 'rb') as f:
+        if f.read(4) not in (b'\x00\x01\x00\x00', b'true'):
+            pytest.skip('{} is not checked out from git lfs'.format(path))
+    return path
@@ -0,0 +1,44 @@
+import asyncio
+import warnings
+
+import numpy as np
+
+from IT8951.aio import AsyncEPD, AsyncEPDDisplay, AsyncSPI
+from IT8951.constants import DisplayModes, PixelModes
+
+
+def test_async_display(emulator):
+    async def main():
+        spi = AsyncSPI(device=emulator.spidev, gpio=emulator.gpio)
+        display = AsyncEPDDisplay(epd=AsyncEPD(spi=spi))
+        await display.clear()
+        await display.wait_display_ready()
+
+        display.frame_buf.paste(0x00, (32, 40, 96, 80))
+        await display.draw_partial(DisplayModes.DU)
+        # black and white on an idle panel goes out as bitmap
+        assert display.refreshing_bitmap
+        np.testing.assert_array_equal(emulator.panel >> 4, np.asarray(display.frame_buf) >> 4)
+
+        pixels = np.full((600, 800), 0x55, dtype=np.uint8)
+        await display.store_slot('gray', pixels, PixelModes.M_4BPP)
+        await display.show_slot('gray')
+        np.testing.assert_array_equal(emulator.panel >> 4, pixels >> 4)
+        await display.wait_display_ready()
+        assert not display.refreshing
+
+    asyncio.run(main())
+    assert emulator.errors == []
+
+
+def test_async_warm_attach(emulator, tmp_path):
+    cache = str(tmp_path / 'it8951.json')
+    cold = emulator.epd(cache=cache)
+    cold.sleep()
+    assert emulator.state == 'sleep'
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        warm = AsyncEPD(spi=AsyncSPI(device=emulator.spidev, gpio=emulator.gpio, reset=False), cache=cache)
+    assert warm.spi.resets == 0
+    assert emulator.state == 'run'
@@ -0,0 +1,149 @@
+import json
+import time
+
+import numpy as np
+
+from IT8951.constants import Commands, DisplayModes, PixelModes, Registers
+from IT8951.display import AutoEPDDisplay
+from IT8951.emulator import UP1SR_BITMAP, IT8951Emulator
+
+
+def test_device_info(emulator):
+    epd = emulator.epd(vcom=-2.06)
+    assert (epd.width, epd.height) == (800, 600)
+    assert epd.img_buf_address == emulator.img_buf_address
+    assert epd.firmware_version.rstrip('\0') == emulator.firmware_version
+    assert epd.lut_version.rstrip('\0') == emulator.lut_version
+    assert emulator.vcom == 2060
+    assert emulator.registers[Registers.I80CPCR] == 0x1
+    assert emulator.hrdy_violations == 0
+
+
+def test_warm_attach(emulator, tmp_path):
+    cache = str(tmp_path / 'it8951.json')
+    cold = emulator.epd(vcom=-2.06, cache=cache)
+    assert cold.spi.resets == 1
+    assert json.load(open(cache))['img_buf_address'] == emulator.img_buf_address
+
+    # an earlier process left the display engine in 1bpp mode
+    cold.load_img_area(np.zeros((8, 32), dtype=np.uint8), xy=(0, 0), dims=(32, 8), pixel_format=PixelModes.M_1BPP)
+    emulator.reset_stats()
+
+    warm = emulator.epd(vcom=-2.06, cache=cache)
+    assert warm.spi.resets == 0
+    assert emulator.commands[Commands.GET_DEV_INFO] == 0
+    assert emulator.commands[Commands.VCOM] == 0
+    assert (warm.width, warm.height, warm.img_buf_address) == (cold.width, cold.height, cold.img_buf_address)
+    assert not emulator.registers[Registers.UP1SR + 2] & UP1SR_BITMAP
+
+
+def test_attach_after_reset(emulator, tmp_path):
+    cache = str(tmp_path / 'it8951.json')
+    emulator.epd(cache=cache)
+    # the controller lost its setup, e.g. after a power cycle
+    emulator.power_on()
+    emulator.reset_stats()
+
+    epd = emulator.epd(cache=cache)
+    assert epd.spi.resets == 1
+    assert emulator.commands[Commands.GET_DEV_INFO] == 1
+    assert emulator.registers[Registers.I80CPCR] == 0x1
+
+
+def test_stale_cache(emulator, tmp_path):
+    cache = tmp_path / 'it8951.json'
+    cache.write_text('{"width": 800')
+    epd = emulator.epd(cache=str(cache))
+    assert epd.spi.resets == 1
+    assert json.loads(cache.read_text())['width'] == 800
+
+
+def test_register_shadow(emulator):
+    epd = emulator.epd()
+    emulator.reset_stats()
+    hits, misses = epd.register_hits, epd.register_misses
+
+    # writes that would not change a register are skipped
+    epd.write_register(Registers.BGVR, 0x1234)
+    epd.write_register(Registers.BGVR, 0x1234)
+    assert emulator.commands[Commands.REG_WR] == 1
+    epd.write_register(Registers.BGVR, 0x5678)
+    assert emulator.commands[Commands.REG_WR] == 2
+    assert emulator.registers[Registers.BGVR] == 0x5678
+    assert epd.read_register(Registers.BGVR) == 0x5678
+    assert emulator.commands[Commands.REG_RD] == 0
+    assert (epd.register_hits - hits, epd.register_misses - misses) == (2, 2)
+
+    # forgotten registers are read once
+    epd.invalidate_registers()
+    assert epd.read_register(Registers.BGVR) == 0x5678
+    assert epd.read_register(Registers.BGVR) == 0x5678
+    assert emulator.commands[Commands.REG_RD] == 1
+    assert (epd.register_hits - hits, epd.register_misses - misses) == (3, 3)
+
+    # volatile registers always go to the device, and are not counted
+    emulator.registers[Registers.MCSR] = 0x0011
+    assert epd.read_register(Registers.MCSR) == 0x0011
+    emulator.registers[Registers.MCSR] = 0x0022
+    assert epd.read_register(Registers.MCSR) == 0x0022
+    value = epd.read_register(Registers.UP1SR + 2)
+    epd.write_register(Registers.UP1SR + 2, value)
+    epd.write_register(Registers.UP1SR + 2, value)
+    assert emulator.commands[Commands.REG_RD] == 4
+    assert emulator.commands[Commands.REG_WR] == 4
+    assert (epd.register_hits - hits, epd.register_misses - misses) == (3, 3)
+    assert emulator.errors == []
+
+
+def test_batch_args_opt_in(emulator):
+    # nothing is probed unless asked for
+    epd = emulator.epd()
+    assert not epd.spi.batch_args
+    assert emulator.commands[Commands.MEM_BST_RD_T] == 0
+    epd.display_area((0, 0), (64, 64), DisplayModes.DU)
+    assert emulator.updates == [(0, 0, 64, 64, DisplayModes.DU)]
+
+
+def test_batch_args_fallback():
+    emulator = IT8951Emulator(width=800, height=600, time_scale=0.0, batch_args=False)
+    display = AutoEPDDisplay(epd=emulator.epd(batch_args=True))
+    display.clear()
+    display.frame_buf.paste(0x00, (40, 40, 200, 120))
+    display.draw_partial(DisplayModes.DU)
+
+    assert not display.epd.spi.batch_args
+    # the probe found out, every command ran once
+    assert emulator.commands[Commands.DPY_AREA] == len(emulator.updates) == 2
+    np.testing.assert_array_equal(emulator.panel >> 4, np.asarray(display.frame_buf) >> 4)
+    assert emulator.errors == []
+
+
+def test_refresh_model_first_poll(emulator):
+    epd = emulator.epd()
+    model = epd.refresh_model
+    a2 = model.predict(DisplayModes.A2, 800 * 600)
+
+    # found done by the first poll long after the refresh ended, which tells nothing
+    epd.display_area((0, 0), (800, 600), DisplayModes.A2)
+    time.sleep(0.3)
+    epd.wait_display_ready()
+    assert model.predict(DisplayModes.A2, 800 * 600) == a2
+
+    # but done sooner than predicted lowers the prediction
+    epd.display_area((0, 0), (800, 600), DisplayModes.A2)
+    epd.wait_display_ready()
+    assert model.predict(DisplayModes.A2, 800 * 600) < a2
+    assert epd.ready_polls == epd.ready_waits == 2
+
+
+def test_slow_hrdy_after_batched_args():
+    emulator = IT8951Emulator(width=800, height=600, time_scale=0.0, hrdy_delay=0.05)
+    epd = emulator.epd(batch_args=True)
+    assert epd.spi.batch_args
+
+    # HRDY rises later than the caller waits, e.g. while the LUTs are busy
+    epd.spi.send_cmd_arg(Commands.DPY_AREA, [0, 0, 64, 64, DisplayModes.DU], timeout=0.01)
+    time.sleep(0.1)
+    assert emulator.commands[Commands.DPY_AREA] == 1
+    assert emulator.updates == [(0, 0, 64, 64, DisplayModes.DU)]
+    assert epd.spi.batch_args
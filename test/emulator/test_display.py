@@ -0,0 +1,281 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from IT8951.constants import DisplayModes, PixelModes, Rotate
+from IT8951.display import AutoEPDDisplay, PipelinedEPDDisplay, Quantizer, TextRenderer, UpdateScheduler
+from IT8951.emulator import IT8951Emulator
+
+TURNS = {
+    Rotate.NONE: 0,
+    Rotate.CW: -1,
+    Rotate.CCW: 1,
+    Rotate.FLIP: 2,
+}
+
+
+def shown(emulator, display):
+    """
+    Return the gray levels of frame_buf and of the panel, both in device orientation
+    """
+    frame = np.rot90(np.asarray(display.frame_buf), TURNS[display.rotate])
+    return frame >> 4, emulator.panel >> 4
+
+
+@pytest.mark.parametrize('rotate', sorted(TURNS))
+@pytest.mark.parametrize('pixel_format', [PixelModes.AUTO, PixelModes.M_4BPP, PixelModes.M_8BPP])
+def test_draw_partial(emulator, rotate, pixel_format):
+    display = AutoEPDDisplay(epd=emulator.epd(), rotate=rotate, pixel_format=pixel_format)
+    display.clear()
+    assert (display.width, display.height) == ((600, 800) if rotate in (Rotate.CW, Rotate.CCW) else (800, 600))
+
+    display.frame_buf.paste(0x00, (10, 20, 110, 70))
+    display.frame_buf.paste(0x80, (300, 500, 420, 560))
+    display.draw_partial(DisplayModes.GC16)
+
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+    assert 1 <= len(emulator.updates) - 1 <= 2
+    assert emulator.errors == []
+
+
+@pytest.mark.parametrize('rotate', sorted(TURNS))
+def test_panel_height_not_word_aligned(rotate):
+    emulator = IT8951Emulator(width=1024, height=758, time_scale=0.0)
+    display = AutoEPDDisplay(epd=emulator.epd(), rotate=rotate)
+    display.clear()
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+
+    # gray levels at the right edge of the frame, sent as 4bpp
+    display.frame_buf.paste(0x80, (display.width - 30, 100, display.width, 140))
+    display.frame_buf.paste(0x40, (display.width - 20, 110, display.width, 130))
+    display.draw_partial(DisplayModes.AUTO)
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+    assert emulator.errors == []
+
+
+def test_draw_full(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.frame_buf.paste(0x40, (0, 0, 400, 600))
+    display.draw_full(DisplayModes.GC16)
+
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+    assert emulator.updates == [(0, 0, 800, 600, DisplayModes.GC16)]
+
+
+def test_auto_pixel_format(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    display.wait_display_ready()
+
+    # black and white goes out as bitmap, aligned to 32 pixels
+    display.frame_buf.paste(0x00, (40, 40, 80, 60))
+    display.draw_partial(DisplayModes.DU)
+    assert emulator.updates[-1][:4] == (32, 40, 64, 20)
+    assert display.epd.bitmap_colors is not None
+
+    # more than two levels as 4bpp, aligned to 4 pixels
+    display.frame_buf.paste(0x80, (42, 100, 60, 120))
+    display.frame_buf.paste(0x40, (60, 100, 80, 120))
+    display.draw_partial(DisplayModes.GC16)
+    assert emulator.updates[-1][:4] == (40, 100, 40, 20)
+    assert display.epd.bitmap_colors is None
+
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+
+
+def test_auto_mode_of_quantized_pixels(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    gradient = np.tile(np.linspace(0, 255, 128).astype(np.uint8), (32, 1))
+
+    display.frame_buf.paste(Image.fromarray(gradient), (64, 64))
+    display.draw_partial(DisplayModes.AUTO)
+    assert emulator.updates[-1][4] not in (DisplayModes.DU, DisplayModes.A2)
+
+    # dithered to black and white, the gradient goes out as such
+    display.frame_buf.paste(Image.fromarray(gradient), (64, 128))
+    display.draw_partial(DisplayModes.AUTO, dither=Quantizer(2))
+    assert emulator.updates[-1][:2] == (64, 128)
+    assert emulator.updates[-1][4] in (DisplayModes.DU, DisplayModes.A2)
+
+    assert set(np.unique(emulator.panel[128:160, 64:192] >> 4)) == {0x0, 0xF}
+
+
+@pytest.mark.parametrize('method', Quantizer.METHODS)
+@pytest.mark.parametrize('levels', [2, 4, 16])
+def test_quantizer_levels(rng, method, levels):
+    quantizer = Quantizer(levels, method)
+    step = 255 / (levels - 1)
+
+    # every result is one of the levels, and the levels themselves are kept
+    pixels = rng.integers(0, 256, (48, 80), dtype=np.uint8)
+    assert set(np.unique(quantizer.quantize(pixels))) <= set(quantizer.grays)
+    flat = np.repeat(quantizer.grays, 8).reshape(levels, 8)
+    np.testing.assert_array_equal(quantizer.quantize(flat), flat)
+
+    gray = np.full((64, 64), 0x70, dtype=np.uint8)
+    quantized = quantizer.quantize(gray).astype(float)
+    if method == 'threshold':
+        # the nearest level
+        np.testing.assert_array_equal(quantized, np.round(np.round(0x70 / step) * step))
+    else:
+        # dithering mixes the neighbouring levels to the same mean gray
+        assert set(np.unique(quantized)) <= {np.floor(0x70 / step) * step // 1, np.ceil(0x70 / step) * step // 1}
+        assert abs(quantized.mean() - 0x70) < step / 8
+
+
+@pytest.mark.parametrize('method', ['threshold', 'ordered'])
+def test_quantizer_areas_join(rng, method):
+    # the pattern is aligned to the frame, so an area matches the same part of the frame
+    quantizer = Quantizer(2, method)
+    frame = rng.integers(0, 256, (64, 96), dtype=np.uint8)
+    whole = quantizer.quantize(frame)
+    np.testing.assert_array_equal(quantizer.quantize(frame[13:40, 21:77], (21, 13)), whole[13:40, 21:77])
+
+
+def test_quantizer_arguments():
+    with pytest.raises(ValueError):
+        Quantizer(8)
+    with pytest.raises(ValueError):
+        Quantizer(2, 'random')
+
+
+@pytest.mark.parametrize('method', Quantizer.METHODS)
+def test_quantizer_cache(rng, method):
+    quantizer = Quantizer(4, method, tile_size=(32, 32))
+    size = (128, 96)
+    frame = rng.integers(0, 256, (96, 128), dtype=np.uint8)
+
+    first = quantizer.quantize(frame, (0, 0), size).copy()
+    assert (quantizer.hits, quantizer.misses) == (0, 12)
+    if method != 'diffusion':
+        np.testing.assert_array_equal(first, quantizer.quantize(frame))
+
+    # unchanged tiles come from the cache
+    np.testing.assert_array_equal(quantizer.quantize(frame, (0, 0), size), first)
+    assert (quantizer.hits, quantizer.misses) == (12, 12)
+
+    # a changed pixel only quantizes its tile again, the others keep their pattern
+    frame[40, 70] ^= 0xFF
+    second = quantizer.quantize(frame, (0, 0), size)
+    assert (quantizer.hits, quantizer.misses) == (23, 13)
+    tile = (slice(32, 64), slice(64, 96))
+    outside = np.ones(first.shape, dtype=bool)
+    outside[tile] = False
+    np.testing.assert_array_equal(second[outside], first[outside])
+    np.testing.assert_array_equal(second[tile], quantizer.quantize(frame[tile], (64, 32)))
+
+    # tiles an area covers only in part are not cached
+    quantizer = Quantizer(4, method, tile_size=(32, 32))
+    quantizer.quantize(frame[8:40, 8:72], (8, 8), size)
+    quantizer.quantize(frame[8:40, 8:72], (8, 8), size)
+    assert (quantizer.hits, quantizer.misses) == (0, 12)
+
+
+def test_text_renderer(emulator, font):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    text = TextRenderer(display)
+
+    image, anchor = text.render('42.5', font, 30)
+    # padded to whole words of 1bpp bitmaps and to four rows, in 16 gray levels
+    assert image.size[0] % 32 == 0 and image.size[1] % 4 == 0
+    pixels = np.asarray(image)
+    assert not np.any(pixels % 0x11)
+    assert pixels.min() == 0x00
+    assert (text.hits, text.misses) == (0, 1)
+    assert text.render('42.5', font, 30) == (image, anchor)
+    assert (text.hits, text.misses) == (1, 1)
+
+    # right aligned text ends at x
+    box = text.draw((320, 100), '42.5', font, 30, align='right')
+    frame = np.asarray(display.frame_buf)
+    assert box[1] == 100 and box[0] < 320 <= box[2]
+    assert frame[:, 320:].min() == 0xFF
+    assert frame[box[1]:box[3], box[0]:320].min() == 0x00
+    display.draw_partial(DisplayModes.GC16, damage=[box])
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+
+    # a shorter text at the same place clears what the longer one left
+    wide = text.draw((64, 200), '888888', font, 30)
+    narrow = text.draw((64, 200), '1', font, 30)
+    assert narrow == wide
+    frame = np.asarray(display.frame_buf)
+    strip, _ = text.render('1', font, 30)
+    assert frame[200:wide[3], 64 + strip.size[0]:wide[2]].min() == 0xFF
+    display.draw_partial(DisplayModes.GC16, damage=[narrow])
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+    assert emulator.errors == []
+
+
+def test_text_renderer_evicts(font):
+    text = TextRenderer(None, max_strips=2)
+    for value in ('1', '2', '3'):
+        text.render(value, font, 20)
+    text.render('3', font, 20)
+    assert text.hits == 1
+    # the strip used longest ago was dropped
+    text.render('1', font, 20)
+    assert text.misses == 4
+    with pytest.raises(ValueError):
+        text.render('1', font, 20, align='top')
+
+
+@pytest.mark.parametrize('display_class', [AutoEPDDisplay, PipelinedEPDDisplay])
+def test_overlapping_refreshes(emulator, display_class):
+    display = display_class(epd=emulator.epd())
+    display.clear()
+    display.wait_display_ready()
+    if display_class is PipelinedEPDDisplay:
+        display.flush()
+
+    # areas of the same draw are sent as 4bpp, each loaded while the one before refreshes
+    waits = display.epd.ready_waits
+    display.frame_buf.paste(0x00, (0, 0, 64, 64))
+    display.frame_buf.paste(0x00, (736, 536, 800, 600))
+    display.draw_partial(DisplayModes.DU)
+    if display_class is PipelinedEPDDisplay:
+        display.flush()
+    assert display.epd.ready_waits == waits
+    assert not display.refreshing_bitmap
+
+    # a single area while the panel is idle goes out as bitmap
+    display.wait_display_ready()
+    display.frame_buf.paste(0x00, (320, 300, 384, 340))
+    display.draw_partial(DisplayModes.DU)
+    if display_class is PipelinedEPDDisplay:
+        display.flush()
+        display.close()
+    assert display.refreshing_bitmap
+
+    display.epd.wait_display_ready()
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
+    assert emulator.errors == []
+
+
+def test_scheduler_close_during_rate_limit(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    scheduler = UpdateScheduler(display, mode=DisplayModes.DU, max_rate=2)
+    scheduler.submit(np.zeros((32, 64), dtype=np.uint8), xy=(64, 64))
+    time.sleep(0.1)
+    # waits for the rate limit when close comes in
+    scheduler.submit(np.full((32, 64), 0xFF, dtype=np.uint8), xy=(64, 64))
+
+    closing = threading.Thread(target=scheduler.close, daemon=True)
+    closing.start()
+    closing.join(2.0)
+    assert not closing.is_alive()
+    assert scheduler.refreshes == 2
+    frame, panel = shown(emulator, display)
+    np.testing.assert_array_equal(panel, frame)
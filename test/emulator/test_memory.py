@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from IT8951.constants import Commands, DisplayModes, PixelModes, Registers
+from IT8951.display import AutoEPDDisplay
+
+
+def test_burst_round_trip(emulator, rng):
+    epd = emulator.epd()
+    emulator.reset_stats()
+    # more than one chunk of SPI.MAX_BUFFER_SIZE words
+    words = rng.integers(0, 1 << 16, 2500, dtype=np.uint16)
+
+    epd.write_memory(epd.frame_offset(1) + 6, words)
+
+    address = emulator.img_buf_address + epd.frame_offset(1) + 6
+    np.testing.assert_array_equal(emulator.memory[address:address + 2 * words.size].view('<u2'), words)
+    np.testing.assert_array_equal(epd.read_memory(epd.frame_offset(1) + 6, words.size), words)
+    assert emulator.commands[Commands.MEM_BST_END] == 2
+    assert emulator.errors == []
+
+
+def test_burst_odd_offset(emulator):
+    epd = emulator.epd()
+    with pytest.raises(ValueError):
+        epd.write_memory(3, [0])
+
+
+@pytest.mark.parametrize('xy, dims', [(None, None), ((0, 100), (800, 40)), ((34, 17), (250, 61))])
+def test_image_round_trip(emulator, rng, xy, dims):
+    epd = emulator.epd()
+    offset = epd.frame_offset(2)
+    (x, y), (w, h) = xy or (0, 0), dims or (800, 600)
+    pixels = rng.integers(0, 256, (h, w), dtype=np.uint8)
+
+    epd.write_image(pixels, xy, dims, offset=offset)
+
+    frame = emulator.frame(emulator.img_buf_address + offset)
+    np.testing.assert_array_equal(frame[y:y + h, x:x + w], pixels)
+    assert (frame[:y] == 0).all() and (frame[y + h:] == 0).all()
+    # read_image takes odd coordinates as well
+    np.testing.assert_array_equal(epd.read_image((x + 1, y), (w - 2, h), offset=offset), pixels[:, 1:-1])
+    assert emulator.errors == []
+
+
+@pytest.fixture
+def display(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    return display
+
+
+def test_slots(emulator, display, rng):
+    screens = {name: rng.integers(0, 16, (600, 800), dtype=np.uint8) * 0x11 for name in ('home', 'settings')}
+    image_buffer = emulator.frame().copy()
+    for name, pixels in screens.items():
+        display.store_slot(name, pixels, PixelModes.M_4BPP)
+    # the image buffer is left alone
+    np.testing.assert_array_equal(emulator.frame(), image_buffer)
+
+    loads = emulator.commands[Commands.LD_IMG_AREA]
+    for name in ('settings', 'home', 'settings'):
+        display.show_slot(name)
+        np.testing.assert_array_equal(emulator.panel, screens[name] & 0xF0)
+        np.testing.assert_array_equal(np.asarray(display.frame_buf), screens[name])
+        assert display.current_slot == name
+    assert emulator.commands[Commands.LD_IMG_AREA] == loads
+    assert emulator.commands[Commands.DPY_BUF_AREA] == 3
+
+    # loads keep going to the image buffer
+    address = emulator.registers[Registers.LISAR] | (emulator.registers[Registers.LISAR + 2] << 16)
+    assert address == emulator.img_buf_address
+    assert emulator.errors == []
+
+
+def test_partial_update_after_slot(emulator, display):
+    pixels = np.full((600, 800), 0x55, dtype=np.uint8)
+    display.store_slot('gray', pixels, PixelModes.M_4BPP)
+    display.show_slot('gray')
+
+    display.frame_buf.paste(0x00, (100, 100, 164, 132))
+    display.draw_partial(DisplayModes.GC16)
+
+    # only the change is sent, on top of the slot
+    x, y, w, h, _ = emulator.updates[-1]
+    assert x <= 100 and y == 100 and x + w >= 164 and y + h == 132 and w * h < 4096
+    assert display.current_slot is None
+    expected = pixels.copy()
+    expected[100:132, 100:164] = 0x00
+    np.testing.assert_array_equal(emulator.panel >> 4, expected >> 4)
+
+
+def test_slots_bounded(emulator, display):
+    # the emulator holds the image buffer and three more frames
+    assert display.epd.frame_count == 4
+    with pytest.raises(ValueError):
+        display.epd.frame_offset(4)
+
+    pixels = np.full((600, 800), 0x55, dtype=np.uint8)
+    for name in ('a', 'b', 'c'):
+        display.store_slot(name, pixels, PixelModes.M_4BPP)
+    with pytest.raises(ValueError):
+        display.store_slot('d', pixels, PixelModes.M_4BPP)
+    assert sorted(display.slots) == ['a', 'b', 'c']
+    # existing slots can still be overwritten
+    display.store_slot('c', pixels, PixelModes.M_4BPP)
+    assert emulator.errors == []
@@ -0,0 +1,64 @@
+import logging
+
+import numpy as np
+import pytest
+
+from IT8951.constants import PixelModes
+from IT8951.emulator import IT8951Emulator
+from IT8951.spi import SPI
+
+
+def load_frame(emulator, epd, rng):
+    pixels = rng.integers(0, 256, (emulator.height, emulator.width), dtype=np.uint8)
+    emulator.reset_stats()
+    epd.load_img_area(pixels, xy=(0, 0), dims=(emulator.width, emulator.height), pixel_format=PixelModes.M_4BPP)
+    np.testing.assert_array_equal(emulator.frame(), pixels & 0xF0)
+    assert emulator.errors == []
+
+
+@pytest.mark.parametrize('bufsiz, chunk, segments', [(4096, 1023, 2), (65536, 1024, 31)])
+def test_batched_transfers(rng, bufsiz, chunk, segments):
+    emulator = IT8951Emulator(width=800, height=600, time_scale=0.0, bufsiz=bufsiz)
+    epd = emulator.epd(batch_transfers=True)
+    assert (epd.spi.batch_chunk, epd.spi.batch_segments) == (chunk, segments)
+    batch = epd.spi.pool.arrays['batch']
+
+    load_frame(emulator, epd, rng)
+
+    # 120000 words of 4bpp pixels
+    chunks = -(-120000 // chunk)
+    assert emulator.ioctls == epd.spi.ioctl_count == -(-chunks // segments)
+    assert epd.spi.batch_transfers
+    # the batch buffer was reserved for a full frame
+    assert epd.spi.pool.arrays['batch'] is batch
+
+
+def test_unbatched_transfers(emulator, rng):
+    epd = emulator.epd()
+    load_frame(emulator, epd, rng)
+    assert emulator.ioctls == 0
+
+
+def test_message_too_large(rng, caplog):
+    # spidev takes less than the transport was told
+    emulator = IT8951Emulator(width=800, height=600, time_scale=0.0)
+    epd = emulator.epd(batch_transfers=True, message_size=65536)
+
+    with caplog.at_level(logging.WARNING):
+        load_frame(emulator, epd, rng)
+
+    assert emulator.ioctls == 0
+    assert not epd.spi.batch_transfers
+    assert 'spidev.bufsiz' in caplog.text
+
+
+def test_message_size_too_small(emulator, caplog):
+    with caplog.at_level(logging.WARNING):
+        spi = emulator.spi(batch_transfers=True, message_size=4)
+    assert not spi.batch_transfers
+    assert 'too small' in caplog.text
+
+
+def test_max_message_size():
+    # read from sysfs on a Raspberry Pi, the kernel default elsewhere
+    assert SPI.max_message_size() >= 4096
@@ -0,0 +1,206 @@
+import numpy as np
+import pytest
+
+from IT8951.constants import Commands, DisplayModes, PixelModes, Registers, Rotate
+from IT8951.emulator import UP1SR_BITMAP, IT8951Emulator
+from IT8951.interface import PackCache
+
+# the bits of a pixel the controller keeps in every pixel format, stored as upper bits of a byte
+STORED_BITS = {
+    PixelModes.M_2BPP: 0xC0,
+    PixelModes.M_3BPP: 0xE0,
+    PixelModes.M_4BPP: 0xF0,
+    PixelModes.M_8BPP: 0xFF,
+}
+
+# numpy.rot90 turns from the loaded image to the device frame
+TURNS = {
+    Rotate.NONE: 0,
+    Rotate.CW: -1,
+    Rotate.CCW: 1,
+    Rotate.FLIP: 2,
+}
+
+PIXEL_FORMATS = sorted(STORED_BITS)
+ROTATIONS = sorted(TURNS)
+
+
+def image_size(emulator, rotate):
+    if rotate in (Rotate.CW, Rotate.CCW):
+        return emulator.height, emulator.width
+    return emulator.width, emulator.height
+
+
+@pytest.mark.parametrize('rotate', ROTATIONS)
+@pytest.mark.parametrize('pixel_format', PIXEL_FORMATS)
+def test_load_full_frame(emulator, rng, pixel_format, rotate):
+    epd = emulator.epd()
+    width, height = image_size(emulator, rotate)
+    image = rng.integers(0, 256, (height, width), dtype=np.uint8)
+
+    epd.load_img_area(image, rotate_mode=rotate, pixel_format=pixel_format)
+
+    assert emulator.commands[Commands.LD_IMG] == 1
+    expected = np.rot90(image & STORED_BITS[pixel_format], TURNS[rotate])
+    np.testing.assert_array_equal(emulator.frame(), expected)
+    assert emulator.errors == []
+
+
+@pytest.mark.parametrize('rotate', ROTATIONS)
+@pytest.mark.parametrize('pixel_format', PIXEL_FORMATS)
+def test_load_area(emulator, rng, pixel_format, rotate):
+    epd = emulator.epd()
+    width, height = image_size(emulator, rotate)
+    image = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    x, y, w, h = 64, 40, 96, 52
+
+    epd.load_img_area(image[y:y + h, x:x + w], rotate_mode=rotate, xy=(x, y), dims=(w, h),
+                      pixel_format=pixel_format)
+
+    # only the area changes, at the place it takes in the rotated frame
+    canvas = np.zeros((height, width), dtype=np.uint8)
+    canvas[y:y + h, x:x + w] = image[y:y + h, x:x + w] & STORED_BITS[pixel_format]
+    np.testing.assert_array_equal(emulator.frame(), np.rot90(canvas, TURNS[rotate]))
+    assert emulator.errors == []
+
+
+@pytest.mark.parametrize('rotate, corner', [
+    (Rotate.NONE, (0, 0)),
+    (Rotate.CW, (0, 799)),
+    (Rotate.CCW, (599, 0)),
+    (Rotate.FLIP, (599, 799)),
+])
+def test_rotated_origin(emulator, rotate, corner):
+    # the first loaded pixel lands in the corner the datasheet gives for each rotation
+    epd = emulator.epd()
+    width, height = image_size(emulator, rotate)
+    image = np.zeros((height, width), dtype=np.uint8)
+    image[0, 0] = 0xFF
+
+    epd.load_img_area(image, rotate_mode=rotate, pixel_format=PixelModes.M_8BPP)
+
+    assert list(zip(*np.nonzero(emulator.frame()))) == [corner]
+
+
+@pytest.mark.parametrize('rotate', ROTATIONS)
+@pytest.mark.parametrize('pixel_format', PIXEL_FORMATS)
+def test_rows_padded_to_words(rng, pixel_format, rotate):
+    # rotated by a quarter, rows are 758 pixels long, which fills no whole word below 8bpp
+    emulator = IT8951Emulator(width=1024, height=758, time_scale=0.0)
+    epd = emulator.epd()
+    width, height = image_size(emulator, rotate)
+    image = rng.integers(0, 256, (height, width), dtype=np.uint8)
+
+    epd.load_img_area(image, rotate_mode=rotate, pixel_format=pixel_format)
+    np.testing.assert_array_equal(emulator.frame(), np.rot90(image & STORED_BITS[pixel_format], TURNS[rotate]))
+
+    # an area of odd width at the edge, given as bytes
+    x, y, w, h = width - 13, 40, 13, 20
+    area = image[y:y + h, x:x + w] ^ 0xFF
+    epd.load_img_area(area.tobytes(), rotate_mode=rotate, xy=(x, y), dims=(w, h), pixel_format=pixel_format)
+    image[y:y + h, x:x + w] = area
+    np.testing.assert_array_equal(emulator.frame(), np.rot90(image & STORED_BITS[pixel_format], TURNS[rotate]))
+    assert emulator.errors == []
+
+
+@pytest.mark.parametrize('pixel_format', PIXEL_FORMATS)
+def test_display_area_shows_memory(emulator, rng, pixel_format):
+    epd = emulator.epd()
+    xy, dims = (128, 100), (200, 120)
+    pixels = rng.integers(0, 256, (dims[1], dims[0]), dtype=np.uint8)
+
+    epd.load_img_area(pixels, xy=xy, dims=dims, pixel_format=pixel_format)
+    epd.display_area(xy, dims, DisplayModes.GC16)
+
+    assert emulator.updates == [(128, 100, 200, 120, DisplayModes.GC16)]
+    np.testing.assert_array_equal(emulator.panel[100:220, 128:328], pixels & STORED_BITS[pixel_format])
+    assert (emulator.panel[:100] == 0xFF).all()
+
+
+def test_auto_pixel_format(emulator):
+    epd = emulator.epd()
+    two_levels = np.full((32, 64), 0xFF, dtype=np.uint8)
+    two_levels[8:24, 8:56] = 0x00
+    gray = np.arange(32 * 64, dtype=np.uint32).reshape(32, 64).astype(np.uint8)
+
+    assert epd.select_pixel_format(two_levels, (32, 0), (64, 32)) == PixelModes.M_1BPP
+    # bitmaps need x and width aligned to 32 pixels, and cannot be rotated
+    assert epd.select_pixel_format(two_levels, (4, 0), (64, 32)) == PixelModes.M_4BPP
+    assert epd.select_pixel_format(two_levels, (32, 0), (64, 32), Rotate.CW) == PixelModes.M_4BPP
+    assert epd.select_pixel_format(gray, (32, 0), (64, 32)) == PixelModes.M_4BPP
+    assert epd.select_pixel_format(gray[:, :62], (2, 0), (62, 32)) == PixelModes.M_8BPP
+
+    assert epd.load_img_area(gray, xy=(32, 0), dims=(64, 32), pixel_format=PixelModes.AUTO) == PixelModes.M_4BPP
+    np.testing.assert_array_equal(emulator.frame()[:32, 32:96], gray & 0xF0)
+
+
+def test_bitmap(emulator, rng):
+    epd = emulator.epd()
+    x, y, w, h = 64, 16, 128, 40
+    pixels = np.where(rng.random((h, w)) < 0.5, 0x30, 0xE0).astype(np.uint8)
+
+    assert epd.load_img_area(pixels, xy=(x, y), dims=(w, h), pixel_format=PixelModes.M_1BPP) == PixelModes.M_1BPP
+    epd.display_area((x, y), (w, h), DisplayModes.DU)
+
+    # a bit per pixel, set for the darker level, stored as bytes at x / 8
+    bits = np.packbits(pixels == 0x30, axis=1, bitorder='little')
+    np.testing.assert_array_equal(emulator.frame()[y:y + h, x // 8:(x + w) // 8], bits)
+    assert emulator.registers[Registers.UP1SR + 2] & UP1SR_BITMAP
+    assert emulator.registers[Registers.BGVR] == 0x33EE
+    np.testing.assert_array_equal(emulator.panel[y:y + h, x:x + w], np.where(pixels == 0x30, 0x33, 0xEE))
+
+    # any other format switches the display engine back to 8bpp
+    epd.load_img_area(pixels, xy=(x, y), dims=(w, h), pixel_format=PixelModes.M_4BPP)
+    assert not emulator.registers[Registers.UP1SR + 2] & UP1SR_BITMAP
+    assert emulator.errors == []
+
+
+def test_bitmap_keeps_memory(emulator, rng):
+    epd = emulator.epd()
+    before = rng.integers(0, 256, (emulator.height, emulator.width), dtype=np.uint8)
+    epd.write_image(before)
+    epd.write_image(before[::-1], offset=epd.frame_offset(1))
+    x, y, w, h = 256, 16, 128, 40
+    pixels = np.where(rng.random((h, w)) < 0.5, 0x30, 0xE0).astype(np.uint8)
+
+    epd.load_img_area(pixels, xy=(x, y), dims=(w, h), pixel_format=PixelModes.M_1BPP)
+    epd.display_area((x, y), (w, h), DisplayModes.DU)
+    # a second bitmap whose columns overlap those of the first
+    epd.load_img_area(pixels, xy=(x + 32, y + 8), dims=(w, h), pixel_format=PixelModes.M_1BPP)
+    epd.display_area((x + 32, y + 8), (w, h), DisplayModes.DU)
+    epd.wait_display_ready()
+
+    # leaving 1bpp mode writes back the columns the bitmaps were loaded into
+    epd.load_img_area(pixels, xy=(x, y), dims=(w, h), pixel_format=PixelModes.M_8BPP)
+    expected = before.copy()
+    expected[y:y + h, x:x + w] = pixels
+    np.testing.assert_array_equal(epd.read_image(), expected)
+    np.testing.assert_array_equal(epd.read_image(offset=epd.frame_offset(1)), before[::-1])
+    assert emulator.errors == []
+
+
+def test_bitmap_constraints(emulator):
+    epd = emulator.epd()
+    pixels = np.zeros((8, 64), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        epd.load_img_area(pixels, xy=(8, 0), dims=(64, 8), pixel_format=PixelModes.M_1BPP)
+    with pytest.raises(ValueError):
+        epd.load_img_area(pixels, rotate_mode=Rotate.FLIP, xy=(0, 0), dims=(64, 8), pixel_format=PixelModes.M_1BPP)
+
+
+def test_pack_cache(emulator, rng):
+    epd = emulator.epd()
+    # off by default, changing frames are loaded without allocations
+    assert epd.pack_cache is None
+    epd.load_img_area(rng.integers(0, 256, (600, 800), dtype=np.uint8))
+    allocations = epd.spi.pool.allocations
+    for _ in range(2):
+        epd.load_img_area(rng.integers(0, 256, (600, 800), dtype=np.uint8))
+    assert epd.spi.pool.allocations == allocations
+
+    epd.pack_cache = PackCache()
+    icons = [rng.integers(0, 256, (32, 64), dtype=np.uint8) for _ in range(2)]
+    for icon in icons + icons:
+        epd.load_img_area(icon, xy=(64, 32), dims=(64, 32))
+        np.testing.assert_array_equal(emulator.frame()[32:64, 64:128], icon & 0xF0)
+    assert (epd.pack_cache.hits, epd.pack_cache.misses) == (2, 2)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from IT8951.constants import DisplayModes
+from IT8951.display import AutoEPDDisplay
+from IT8951.widgets import BarGauge, Label, Rectangle, WidgetLayer
+
+
+@pytest.fixture
+def display(emulator):
+    display = AutoEPDDisplay(epd=emulator.epd())
+    display.clear()
+    return display
+
+
+def outside(frame, *boxes):
+    """
+    Return the pixels of frame outside of boxes
+    """
+    mask = np.ones(frame.shape, dtype=bool)
+    for minx, miny, maxx, maxy in boxes:
+        mask[miny:maxy, minx:maxx] = False
+    return frame[mask]
+
+
+def test_bar_gauge(emulator, display):
+    layer = WidgetLayer(display)
+    gauge = layer.add(BarGauge((64, 300, 464, 340), maximum=200, fill=0x00))
+
+    # the first update draws the whole box
+    assert layer.render() == [gauge.box]
+    gauge.set(100)
+    assert layer.render() == [(64, 300, 264, 340)]
+    frame = np.asarray(display.frame_buf)
+    assert (frame[300:340, 64:264] == 0x00).all() and (frame[300:340, 264:464] == 0xFF).all()
+
+    # a shorter bar clears the strip it left, values are kept to the box
+    gauge.set(50)
+    assert layer.render() == [(164, 300, 264, 340)]
+    assert (np.asarray(display.frame_buf)[300:340, 164:464] == 0xFF).all()
+    gauge.set(50)
+    assert layer.render() == []
+    gauge.set(1000)
+    assert layer.render() == [(164, 300, 464, 340)]
+    assert (np.asarray(display.frame_buf)[300:340, 64:464] == 0x00).all()
+    assert (outside(np.asarray(display.frame_buf), gauge.box) == 0xFF).all()
+
+
+def test_label(emulator, display, font):
+    layer = WidgetLayer(display)
+    label = layer.add(Label((96, 64, 256, 104), font, 30, '12 km/h', align='right'))
+    frame_box = layer.add(Rectangle((64, 48, 288, 120), fill=None, outline=0x00, width=2))
+
+    layer.update(DisplayModes.GC16)
+    frame = np.asarray(display.frame_buf)
+    assert frame[64:104, 96:256].min() == 0x00
+    assert (frame[48:50, 64:288] == 0x00).all() and (frame[48:120, 64:66] == 0x00).all()
+    assert (outside(frame, frame_box.box) == 0xFF).all()
+    np.testing.assert_array_equal(emulator.panel >> 4, frame >> 4)
+
+    # text wider than the box is cut to it, and only the label is sent
+    updates = len(emulator.updates)
+    label.set('1234567890 km/h')
+    layer.update(DisplayModes.GC16)
+    frame = np.asarray(display.frame_buf)
+    assert (outside(frame, frame_box.box) == 0xFF).all()
+    assert (frame[50:64, 66:286] == 0xFF).all() and (frame[104:118, 66:286] == 0xFF).all()
+    assert len(emulator.updates) == updates + 1
+    x, y, w, h, _ = emulator.updates[-1]
+    assert 96 - 32 < x and x + w < 256 + 32 and 64 <= y and y + h <= 104 + 4
+    np.testing.assert_array_equal(emulator.panel >> 4, frame >> 4)
+
+    # nothing changed, nothing is sent
+    label.set('1234567890 km/h')
+    layer.update(DisplayModes.DU)
+    assert len(emulator.updates) == updates + 1
+
+    # after frame_buf was overwritten, invalidate draws every widget again
+    display.frame_buf.paste(0x80, (0, 0, 800, 600))
+    layer.invalidate()
+    assert sorted(layer.render()) == sorted([label.box, frame_box.box])
+    assert (np.asarray(display.frame_buf)[64:104, 96:256] != 0x80).all()
+    assert emulator.errors == []
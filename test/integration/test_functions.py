@@ -98,7 +98,6 @@ def partial_update(display):
     _place_text(display.frame_buf, 'partial', x_offset=-200)
     display.draw_full(constants.DisplayModes.GC16)
 
-    # TODO: should use 1bpp for partial text update
     logging.info('  writing partial...')
     start = time.time()
     _place_text(display.frame_buf, 'update', x_offset=+200)